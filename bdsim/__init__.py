@@ -1,3 +1,4 @@
 from bdsim.blockdiagram import *
 from bdsim.components import *
 from bdsim.graphics import GraphicsBlock
+from bdsim.parallel import sweep
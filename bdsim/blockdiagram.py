@@ -12,16 +12,30 @@ import importlib
 import inspect
 import re
 import argparse
+import numbers
 from collections import Counter, namedtuple
 import numpy as np
-import scipy.integrate as integrate
+import scipy.optimize
+import scipy.sparse
 
 from ansitable import ANSITable, Column
 
 from bdsim.components import *
+import bdsim.codegen
+import bdsim.solvers
+import bdsim.recorder
 
 debuglist = [] # ('propagate', 'state', 'deriv')
 
+def _watch(recorder, name, plug):
+    # add a channel to the recorder for a watched port, with the shape and
+    # type of the value on its wire that was found by compile
+    w = plug.block.inports[plug.port]
+    if w is None or w.shape is None:
+        recorder.add(name)
+    else:
+        recorder.add(name, w.shape, w.dtype if w.dtype is not None else object)
+
 def DEBUG(debug, *args):
     if debug in debuglist:
         print('DEBUG.{:s}: '.format(debug), *args)
@@ -50,10 +64,16 @@ class BlockDiagram:
     :vartype wirelist: list of Wire instances
     :ivar blocklist: all blocks in the diagram
     :vartype blocklist: list of Block subclass instances
-    :ivar x: state vector
+    :ivar x: state vector, each stateful block has a view of its own slice
     :vartype x: np.ndarray
+    :ivar xd: state derivative vector, each stateful block writes to its own slice
+    :vartype xd: np.ndarray
     :ivar compiled: diagram has successfully compiled
     :vartype compiled: bool
+    :ivar algebraic_loops: closed paths of function blocks found by ``compile``
+    :vartype algebraic_loops: list of lists of Block
+    :ivar pruned: unused blocks that are not evaluated
+    :vartype pruned: list of Block
     :ivar T: maximum simulation time (seconds)
     :vartype T: float
     :ivar t: current simulation time (seconds)
@@ -72,6 +92,8 @@ class BlockDiagram:
     :vartype name: str
     :ivar graphics: enable graphics
     :vartype graphics: bool
+    :ivar code: generated Python code for evaluating the diagram, else None
+    :vartype code: str
     """
     
     def __init__(self, name='main', **kwargs):
@@ -114,13 +136,24 @@ class BlockDiagram:
             - 'p' debug network value propagation
             - 's' debug state vector
             - 'd' debug state derivative 
+            - 'c' check block inputs and outputs at every evaluation
+
+        Without the 'c' flag the diagram runs in release mode.  Block inputs
+        and outputs are checked once, when the diagram is compiled, and the
+        type, dtype and shape of the value on every wire is recorded.  With
+        the flag every evaluation is checked against these, and for inf or
+        nan values, which is slower but pinpoints the block at fault.
 
         """
 
         self.wirelist = []      # list of all wires
         self.blocklist = []     # list of all blocks
         self.x = None           # state vector numpy.ndarray
+        self.xd = None          # state derivative numpy.ndarray
         self.compiled = False   # network has been compiled
+        self.pruned = []        # blocks removed from the schedule
+        self._fused = []        # fused blocks in the schedule
+        self._published = []    # fused blocks whose members are evaluated
         self.T = None           # maximum.BlockDiagram time
         self.t = None           # current time
         self.fignum = 0
@@ -128,6 +161,9 @@ class BlockDiagram:
         self.checkfinite = True
         self.blockcounter = Counter()
         self.name = name
+        self.code = None
+        self._codemaker = None
+        self._store = None      # signal store, see _layout
 
         # process command line and constructor options
         self._get_options(**kwargs)
@@ -160,7 +196,7 @@ class BlockDiagram:
                                 help='animate graphics')
             parser.add_argument('--noprogress', '-p', default=defaults['progress'], action='store_const', const=False, dest='progress',
                         help='animate graphics')
-            parser.add_argument('--debug', '-d', type=str, metavar='[psd]', default=defaults['debug'], 
+            parser.add_argument('--debug', '-d', type=str, metavar='[psdc]', default=defaults['debug'], 
                                 help='debug flags')
             clargs = vars(parser.parse_args())  # get args as a dictionary
             print(f'clargs {clargs}')
@@ -196,6 +232,7 @@ class BlockDiagram:
             debuglist.append('state')
         if 'd' in self.options.debug:
             debuglist.append('deriv')
+        self._checks = 'c' in self.options.debug
             
     def _load_modules(self):
         nblocks = len(blocklist)
@@ -341,7 +378,8 @@ class BlockDiagram:
                 wire = Wire(start, end, name)
                 self.add_wire(wire)
         
-    def compile(self, subsystem=False, doimport=True):
+    def compile(self, subsystem=False, doimport=True, algebraic=False,
+                prune=True, fuse=False, store=False, codegen=False, codecache=None):
         """
         Compile the block diagram
         
@@ -349,6 +387,18 @@ class BlockDiagram:
         :type subsystem: bool, optional
         :param doimport: import subsystems, defaults to True
         :type doimport: bool, optional
+        :param algebraic: solve algebraic loops numerically, defaults to False
+        :type algebraic: bool, optional
+        :param prune: remove unused blocks from the schedule, defaults to True
+        :type prune: bool, optional
+        :param fuse: evaluate groups of linear blocks as one block, defaults to False
+        :type fuse: bool, optional
+        :param store: keep numeric wire values in a single array, defaults to False
+        :type store: bool, optional
+        :param codegen: generate Python code to evaluate the diagram, defaults to False
+        :type codegen: bool, optional
+        :param codecache: directory in which to cache generated code, defaults to None
+        :type codecache: str, optional
         :raises RuntimeError: various block diagram errors
         :return: Compile status
         :rtype: bool
@@ -357,12 +407,51 @@ class BlockDiagram:
             
             - Check sanity of block parameters
             - Recursively clone and import subsystems
-            - Check for loops without dynamics
+            - Check for loops without dynamics, or prepare to solve them
             - Check for inputs driven by more than one wire
             - Check for unconnected inputs and outputs
             - Link all output ports to outgoing wires
             - Link all input ports to incoming wires
-            - Evaluate all blocks in the network
+            - Build a static execution schedule
+            - Remove unused blocks from the schedule
+            - Evaluate all blocks in the network, recording wire types
+            - Optionally, replace groups of linear blocks by fused blocks
+            - Optionally, generate Python code to evaluate the network
+
+        An algebraic loop is a cycle of function blocks with no transfer block
+        to break it, and is an error unless ``algebraic`` is True.  In that
+        case each loop is evaluated by an ``AlgebraicLoop`` block that solves
+        for the values on its wires using Broyden's method, starting from the
+        solution found at the previous evaluation.
+
+        A block is unused if its outputs do not reach, directly or through
+        other blocks, a transfer block or a block with no outputs, such as a
+        sink.  Unused blocks are not evaluated during simulation, and are
+        listed in ``pruned``.  They are restored to the schedule if one is
+        watched during ``run``.
+
+        If ``fuse`` is True connected ``GAIN``, ``SUM``, ``MUX``, ``DEMUX``,
+        ``LTI_SS`` and ``LTI_SISO`` blocks are replaced in the schedule by
+        ``FusedLinear`` blocks, which evaluate each group as a single
+        state-space system, see ``_fuse``.  The blocks keep their names and
+        can still be watched.
+
+        The type, dtype and shape of the value on every wire are recorded in
+        the ``Wire`` when the network is evaluated.  Block inputs and outputs
+        are checked during this evaluation but not during simulation, unless
+        the 'c' debug flag is given.
+
+        If ``store`` is True the values on all float64 wires are kept in a
+        single preallocated vector, and array inputs of function and transfer
+        blocks are views of it, see ``_layout``.  Such a block must copy an
+        input value that it keeps, since the view is overwritten at the next
+        evaluation.  The store is not used with ``codegen``.
+
+        If ``codegen`` is True the execution schedule is converted to
+        straight-line Python code which is used by ``run`` in place of
+        ``evaluate``.  The code can be displayed using ``dumpcode``.  If a
+        ``codecache`` directory is given the code is saved there, and
+        reused by later compilations of the same diagram.
 
         """
         
@@ -412,7 +501,7 @@ class BlockDiagram:
         
         # visit all stateful blocks
         for b in self.blocklist:
-            if b.blockclass == 'TransferBlock':
+            if b.blockclass == 'transfer':
                 self.nstates += b.nstates
                 if b._state_names is not None:
                     assert len(b._state_names) == b.nstates, 'number of state names not consistent with number of states'
@@ -457,34 +546,63 @@ class BlockDiagram:
                 assert len(b._state_names) == b.nstates, 'incorrect number of state names given: ' + str(b)
                     
         # check for cycles of function blocks
-        def _DFS(path):
-            start = path[0]
-            tail = path[-1]
-            for outgoing in tail.outports:
-                # for every port on this block
-                for w in outgoing:
-                    dest = w.end.block
-                    if dest == start:
-                        print('  ERROR: cycle found: ', ' - '.join([str(x) for x in path + [dest]]))
-                        return True
-                    if dest.blockclass == 'function':
-                        return _DFS(path + [dest]) # recurse
-            return False
+        components = self._find_loops()
+        self.algebraic_loops = [self._loop_path(c) for c in components]
+        for loop in self.algebraic_loops:
+            if algebraic:
+                print('  solving algebraic loop: ', ' - '.join([str(x) for x in loop]))
+            else:
+                print('  ERROR: algebraic loop found: ', ' - '.join([str(x) for x in loop]))
+                error = True
 
-        for b in self.blocklist:
-            if b.blockclass == 'function':
-                # do depth first search looking for a cycle
-                if _DFS([b]):
-                    error = True
+        # build the execution schedule
+        loops = components if algebraic else []
+        keep = [] if prune else self.blocklist
+        self._fused = []
+        self._published = []
+        self._build_schedule(loops)
+        self._prune(keep)
+        if len(self.pruned) > 0:
+            print('  pruned {:d} blocks whose outputs are not used: '.format(len(self.pruned)),
+                  ', '.join([str(b) for b in self.pruned]))
+        self._allocate_state()
 
-        # evaluate the network once to check out wire types
+        # evaluate the network once, with all checks enabled, to check out
+        # wire types, linear blocks are fused based on these
         x = self.getstate()
         
+        checks = self._checks
+        self._checks = True
+        self._store = None
         try:
+            self._fold()
             self.evaluate(x, 0.0)
+            if fuse and self._fuse(loops, keep):
+                self._fold()
+                self.evaluate(x, 0.0)
+                for g in self._fused:
+                    g.publish(0.0)
+            self._record()
+            if store and codegen:
+                print('  WARNING: the signal store is not used with generated code')
+            elif store:
+                # evaluate again to fill the store
+                self._layout()
+                self._bindstore()
+                self._fold()
+                self.evaluate(x, 0.0)
         except RuntimeError as err:
             print('unrecoverable error in value propagation:', err)
             error = True
+        finally:
+            self._checks = checks
+
+        # generate code based on the wire values just computed
+        self.code = None
+        self._codemaker = None
+        self._codecache = codecache
+        if codegen and not error:
+            self._generate()
             
         if not error:
             self.compiled = True
@@ -562,13 +680,15 @@ class BlockDiagram:
         
     def run(self, T=10.0, dt=0.1, solver='RK45', 
             block=False, checkfinite=True, watch=[],
+            t_eval=None, sample_dt=None, record_to=None,
             **kwargs):
         """
         Run the block diagram
         
         :param T: maximum integration time, defaults to 10.0
         :type T: float, optional
-        :param dt: maximum time step, defaults to 0.1
+        :param dt: maximum time step, or the time step of a fixed-step
+                   solver, defaults to 0.1
         :type dt: float, optional
         :param solver: integration method, defaults to ``RK45``
         :type solver: str, optional
@@ -578,6 +698,12 @@ class BlockDiagram:
         :type checkfinite: bool
         :param watch: list of input ports to log
         :type watch: list
+        :param t_eval: times at which to record results, defaults to None
+        :type t_eval: array_like(M), optional
+        :param sample_dt: interval at which to record results, defaults to None
+        :type sample_dt: float, optional
+        :param record_to: file or directory to record results to, defaults to None
+        :type record_to: str, optional
         :param ``**kwargs``: passed to ``scipy.integrate``
         :return: time history of signals and states
         :rtype: Sim class
@@ -605,28 +731,872 @@ class BlockDiagram:
             - a ``Block`` reference, which is interpretted as input port 0
             - a ``Plug`` reference, ie. a block with an index or attribute
             - a string of the form "block[i]" which is port i of the block named block.
+
+        By default a watched port is recorded at every step.  An element of
+        the list can instead be a tuple of the port and a dict of options
+        that set a logging policy, for example ``('plant[0]', {'period': 0.01})``.
+        The options are ``every``, to record every k'th step, ``period``, to
+        record at most once per interval of simulation time, and ``change``,
+        to record only when the value changes, see ``bdsim.recorder.LogPolicy``.
+        The times at which port N is recorded are then ``t_uN``.  These
+        ports are recorded in memory, even if ``record_to`` is given.
         
+        If ``checkfinite`` is True the floating point values on all wires are
+        checked for inf and nan once each step is accepted, and the simulation
+        halts with a message naming the first wire at fault.
+
+        The ``solver`` is the name of a ``scipy.integrate`` solver, or one of
+        the fixed-step solvers ``'euler'``, ``'heun'``, ``'rk4'`` or
+        ``'dopri5'`` which take steps of exactly ``dt``.  For small diagrams
+        these have much less overhead per step than the adaptive solvers, but
+        the accuracy of the result depends on ``dt``.
+
+        By default results are recorded at every step of the integrator, so
+        their resolution depends on the step size.  If ``t_eval`` is given,
+        results are recorded at those times instead, or at multiples of
+        ``sample_dt`` from 0 to ``T``.  The state at these times is
+        interpolated within each step using the solver's ``dense_output``,
+        so the solver can take steps much larger than the sample interval
+        and ``dt`` can be increased to suit the dynamics rather than the
+        plots.  Sinks are still updated at every step.  ``iterrun`` runs the
+        same simulation but yields the results rather than recording them.
+
+        If ``record_to`` is given, the results are written to disk in chunks
+        as the simulation runs, to an HDF5 file if it ends with ``.h5`` and
+        ``h5py`` is installed, or else to a directory of ``.npy`` files.  The
+        arrays of the results are then read from disk as they are indexed,
+        and ``bdsim.recorder.load`` returns them again later.  The file is
+        completed even if the simulation fails.
+
+        The implicit solvers ``Radau``, ``BDF`` and ``LSODA`` are given the
+        Jacobian of the state derivative if every block that it depends on
+        provides one, as ``LTI_SS``, ``LTI_SISO``, ``INTEGRATOR`` and
+        ``GAIN`` do.  Otherwise ``Radau`` and ``BDF`` are given its sparsity
+        pattern, found from the wiring of the diagram, so that it can be
+        estimated with few evaluations of the diagram.
+
+        Source blocks such as ``STEP``, ``PIECEWISE`` and ``WAVEFORM`` report
+        the times of their discontinuities with ``breakpoints``, and the
+        integrator is restarted at each of them rather than discovering them
+        by rejecting steps.
+
+        Blocks may also have event functions, such as the condition of a
+        ``STOP`` block or the bounds of an ``INTEGRATOR``.  The time at which
+        one becomes non-negative is found by root finding, and the
+        integration steps to exactly that time, so large steps can be taken
+        without overshooting.  Events are not located in ``run_ensemble``.
 
         """
         
         assert self.compiled, 'Network has not been compiled'
+        t_eval = self._sampletimes(T, dt, t_eval, sample_dt)
+
+        # preproces the watchlist
+        pluglist, plugnamelist, policies = self._watchlist(watch)
+
+        # the time, state and watched ports are recorded into arrays, of
+        # known length if the sample times are given, or written to disk
+        if record_to is None:
+            recorder = bdsim.recorder.Recorder(n=None if t_eval is None else len(t_eval))
+        else:
+            attrs = {'unames': plugnamelist}
+            if self.nstates > 0:
+                attrs['xnames'] = self.statenames
+            recorder = bdsim.recorder.writer(record_to, attrs=attrs)
+        recorder.add('t', ())
+        if self.nstates > 0:
+            recorder.add('x', (self.nstates,))
+        unlogged = [p for p, policy in zip(pluglist, policies) if policy is None]
+        for i, p in enumerate(pluglist):
+            if policies[i] is None:
+                _watch(recorder, 'u' + str(i), p)
+
+        # ports with a logging policy are recorded in memory with their own
+        # times
+        logged = []
+        for i, p in enumerate(pluglist):
+            if policies[i] is not None:
+                r = bdsim.recorder.Recorder(chunk=64)
+                r.add('t_u' + str(i), ())
+                _watch(r, 'u' + str(i), p)
+                logged.append((p, policies[i], r))
+
+        try:
+            for t, x in self._iterrun(pluglist, T, dt, solver, checkfinite, t_eval, **kwargs):
+                if x is None:
+                    recorder.append(t, *[p.block.inputs[p.port] for p in unlogged])
+                else:
+                    recorder.append(t, x, *[p.block.inputs[p.port] for p in unlogged])
+                for p, policy, r in logged:
+                    value = p.block.inputs[p.port]
+                    if policy(t, value):
+                        r.append(t, value)
+
+        except RuntimeError as err:
+            # bad things happens, print a message and return no result
+            print('unrecoverable error in evaluation: ', err)
+            return None
+        finally:
+            if record_to is not None:
+                recorder.close()  # complete the file
+
+        # save the recorded data in a Struct
+        out = Struct('results')
+        out.update(recorder.arrays())
+        for p, policy, r in logged:
+            out.update(r.arrays())
+        if self.nstates > 0:
+            out.xnames = self.statenames
+        out.unames = plugnamelist
+
+        # statistics accumulated by STATS blocks
+        stats = [b for b in self.blocklist if b.type == 'stats']
+        if len(stats) > 0:
+            out.stats = Struct('stats')
+            for b in stats:
+                out.stats[b.name] = b.stats()
+
+        # pause until all graphics blocks close
+        self.done(block=block)
+        # print(self.count, ' integrator steps')
+        
+        return out
+
+    def iterrun(self, T=10.0, dt=0.1, solver='RK45', checkfinite=True, watch=[],
+            t_eval=None, sample_dt=None, **kwargs):
+        """
+        Run the block diagram, generating the results as they are computed
+
+        :param T: maximum integration time, defaults to 10.0
+        :type T: float, optional
+        :param dt: maximum time step, or the time step of a fixed-step
+                   solver, defaults to 0.1
+        :type dt: float, optional
+        :param solver: integration method, defaults to ``RK45``
+        :type solver: str, optional
+        :param checkfinite: error if inf or nan on any wire, default True
+        :type checkfinite: bool
+        :param watch: list of input ports to log
+        :type watch: list
+        :param t_eval: times at which to generate results, defaults to None
+        :type t_eval: array_like(M), optional
+        :param sample_dt: interval at which to generate results, defaults to None
+        :type sample_dt: float, optional
+        :param ``**kwargs``: passed to ``scipy.integrate``
+        :return: time, state and values of the watched ports
+        :rtype: generator of tuple (float, ndarray(N), list)
+
+        The simulation is the same as that of ``run``, but rather than
+        recording the results it yields them at every step, or at every
+        sample time, so a simulation of any length can be processed in
+        constant memory.  For example::
+
+            for t, x, (u,) in bd.iterrun(T=100, watch=[plant]):
+                error = max(error, abs(u))
+
+        The simulation advances only as the generator is iterated, so it can
+        be paused and resumed, and it is abandoned if the generator is
+        closed.  The state is None for a diagram that has no states.
+        Errors in evaluation are raised, rather than printed.
+
+        Assumes that the network has been compiled.
+        """
+        assert self.compiled, 'Network has not been compiled'
+        t_eval = self._sampletimes(T, dt, t_eval, sample_dt)
+        pluglist, plugnamelist, policies = self._watchlist(watch)
+        if any([policy is not None for policy in policies]):
+            raise ValueError('logging policies are only supported by run')
+
+        # the arguments are checked now, rather than when iteration starts
+        def steps():
+            for t, x in self._iterrun(pluglist, T, dt, solver, checkfinite, t_eval, **kwargs):
+                # the values may be views of arrays that will be overwritten
+                yield t, x, [np.array(p.block.inputs[p.port]) for p in pluglist]
+            self.done()
+
+        return steps()
+
+    def _sampletimes(self, T, dt, t_eval, sample_dt):
+        # check the sample times given to run, a diagram without states is
+        # evaluated at multiples of dt if none are given
+        if sample_dt is not None:
+            if t_eval is not None:
+                raise ValueError('cannot give both t_eval and sample_dt')
+            t_eval = sample_dt * np.arange(int(T / sample_dt + 1e-9) + 1)
+        if t_eval is not None:
+            t_eval = np.array(t_eval, dtype=float)
+            if t_eval.ndim != 1 or np.any(np.diff(t_eval) <= 0):
+                raise ValueError('t_eval must be a vector of increasing times')
+            if len(t_eval) > 0 and (t_eval[0] < 0 or t_eval[-1] > T):
+                raise ValueError('t_eval must lie in the interval [0, T]')
+        elif self.nstates == 0:
+            t_eval = np.arange(0, T, dt)
+        return t_eval
+
+    def _iterrun(self, pluglist, T, dt, solver, checkfinite, t_eval, **kwargs):
+        """
+        Simulate the block diagram
+
+        :param pluglist: watched ports
+        :type pluglist: list of Plug
+        :param T: maximum integration time
+        :type T: float
+        :param dt: maximum time step, or the time step of a fixed-step solver
+        :type dt: float
+        :param solver: integration method
+        :type solver: str
+        :param checkfinite: error if inf or nan on any wire
+        :type checkfinite: bool
+        :param t_eval: sample times, or None for every step
+        :type t_eval: ndarray(M)
+        :param ``**kwargs``: passed to ``scipy.integrate``
+        :return: time and state, or None if there are no states
+        :rtype: generator of tuple (float, ndarray(N))
+
+        This is the simulation loop of ``run`` and ``iterrun``.  When each
+        result is yielded the diagram has been evaluated at that time, so
+        the values of the watched ports are on their blocks' inputs.
+        """
         self.T = T
         self.count = 0
         self.stop = None # allow any block to stop.BlockDiagram by setting this to the block's name
         self.checkfinite = checkfinite
         
-        # preproces the watchlist
+        self._unprune(pluglist)
+
+        # tell all blocks we're doing a.BlockDiagram
+        self.start()
+        if self._store is not None:
+            self._bindstore()
+        self._fold()
+
+        # bind the generated code to the blocks, this is done after start
+        # since some blocks recreate their input lists
+        if self._codemaker is not None:
+            derivs = self._codemaker(self, self._codeblocks)
+        else:
+            derivs = lambda x, t: self.evaluate(x, t, outputs=False)
+
+        # get initial state from the stateful blocks
+        x0 = self.getstate()
+        if len(x0) > 0:
+            print('initial state x0 = ', x0)
+
+        if self.options.progress:
+            printProgressBar(0, prefix='Progress:', suffix='complete', length=60)
+
+        # out = scipy.integrate.solve_ivp.BlockDiagram._deriv, args=(self,), t_span=(0,T), y0=x0, 
+        #             method=solver, t_eval=np.linspace(0, T, 100), events=None, **kwargs)
+        if len(x0) > 0:
+            # block diagram contains states, solve it using numerical integration
+
+            if t_eval is not None:
+                nsamples = len(t_eval)
+                k = 0  # the next sample
+
+                while k < nsamples and t_eval[k] <= 0:
+                    self.evaluate(x0, t_eval[k])
+                    yield t_eval[k], x0.copy()
+                    k += 1
+            
+            # an implicit solver is given the Jacobian if it is known,
+            # or else its sparsity pattern
+            if solver in ('Radau', 'BDF', 'LSODA') and 'jac' not in kwargs:
+                J, sparsity = self._jacobian()
+                if J is not None:
+                    if solver == 'LSODA':
+                        J = J.toarray()
+                        kwargs['jac'] = lambda t, y: J
+                    else:
+                        kwargs['jac'] = J
+                elif solver != 'LSODA' and 'jac_sparsity' not in kwargs:
+                    kwargs['jac_sparsity'] = sparsity
+
+            # step the integrator, calls _deriv multiple times
+            for t, x, integrator, evaluated in self._integrate(solver, derivs, x0, T, dt, events=True, **kwargs):
+
+                if integrator.status == 'failed':
+                    print('integration completed with failed status ')
+
+                # the samples within this step, interpolating the state
+                if t_eval is not None and k < nsamples and t_eval[k] <= t:
+                    interpolant = integrator.dense_output()
+                    while k < nsamples and t_eval[k] <= t:
+                        xk = interpolant(t_eval[k])
+                        self.evaluate(xk, t_eval[k])
+                        yield t_eval[k], xk
+                        k += 1
+                    evaluated = False
+
+                # evaluate all blocks at the accepted step, for the sinks
+                # and the watchlist, unless this was done to find events
+                if not evaluated:
+                    self.evaluate(x, t)
+                if checkfinite:
+                    self._checkfinite(t)
+
+                if t_eval is None:
+                    yield t, x
+                
+                # update all blocks that need to know
+                self.step()
+                
+                # update the progress bar
+                if self.options.progress:
+                    printProgressBar(t / T, prefix='Progress:', suffix='complete', length=60)
+
+                # has any block called a stop?
+                if self.stop is not None:
+                    print('\n--- stop requested at t={:f} by {:s}'.format(self.t, str(self.stop)))
+                    break
+        else:
+            # block diagram has no states
+
+            for t in t_eval:  # step through the time range
+
+                # evaluate the block diagram
+                self.evaluate([], t)
+                if checkfinite:
+                    self._checkfinite(t)
+
+                yield t, None
+
+                # update all blocks that need to know
+                self.step()
+
+                # update the progress bar
+                if self.options.progress:
+                    printProgressBar(t / T, prefix='Progress:', suffix='complete', length=60)
+                    
+                # has any block called a stop?
+                if self.stop is not None:
+                    print('\n--- stop requested at t={:f} by {:s}'.format(self.t, str(self.stop)))
+                    break
+            
+        if self.options.progress:
+            print('\r' + ' '* 90 + '\r')
+
+    def run_ensemble(self, x0=None, params={}, T=10.0, dt=0.1, solver='RK45',
+            checkfinite=True, watch=[], **kwargs):
+        """
+        Run an ensemble of simulations of the block diagram
+
+        :param x0: initial state of every simulation, defaults to None
+        :type x0: array_like(N,nstates), optional
+        :param params: block parameter values for every simulation, defaults to {}
+        :type params: dict, optional
+        :param T: maximum integration time, defaults to 10.0
+        :type T: float, optional
+        :param dt: maximum time step, or the time step of a fixed-step
+                   solver, defaults to 0.1
+        :type dt: float, optional
+        :param solver: integration method, defaults to ``RK45``, see ``run``
+        :type solver: str, optional
+        :param checkfinite: error if inf or nan on any wire, default True
+        :type checkfinite: bool
+        :param watch: list of input ports to log
+        :type watch: list
+        :param ``**kwargs``: passed to ``scipy.integrate``
+        :raises ValueError: the ensemble cannot be simulated
+        :return: time history of signals and states for every simulation
+        :rtype: Struct
+
+        N variants of the diagram are simulated by a single numerical
+        integration.  Their states are stacked into an array of shape
+        (N, nstates) and every block is evaluated once per integrator stage,
+        with each wire carrying the values for all the variants.  The leading
+        axis of those values is the simulation index.
+
+        ``params`` is a dictionary that maps a block parameter to an
+        array_like of N values, one per simulation.  The parameter is given
+        as a string of the form "block.attribute" or as a tuple
+        ``(block, "attribute")``, for example::
+
+            out = bd.run_ensemble(params={'gain.0.gain': np.linspace(1, 2, 100)})
+
+        The original parameter values are restored at the end of the run.  If
+        ``x0`` is not given every simulation starts from the initial state of
+        the diagram.
+
+        Every function and transfer block must support batched evaluation,
+        currently ``GAIN``, ``SUM``, ``PROD``, ``CLIP``, ``INTEGRATOR``,
+        ``LTI_SS``, ``LTI_SISO``, ``BICYCLE`` and ``UNICYCLE``.  Sink blocks
+        are not run, use ``watch`` to record signals.  Source blocks are the
+        same for every simulation, so their parameters cannot be varied.
+
+        Results are returned in a class with attributes:
+
+        - ``t`` the time vector: ndarray, shape=(M,)
+        - ``x`` is the state of every simulation: ndarray, shape=(M,N,nstates)
+        - ``xnames`` is a list of the names of the states
+        - ``uK`` for a watched input where K is the index of the port mentioned
+          in the ``watch`` argument: ndarray, shape=(M,N,...), or shape=(M,...)
+          if the signal is the same for every simulation
+        - ``unames`` is a list of the names of the input ports being watched
+
+        .. note:: The integrator chooses a single sequence of time steps for
+            the whole ensemble.
+        """
+        assert self.compiled, 'Network has not been compiled'
+        if self.nstates == 0:
+            raise ValueError('ensemble simulation requires a diagram with states')
+
+        fused = [b for g in self._fused for b in g.members]
+
+        # determine the number of simulations
+        sizes = set()
+        values = {}
+        for key, value in params.items():
+            value = np.asarray(value)
+            b, attr = self._parameter(key)
+            if b in fused:
+                raise ValueError('block {:s} is fused, compile with fuse=False to vary its parameters'.format(str(b)))
+            if b.blockclass == 'source':
+                raise ValueError('block {:s} is a source, its parameters cannot vary within an ensemble'.format(str(b)))
+            values[b, attr] = value
+            sizes.add(value.shape[0])
+        if x0 is not None:
+            x0 = np.array(x0, dtype=float)
+            if x0.ndim != 2 or x0.shape[1] != self.nstates:
+                raise ValueError('x0 must have shape (N,{:d})'.format(self.nstates))
+            sizes.add(x0.shape[0])
+        if len(sizes) == 0:
+            raise ValueError('ensemble size is unknown, give x0 or params')
+        elif len(sizes) > 1:
+            raise ValueError('x0 and params must all describe the same number of simulations')
+        N = sizes.pop()
+        if x0 is None:
+            x0 = np.tile(self.getstate(), (N, 1))
+
+        self.T = T
+        self.stop = None
+        self.checkfinite = checkfinite
+        pluglist, plugnamelist, policies = self._watchlist(watch)
+        if any([policy is not None for policy in policies]):
+            raise ValueError('logging policies are only supported by run')
+        self._unprune(pluglist)
+
+        # after any pruned blocks that are watched have been restored
+        for b in self.schedule:
+            if not b.batchable:
+                raise ValueError('block {:s} does not support ensemble simulation'.format(str(b)))
+
+        saved = {}
+        store = self._store
+        try:
+            # the store holds one value per wire, so is not used
+            self._store = None
+
+            # substitute the parameter values for the ensemble
+            for (b, attr), value in values.items():
+                saved[b, attr] = getattr(b, attr)
+                setattr(b, attr, value)
+
+            # every state has a row per simulation, the blocks get views
+            # of their columns
+            self.x = np.zeros((N, self.nstates))
+            self.xd = np.zeros((N, self.nstates))
+            for b in self.transferblocks:
+                b._x = self.x[:, b._xslice]
+            self._bindderivs()
+            for b in self.schedule:
+                b.batched = True
+                b.start()
+            for b in fused:
+                b.batched = True
+            self._fold()
+
+            if self.options.progress:
+                printProgressBar(0, prefix='Progress:', suffix='complete', length=60)
+
+            shape = (N, self.nstates)
+            derivs = lambda y, t: self.evaluate(y.reshape(shape), t, outputs=False).ravel()
+
+            # the watched ports have a leading axis for the simulation, so
+            # their shapes are taken from their first values
+            recorder = bdsim.recorder.Recorder()
+            recorder.add('t', ())
+            recorder.add('x', shape)
+            for i in range(len(pluglist)):
+                recorder.add('u' + str(i))
+
+            # step the integrator, calls evaluate multiple times
+            for t, x, integrator, evaluated in self._integrate(solver, derivs, x0.ravel(), T, dt, **kwargs):
+
+                if integrator.status == 'failed':
+                    print('integration completed with failed status ')
+
+                # evaluate all blocks at the accepted step, for the watchlist
+                self.evaluate(x.reshape(shape), t)
+                if checkfinite:
+                    self._checkfinite(t)
+
+                # record the time, state and the ports on the watchlist
+                recorder.append(t, x.reshape(shape), *[p.block.inputs[p.port] for p in pluglist])
+
+                # update the progress bar
+                if self.options.progress:
+                    printProgressBar(t / T, prefix='Progress:', suffix='complete', length=60)
+
+            if self.options.progress:
+                print('\r' + ' '* 90 + '\r')
+
+        except RuntimeError as err:
+            # bad things happens, print a message and return no result
+            print('unrecoverable error in evaluation: ', err)
+            return None
+
+        finally:
+            # restore the diagram for a normal simulation
+            for (b, attr), value in saved.items():
+                setattr(b, attr, value)
+            for b in self.schedule + fused:
+                b.batched = False
+            self._allocate_state()
+            self._store = store
+            if store is not None:
+                self._bindstore()
+            self._fold()
+
+        # save the recorded data in a Struct
+        out = Struct('results')
+        out.update(recorder.arrays())
+        out.xnames = self.statenames
+        out.unames = plugnamelist
+
+        return out
+
+    def _integrate(self, solver, fun, x0, T, dt, events=False, **kwargs):
+        """
+        Integrate the state, restarting at breakpoints and events
+
+        :param solver: integration method
+        :type solver: str
+        :param fun: derivative function ``fun(x, t)``
+        :type fun: callable
+        :param x0: initial state
+        :type x0: ndarray(n)
+        :param T: final time
+        :type T: float
+        :param dt: maximum time step, or the time step of a fixed-step solver
+        :type dt: float
+        :param events: locate the events of the blocks, defaults to False
+        :type events: bool, optional
+        :param ``**kwargs``: passed to the integrator
+        :return: the time and state after every step, the integrator, and
+            whether the diagram has been evaluated at that time and state
+        :rtype: generator
+
+        Source blocks report the times at which their outputs are
+        discontinuous, and a new integrator is started at each of them, so
+        that no step straddles a discontinuity.  Each integration ends just
+        before the breakpoint, so its last step sees the source values from
+        before the discontinuity.
+
+        If ``events`` is True the event functions of the blocks are evaluated
+        after each step.  If any has become non-negative its time is found by
+        root finding on the integrator's dense output.  The step is discarded
+        and the state is integrated again up to that time, since the dense
+        output is not accurate across the event.  Once the event is at the
+        end of a step the ``event`` methods of the blocks are called, they
+        may change their state, and the integration restarts from there.
+        The time returned may then be earlier than the integrator's time.
+        When there are event functions the diagram has been evaluated at
+        each step returned, to find them, and need not be evaluated again
+        for the results of the step.
+        """
+        eventblocks = []
+        if events:
+            eventblocks = [b for b in self.blocklist
+                                if b in self._used and type(b).events is not Block.events]
+        if eventblocks:
+            self.evaluate(x0, 0.0)
+            eventblocks = [b for b in eventblocks if b.events() is not None]
+        if eventblocks:
+            g = self._events(eventblocks)
+            if np.any(g >= 0):
+                # events at the start
+                x0, g = self._event(eventblocks, np.full(g.shape, -1.0), x0, 0.0)
+
+        breaks = self._breakpoints(T) + [T]
+        t0 = 0.0
+        k = 0          # the next breakpoint
+        tevent = None  # time of an event being integrated up to
+        while k < len(breaks):
+            t_bound = np.nextafter(breaks[k], -np.inf) if breaks[k] < T else T
+            if tevent is not None:
+                t_bound = tevent
+            elif t_bound <= t0:
+                k += 1
+                continue
+            integrator = bdsim.solvers.integrator(solver, fun, t0=t0, y0=x0,
+                                                  t_bound=t_bound, dt=dt, **kwargs)
+            while integrator.status == 'running':
+                integrator.step()
+                t, x = integrator.t, integrator.y
+                if eventblocks and integrator.status != 'failed':
+                    self.evaluate(x, t)
+                    gnew = self._events(eventblocks)
+                    if np.any((g < 0) & (gnew >= 0)):
+                        te = self._locate(eventblocks, g, integrator)
+                        if integrator.t_old < te < t - 1e-10 * max(1.0, abs(t)):
+                            # integrate again up to the event
+                            t0 = integrator.t_old
+                            x0 = integrator.dense_output()(t0)
+                            tevent = te
+                            break
+                        if te < t:
+                            x = integrator.dense_output()(te)
+                            t = te
+                        x, g = self._event(eventblocks, g, x, t)
+                        yield t, x, integrator, True
+                        t0, x0, tevent = t, x, None
+                        break
+                    g = gnew
+                    yield t, x, integrator, True
+                else:
+                    yield t, x, integrator, False
+                if integrator.status == 'failed':
+                    return
+            else:
+                t0, x0 = t, x
+                if tevent is None:
+                    # the integration reached the breakpoint
+                    t0 = breaks[k]
+                    k += 1
+                tevent = None
+
+    def _events(self, eventblocks):
+        # the values of the event functions of the blocks
+        return np.concatenate([np.ravel(b.events()) for b in eventblocks])
+
+    def _locate(self, eventblocks, g, integrator):
+        """
+        Find the time of the first event within the last step
+
+        :param eventblocks: blocks with event functions
+        :type eventblocks: list of Block
+        :param g: values of the event functions at the start of the step
+        :type g: ndarray(m)
+        :param integrator: integrator that took the step
+        :type integrator: OdeSolver
+        :return: time of the first event
+        :rtype: float
+
+        The time of each event is found using Brent's method on the dense
+        output of the step.  The time returned is the earliest at which an
+        event function is non-negative, to within the root tolerance.
+        """
+        interpolant = integrator.dense_output()
+        ta, te = integrator.t_old, integrator.t
+        xtol = 1e-12 * max(1.0, abs(te))
+
+        def events(t):
+            self.evaluate(interpolant(t), t)
+            return self._events(eventblocks)
+
+        for i in np.flatnonzero((g < 0) & (events(te) >= 0)):
+            f = lambda t: events(t)[i]
+            if f(ta) >= 0:
+                # a source changed at the start of the step
+                return ta
+            elif f(te) < 0:
+                # after an earlier event
+                continue
+            t = scipy.optimize.brentq(f, ta, te, xtol=xtol)
+            # the event function must be non-negative at the event
+            while f(t) < 0:
+                t = min(t + xtol, te)
+            te = t
+        return te
+
+    def _event(self, eventblocks, g, x, t):
+        """
+        Handle the events at a time
+
+        :param eventblocks: blocks with event functions
+        :type eventblocks: list of Block
+        :param g: values of the event functions before the events
+        :type g: ndarray(m)
+        :param x: state
+        :type x: ndarray(n)
+        :param t: time
+        :type t: float
+        :return: state and values of the event functions after the events
+        :rtype: ndarray(n), ndarray(m)
+
+        The ``event`` method of each block is called for each of its event
+        functions that has become non-negative.
+        """
+        self.evaluate(x, t)
+        i = 0
+        for b in eventblocks:
+            gb = np.ravel(b.events())
+            n = len(gb)
+            for j in np.flatnonzero((g[i:i + n] < 0) & (gb >= 0)):
+                b.event(j, t)
+            i += n
+
+        # blocks may have changed their state
+        x = self.x.copy()
+        self.evaluate(x, t)
+        return x, self._events(eventblocks)
+
+    def _breakpoints(self, T):
+        # sorted times in (0, T) at which the outputs of source blocks are
+        # discontinuous, a block that is a source but not a SourceBlock,
+        # such as INTERPOLATE(time=True), may not have breakpoints
+        times = set()
+        for b in self.schedule:
+            breakpoints = getattr(b, 'breakpoints', None)
+            if b.blockclass == 'source' and breakpoints is not None:
+                times.update(float(t) for t in breakpoints(T) if 0 < t < T)
+        return sorted(times)
+
+    def _jacobian(self):
+        """
+        Jacobian of the state derivative and its sparsity pattern
+
+        :return: Jacobian, or None, and sparsity pattern
+        :rtype: scipy.sparse.csr_matrix, scipy.sparse.csr_matrix
+
+        The sparsity pattern follows from the wiring of the diagram: the
+        derivative of the states of a transfer block depends only on its own
+        states, and on the states of the transfer blocks that drive its
+        inputs, directly or through function blocks.
+
+        If every transfer block has a ``jacobian``, and every function block
+        between them has a ``jacobian`` or is a linear ``SUM``, ``MUX`` or
+        ``DEMUX``, the Jacobian is found by chaining their Jacobians along
+        the wires, and it is constant.  Otherwise it is None, and an implicit
+        solver must estimate it by finite differences, which the sparsity
+        pattern makes much cheaper for a large diagram.
+        """
+        n = self.nstates
+
+        def drivers(b):
+            # the transfer blocks that drive the inputs of b
+            found = set()
+            seen = set()
+            stack = [w.start.block for w in b.inports if w is not None]
+            while stack:
+                d = stack.pop()
+                if d not in seen:
+                    seen.add(d)
+                    if d.blockclass == 'transfer':
+                        found.add(d)
+                    elif d.blockclass != 'source':
+                        stack.extend([w.start.block for w in d.inports if w is not None])
+            return found
+
+        S = scipy.sparse.lil_matrix((n, n))
+        for b in self.transferblocks:
+            for d in drivers(b) | {b}:
+                S[b._xslice, d._xslice] = 1
+        sparsity = S.tocsr()
+
+        def place(M, b):
+            # the matrix M with columns for the states of b, as columns of
+            # the whole state
+            P = scipy.sparse.lil_matrix((M.shape[0], n))
+            P[:, b._xslice] = M
+            return P.tocsr()
+
+        # the value on every output port, as a matrix that maps the state to
+        # the flattened value, None if it is not known
+        value = {}
+
+        def inputs(b):
+            # matrices that map the state to the flattened inputs of block b
+            U = [value.get((w.start.block, w.start.port)) for w in b.inports]
+            return None if any([u is None for u in U]) else U
+
+        jacobians = {}
+        for b in self.blocklist:
+            if b.blockclass == 'source':
+                for p, wires in enumerate(b.outports):
+                    if len(wires) > 0 and wires[0].shape is not None:
+                        size = int(np.prod(wires[0].shape))
+                        value[b, p] = scipy.sparse.csr_matrix((size, n))
+            elif b.blockclass == 'transfer':
+                jacobians[b] = b.jacobian()
+                if jacobians[b] is not None:
+                    for p, C in enumerate(jacobians[b][2]):
+                        value[b, p] = place(np.atleast_2d(C), b)
+
+        # the function blocks in schedule order, blocks in an algebraic loop
+        # have no Jacobian
+        order = []
+        for b in self._fullschedule:
+            if b.type == 'fusedlinear':
+                order.extend(b.members)
+            elif b.type != 'algebraicloop':
+                order.append(b)
+
+        for b in order:
+            if b.blockclass != 'function':
+                continue
+            U = inputs(b)
+            if U is None:
+                continue
+            jac = b.jacobian()
+            if jac is not None:
+                D = np.block(jac)
+                sizes = [Dp[0].shape[0] for Dp in jac]
+            elif b.type in ('sum', 'mux', 'demux') and not (b.type == 'sum' and b.angles):
+                linear = FusedLinear._linearmap(b, [w.shape for w in b.inports])
+                if linear is None:
+                    continue
+                D, outshapes = linear
+                sizes = [int(np.prod(s)) for s in outshapes]
+            else:
+                continue
+            U = scipy.sparse.vstack(U)
+            if D.shape[1] != U.shape[0]:
+                continue
+            M = scipy.sparse.csr_matrix(D) @ U
+            row = 0
+            for p, m in enumerate(sizes):
+                value[b, p] = M[row:row + m, :]
+                row += m
+
+        rows = []
+        for b in self.transferblocks:
+            U = inputs(b)
+            if jacobians[b] is None or U is None:
+                return None, sparsity
+            A, B, C = jacobians[b]
+            J = place(A, b)
+            for Bi, Ui in zip(B, U):
+                if Bi.shape[1] != Ui.shape[0]:
+                    return None, sparsity
+                J = J + scipy.sparse.csr_matrix(Bi) @ Ui
+            rows.append(J)
+        return scipy.sparse.vstack(rows).tocsr(), sparsity
+
+    def _watchlist(self, watch):
+        # convert a watch list to a list of plugs, their names and their
+        # logging policies
         pluglist = []
         plugnamelist = []
-        re_block = re.compile(r'(?P<name>[^[]+)(\[(?P<port>[0-9]+)\])')
+        policies = []
+        re_block = re.compile(r'(?P<name>[^[]+)(\[(?P<port>[0-9]+)\])?$')
         for n in watch:
+            policy = None
+            if isinstance(n, tuple):
+                # a port and its logging policy
+                n, options = n
+                unknown = set(options) - {'every', 'period', 'change'}
+                if len(unknown) > 0:
+                    raise ValueError('unknown logging policy: ' + ', '.join(sorted(unknown)))
+                policy = bdsim.recorder.LogPolicy(**options)
             if isinstance(n, str):
                 # a name was given, with optional port number
                 m = re_block.match(n)
                 name = m.group('name')
                 port = m.group('port')
                 b = self.blocknames[name]
-                plug = b[port]
+                plug = b[int(port) if port is not None else 0]
             elif isinstance(n, Block):
                 # a block was given, defaults to port 0
                 plug = n[0]
@@ -635,125 +1605,479 @@ class BlockDiagram:
                 plug = n
             pluglist.append(plug)
             plugnamelist.append(str(plug))
+            policies.append(policy)
+        return pluglist, plugnamelist, policies
 
-        try:        
-            # tell all blocks we're doing a.BlockDiagram
-            self.start()
-    
-            # get initial state from the stateful blocks
-            x0 = self.getstate()
-            if len(x0) > 0:
-                print('initial state x0 = ', x0)
-    
-            if self.options.progress:
-                printProgressBar(0, prefix='Progress:', suffix='complete', length=60)
+    def _parameter(self, key):
+        # convert "block.attribute" or (block, "attribute") to a block and
+        # attribute name
+        if isinstance(key, str):
+            name, attr = key.rsplit('.', 1)
+            block = name
+        else:
+            block, attr = key
+        if isinstance(block, str):
+            if block not in self.blocknames:
+                raise ValueError('unknown block: ' + block)
+            block = self.blocknames[block]
+        if not hasattr(block, attr):
+            raise ValueError('block {:s} has no parameter {:s}'.format(str(block), attr))
+        return block, attr
 
-            # out = scipy.integrate.solve_ivp.BlockDiagram._deriv, args=(self,), t_span=(0,T), y0=x0, 
-            #             method=solver, t_eval=np.linspace(0, T, 100), events=None, **kwargs)
-            if len(x0) > 0:
-                # block diagram contains states, solve it using numerical integration
+    def _prune(self, keep=[]):
+        """
+        Remove unused blocks from the execution schedule
 
-                scipy_integrator = integrate.__dict__[solver]  # get user specified integrator
+        :param keep: blocks that must be evaluated, defaults to []
+        :type keep: list of Block, optional
 
-                integrator = scipy_integrator(lambda t, y: self.evaluate(y, t),
-                                              t0=0.0, y0=x0, t_bound=T, max_step=dt)
+        A block is used if it is in ``keep`` or it drives, directly or through
+        other blocks, a transfer block or a block with no outputs.  The
+        other blocks are removed from the execution schedule and listed in
+        ``pruned``.
 
-                # initialize list of time and states
-                tlist = []
-                xlist = []
-                plist = [[] for p in pluglist]
-                
-                while integrator.status == 'running':
+        The blocks that drive transfer blocks form the derivative schedule,
+        the part of the execution schedule that is needed to compute the
+        state derivative.
+        """
+        def ancestors(blocks):
+            # the blocks and all the blocks that drive them
+            found = set()
+            stack = list(blocks)
+            while stack:
+                b = stack.pop()
+                if b not in found:
+                    found.add(b)
+                    stack.extend([w.start.block for w in b.inports if w is not None])
+            return found
 
-                    # step the integrator, calls _deriv multiple times
-                    integrator.step()
+        def select(found):
+            # the scheduled blocks that were found, in schedule order
+            return [b for b in self._fullschedule if b in found or
+                        (b.type in ('algebraicloop', 'fusedlinear') and any([m in found for m in b.members]))]
 
-                    if integrator.status == 'failed':
-                        print('integration completed with failed status ')
+        derivs = ancestors([b for b in self.blocklist if b.blockclass == 'transfer'])
+        used = ancestors([b for b in self.blocklist if b.nout == 0] + list(keep)) | derivs
 
-                    # stash the results
-                    tlist.append(integrator.t)
-                    xlist.append(integrator.y)
-                    
-                    # record the ports on the watchlist
-                    for i, p in enumerate(pluglist):
-                        plist[i].append(p.block.inputs[p.port])
-                    
-                    # update all blocks that need to know
-                    self.step()
-                    
-                    # update the progress bar
-                    if self.options.progress:
-                        printProgressBar(integrator.t / T, prefix='Progress:', suffix='complete', length=60)
+        self.schedule = select(used)
+        self._derivschedule = select(derivs)
+        self.pruned = [b for b in self.blocklist if b not in used]
+        self._used = used
+        self._partition()
 
-                    # has any block called a stop?
-                    if self.stop is not None:
-                        print('\n--- stop requested at t={:f} by {:s}'.format(self.t, str(self.stop)))
-                        break
+    def _partition(self):
+        """
+        Partition the execution schedule by what the blocks depend on
 
-                # save buffered data in a Struct
-                out = Struct('results')
-                out.t = np.array(tlist)
-                out.x = np.array(xlist)
-                out.xnames = self.statenames
-                for i, p in enumerate(pluglist):
-                    out['u'+str(i)] = np.array(plist[i])
-                out.unames = plugnamelist
-            else:
-                # block diagram has no states
-                
-                # initialize list of time and states
-                tlist = []
-                plist = [[] for p in pluglist]
-                
-                for t in np.arange(0, T, dt):  # step through the time range
+        A constant block is a ``CONSTANT`` source, or a pure function block
+        driven only by constant blocks.  A time block is any other pure
+        source, or a pure function block driven only by constant and time
+        blocks.  A pure block has outputs that depend only on its inputs,
+        parameters and time, and declares this by setting ``pure``.  This
+        excludes ``FUNCTION`` blocks, which may do anything, and user defined
+        blocks that do not declare it, which are evaluated at every stage.
+
+        Constant blocks are evaluated by ``_fold`` rather than ``evaluate``,
+        and time blocks are evaluated once for each value of time.
+        """
+        constant = set()
+        timed = set()
+        for b in self.schedule:
+            if b.blockclass == 'source' and b.pure:
+                if b.type == 'constant':
+                    constant.add(b)
+                else:
+                    timed.add(b)
+            elif b.blockclass == 'function' and b.pure:
+                # a function block without inputs is a function of time
+                drivers = [w.start.block for w in b.inports]
+                if len(drivers) > 0 and all([d in constant for d in drivers]):
+                    constant.add(b)
+                elif all([d in constant or d in timed for d in drivers]):
+                    timed.add(b)
 
-                    # evaluate the block diagram
-                    self.evaluate([], t)
+        derivs = set(self._derivschedule)
+        self._folded = [b for b in self.schedule if b in constant]
+        self._timed = ([b for b in self._derivschedule if b in timed],
+                       [b for b in self.schedule if b in timed and b not in derivs])
+        self._untimed = ([b for b in self._derivschedule if b not in constant and b not in timed],
+                         [b for b in self.schedule if b not in constant and b not in timed])
+        self._tlast = [None, None]  # time at which the time blocks were evaluated
 
-                    # stash the results
-                    tlist.append(integrator.t)
-                    xlist.append(integrator.y)
-                    
-                    # record the ports on the watchlist
-                    for i, p in enumerate(pluglist):
-                        plist[i].append(p.block.inputs[p.port])
+    def _fold(self, t=0.0):
+        """
+        Evaluate the constant blocks
 
-                    # update all blocks that need to know
-                    self.step()
+        :param t: current time, defaults to 0.0
+        :type t: float, optional
 
-                    # update the progress bar
-                    if self.options.progress:
-                        printProgressBar(integrator.t / T, prefix='Progress:', suffix='complete', length=60)
-                        
-                    # has any block called a stop?
-                    if self.stop is not None:
-                        print('\n--- stop requested at t={:f} by {:s}'.format(self.t, str(self.stop)))
+        The outputs of constant blocks are computed once and remain on the
+        inputs that they drive.  This is done by ``compile`` and at the start
+        of every run, since parameters may have been changed.  The outputs of
+        time blocks are also recomputed at the next evaluation, and the
+        matrices of fused blocks are recomputed.
+        """
+        for g in self._fused:
+            g.build()
+        self._propagate(self._folded, t)
+        self._tlast[0] = self._tlast[1] = None
+
+    def _fuse(self, loops, keep):
+        """
+        Replace groups of linear blocks by fused blocks
+
+        :param loops: groups of blocks that contain algebraic loops to solve
+        :type loops: list of lists of Block
+        :param keep: blocks that must be evaluated
+        :type keep: list of Block
+        :return: some blocks were fused
+        :rtype: bool
+
+        The candidates are the ``GAIN``, ``SUM``, ``MUX``, ``DEMUX``,
+        ``LTI_SS`` and ``LTI_SISO`` blocks that are evaluated at every step,
+        rather than folded or cached, that are linear in their inputs, and
+        whose input and output values, when the diagram was compiled, were
+        real scalars or vectors.  Candidates connected by wires form a linear
+        subgraph.
+
+        The transfer blocks of a subgraph, with the function blocks driven only
+        by them, are fused into a block whose outputs depend only on its state.
+        The other function blocks of the subgraph are fused into blocks whose
+        outputs depend only on their inputs, one for each connected group.  A
+        group whose fused block would close a loop through blocks outside it
+        is not fused.  Groups of a single block are left alone.
+
+        The execution schedule is rebuilt with the fused blocks in place of
+        their members.
+        """
+        order = {b: i for i, b in enumerate(self.schedule)}
+
+        linear = set()
+        for b in self._untimed[1]:
+            if b.type in ('LTI', 'LTI SS'):
+                if all([np.size(u) == 1 for u in b.inputs]):
+                    linear.add(b)
+            elif b.type in ('gain', 'sum', 'mux', 'demux'):
+                if b.type == 'sum' and b.angles:
+                    continue
+                if FusedLinear._linearmap(b, [np.shape(u) for u in b.inputs]) is not None:
+                    linear.add(b)
+
+        def connected(blocks):
+            # groups of blocks connected by wires, in schedule order
+            parent = {b: b for b in blocks}
+            def find(b):
+                while parent[b] is not b:
+                    parent[b] = parent[parent[b]]
+                    b = parent[b]
+                return b
+            for b in blocks:
+                for w in b.inports:
+                    if w.start.block in parent:
+                        parent[find(w.start.block)] = find(b)
+            groups = {}
+            for b in sorted(blocks, key=order.get):
+                groups.setdefault(find(b), []).append(b)
+            return list(groups.values())
+
+        # blocks whose outputs depend only on the states of linear blocks
+        stateful = {b for b in linear if b.blockclass == 'transfer'}
+        for b in self.schedule:
+            if b in linear and b.blockclass == 'function' and \
+                    all([w.start.block in stateful for w in b.inports]):
+                stateful.add(b)
+
+        groups = []
+        for subgraph in connected(linear):
+            groups.append([b for b in subgraph if b in stateful])
+            groups.extend(connected([b for b in subgraph if b not in stateful]))
+        fused = [FusedLinear(members, bd=self) for members in groups if len(members) > 1]
+
+        # a fused block depends on all its inputs, discard those that close
+        # loops through other blocks
+        while True:
+            node = {b: g for g in fused for b in g.members}
+
+            def successors(b):
+                found = []
+                for m in b.members if b.type == 'fusedlinear' else [b]:
+                    for wires in m.outports:
+                        for w in wires:
+                            dest = w.end.block
+                            if dest.blockclass == 'function' and \
+                                    (m not in node or node.get(dest) is not node[m]):
+                                found.append(node.get(dest, dest))
+                return found
+
+            blocks = [b for b in self.blocklist if b not in node] + fused
+            cyclic = {b for component in self._find_loops(blocks, successors)
+                        for b in component if b.type == 'fusedlinear'}
+            if len(cyclic) == 0:
+                break
+            fused = [g for g in fused if g not in cyclic]
+
+        for i, g in enumerate(fused):
+            g.name = 'fused.{:d}'.format(i)
+            print('  fused linear blocks: ', ', '.join([str(b) for b in g.members]))
+        self._fused = fused
+        if len(fused) == 0:
+            return False
+
+        self._build_schedule(loops, fused)
+        self._prune(keep)
+        self._allocate_state()
+        return True
+
+    def _unprune(self, pluglist):
+        # restore pruned blocks needed to compute watched inputs, and
+        # evaluate the blocks within fused blocks that have watched inputs
+        self._published = [g for g in self._fused
+                                if any([p.block in g.members for p in pluglist])]
+        keep = [p.block.inports[p.port].start.block for p in pluglist]
+        if all([b in self._used for b in keep]):
+            return
+        self._prune(keep=keep)
+        if self._store is not None:
+            self._layout()
+        if self.code is not None:
+            # the code depends on the wire values
+            self.evaluate(self.getstate(), 0.0)
+            self._generate()
+
+    def _generate(self):
+        # generate and load Python code for the execution schedule
+        self.code, self._codeblocks = bdsim.codegen.generate(self)
+        self._codemaker = bdsim.codegen.load(self.code, self._codecache)
+
+    def _find_loops(self, blocks=None, successors=None):
+        """
+        Find algebraic loops
+
+        :param blocks: blocks to search, defaults to all blocks
+        :type blocks: list of Block, optional
+        :param successors: function that returns the function blocks driven
+            directly by a block, defaults to ``_loop_successors``
+        :type successors: callable, optional
+        :return: groups of blocks that contain algebraic loops
+        :rtype: list of lists of Block
+
+        An algebraic loop is a cycle of function blocks, whose outputs depend
+        directly on their inputs.  The strongly connected components of the
+        graph of function blocks are found in linear time using an iterative
+        version of Tarjan's algorithm.  Every component with more than one
+        block, or a single block wired to itself, contains at least one loop
+        and is returned.
+        """
+        if blocks is None:
+            blocks = self.blocklist
+        if successors is None:
+            successors = self._loop_successors
+
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        components = []
+
+        for root in blocks:
+            if root.blockclass != 'function' or root in index:
+                continue
+
+            # depth first search, work holds the blocks being visited and
+            # an iterator over their remaining successors
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(successors(root)))]
+            while work:
+                b, dests = work[-1]
+                for dest in dests:
+                    if dest not in index:
+                        # visit dest before continuing with b
+                        index[dest] = lowlink[dest] = len(index)
+                        stack.append(dest)
+                        onstack.add(dest)
+                        work.append((dest, iter(successors(dest))))
                         break
-                    
-                # save buffered data in a Struct
-                out = Struct('results')
-                out.t = np.array(tlist)
-                for i, p in enumerate(pluglist):
-                    out['u'+str(i)] = np.array(plist[i])
-                out.unames = plugnamelist
-                
-            if self.options.progress:
-                print('\r' + ' '* 90 + '\r')
-                
-        except RuntimeError as err:
-            # bad things happens, print a message and return no result
-            print('unrecoverable error in evaluation: ', err)
-            return None
+                    elif dest in onstack:
+                        lowlink[b] = min(lowlink[b], index[dest])
+                else:
+                    # all successors of b visited
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[b])
+                    if lowlink[b] == index[b]:
+                        # b is the root of a strongly connected component
+                        component = []
+                        while True:
+                            c = stack.pop()
+                            onstack.discard(c)
+                            component.append(c)
+                            if c is b:
+                                break
+                        component.reverse()
+                        if len(component) > 1 or b in successors(b):
+                            components.append(component)
 
-        # pause until all graphics blocks close
-        self.done(block=block)
-        # print(self.count, ' integrator steps')
-        
-        return out
-        
+        return components
+
+    @staticmethod
+    def _loop_successors(b):
+        # function blocks driven directly by block b
+        return [w.end.block for wires in b.outports for w in wires
+                    if w.end.block.blockclass == 'function']
+
+    def _loop_path(self, component):
+        """
+        Find a closed path through an algebraic loop
+
+        :param component: group of blocks returned by ``_find_loops``
+        :type component: list of Block
+        :return: closed path of blocks
+        :rtype: list of Block
+
+        The path starts and ends with the same block, for example
+        ``[sum.0, gain.0, sum.0]``.
+        """
+        successors = self._loop_successors
+        start = component[0]
+
+        # breadth first search within the component for a path back to
+        # the start
+        members = set(component)
+        parent = {}
+        frontier = [start]
+        while start not in parent:
+            following = []
+            for b in frontier:
+                for dest in successors(b):
+                    if dest in members and dest not in parent:
+                        parent[dest] = b
+                        following.append(dest)
+            frontier = following
+
+        loop = [start]
+        b = parent[start]
+        while b is not start:
+            loop.append(b)
+            b = parent[b]
+        loop.append(start)
+        return loop[::-1]
+
+    def _build_schedule(self, loops=[], fused=[]):
+        """
+        Build the static execution schedule
+
+        :param loops: groups of blocks that contain algebraic loops to solve
+        :type loops: list of lists of Block
+        :param fused: fused blocks that replace groups of linear blocks
+        :type fused: list of FusedLinear
+
+        The schedule is a flat list of blocks, in topological order, such that
+        every block appears after all the blocks that drive its inputs.  Source
+        and transfer blocks are ready at the start, since their outputs do not
+        depend on their inputs.  A function block becomes ready once all the
+        blocks driving it have been scheduled.
+
+        Each block is also given a fanout map, a list of tuples
+        ``(port, block, inport)`` that describes where the value on each of its
+        output ports must be copied to.
+
+        Each group of blocks in ``loops`` is scheduled as a single
+        ``AlgebraicLoop`` block, which is ready once all the blocks driving the
+        group from outside have been scheduled.
+
+        Each block in ``fused`` takes the place of its members, and wires into
+        the group are redirected to its input ports.
+
+        Sink blocks are not scheduled since they have no outputs, and function
+        blocks that are part of an unsolved loop are never ready so are left
+        out.
+        """
+        node = {b: g for g in fused for b in g.members}
+        pending = {}
+        ready = []
+        for b in self.blocklist + fused:
+            b.inputs = [None] * b.nin
+            b._fanout = [(port, w.end.block, w.end.port)
+                            for port, wires in enumerate(b.outports) for w in wires]
+            if b in node:
+                continue
+            if b.blockclass in ('source', 'transfer'):
+                ready.append(b)
+            elif b.blockclass == 'function':
+                pending[b] = b.nin
+
+        # redirect wires into fused groups to the fused block
+        if len(fused) > 0:
+            for b in self.blocklist + fused:
+                fanout = []
+                for port, dest, inport in b._fanout:
+                    g = node.get(dest)
+                    if g is not None and g is not node.get(b):
+                        dest, inport = g, g._inmap[dest, inport]
+                    fanout.append((port, dest, inport))
+                b._fanout = fanout
+
+        # replace the blocks of each loop by a block that solves it
+        solver = {}
+        for i, members in enumerate(loops):
+            loop = AlgebraicLoop(members, name='algebraicloop.{:d}'.format(i), bd=self)
+            for b in members:
+                del pending[b]
+                solver[b] = loop
+            pending[loop] = loop.nexternal
+            if loop.nexternal == 0:
+                ready.append(loop)
+
+        # Kahn's algorithm, ready grows as we iterate over it
+        for b in ready:
+            for port, dest, inport in b._fanout:
+                dest = solver.get(dest, dest)
+                if dest in pending:
+                    pending[dest] -= 1
+                    if pending[dest] == 0:
+                        ready.append(dest)
 
-    def evaluate(self, x, t):
+        self.schedule = ready
+        self._fullschedule = ready
+        self.transferblocks = [b for b in self.blocklist if b.blockclass == 'transfer']
+        self._derivblocks = [b for b in self.schedule if b.blockclass == 'transfer']
+
+    def _allocate_state(self):
+        """
+        Allocate the state and state derivative vectors
+
+        Every stateful block is assigned a fixed slice of the state vector
+        ``x`` and the derivative vector ``xd``.  The block's state ``_x``
+        is a view of its slice of ``x`` so no copying is required when the
+        integrator updates the state, and the result of its ``deriv``
+        method is written directly into its slice of ``xd``.
+        """
+        self.x = np.zeros((self.nstates,))
+        self.xd = np.zeros((self.nstates,))
+
+        offset = 0
+        for b in self.transferblocks:
+            b._xslice = slice(offset, offset + b.nstates)
+            b._x = self.x[b._xslice]
+            offset += b.nstates
+        self._bindderivs()
+
+    def _bindderivs(self):
+        """
+        Find where the derivative of each block is written
+
+        The derivative of a block is written to a view of its slice of
+        ``xd``, made once rather than by indexing ``xd`` at every
+        evaluation.  A fused block whose states are not contiguous, whose
+        slice is an index array, has no view.
+        """
+        self._derivviews = [(b, self.xd[..., b._xslice] if isinstance(b._xslice, slice) else None)
+                                for b in self._derivblocks]
+
+    def evaluate(self, x, t, outputs=True):
         """
         Evaluate all blocks in the network
         
@@ -761,100 +2085,343 @@ class BlockDiagram:
         :type x: numpy.ndarray
         :param t: current time
         :type t: float
+        :param outputs: evaluate blocks that only drive sinks, defaults to True
+        :type outputs: bool, optional
         :return: state derivative
         :rtype: numpy.ndarray
         
         Performs the following steps:
             
-        1. Partition the state vector to all stateful blocks
-        2. Propogate known block output ports to connected input ports
+        1. Copy the state into the state vector, every stateful block has a
+           view of its slice of it
+        2. Evaluate every block in the execution schedule, copying its output
+           port values to all connected input ports
+        3. Write the state derivative of every stateful block into its slice
+           of the derivative vector
+
+        The execution schedule is computed by ``compile``.  If ``outputs`` is
+        False only the derivative schedule is evaluated, the blocks needed to
+        compute the state derivative.  This is used for the intermediate
+        stages of the integrator, and all blocks are evaluated once each step
+        is accepted.
+
+        Constant blocks are not evaluated, see ``_fold``, and blocks that
+        depend only on time are not evaluated again if ``t`` is unchanged.
 
+        Other than the values computed by the blocks, nothing is allocated:
+        the state and derivative vectors, the views of them, the schedules
+        and the fanout lists are all created by ``compile``.  This keeps the
+        garbage collector quiet during long runs.  It is not true when block
+        checks are enabled by the 'c' debug flag.
 
+        .. note:: The returned derivative is the preallocated vector ``xd``,
+            it is overwritten by the next call, so copy it if it needs to be kept.
         """
         #print('in evaluate at t=', t)
         self.t = t
         DEBUG('state', '>>>>>>>>> t=', t, ', x=', x, '>>>>>>>>>>>>>>>>')
         
-        # reset all the blocks ready for the evalation
-        self.reset()
-        
-        # split the state vector to stateful blocks
-        for b in self.blocklist:
-            if b.blockclass == 'transfer':
-                x = b.setstate(x)
-        
-        # process blocks with initial outputs and propagate
-        for b in self.blocklist:
-            if b.blockclass in ('source', 'transfer'):
-                self._propagate(b, t)
-                
-        # check we have values for all
-        for b in self.blocklist:
-            if b.nin > 0 and not b.done:
-                raise RuntimeError(str(b) + ' has incomplete inputs')
-            
+        # load the state vector, stateful blocks see this through their views
+        self.x[...] = x
+
+        # evaluate blocks in topological order and copy outputs to inputs,
+        # blocks that depend only on time are evaluated once for each value
+        # of time
+        if t != self._tlast[0]:
+            self._tlast[0] = t
+            self._propagate(self._timed[0], t)
+        if outputs:
+            if t != self._tlast[1]:
+                self._tlast[1] = t
+                self._propagate(self._timed[1], t)
+            self._propagate(self._untimed[1], t)
+            for g in self._published:
+                g.publish(t)
+        else:
+            self._propagate(self._untimed[0], t)
+
         # gather the derivative
-        YD = np.array([])
-        for b in self.blocklist:
-            if b.blockclass == 'transfer':
-                assert b.updated, str(b) + ' has incomplete inputs'
-                yd = b.deriv().flatten()
-                YD = np.r_[YD, yd]
-        DEBUG('deriv', YD)
-        return YD
+        if self._checks:
+            for b in self._derivblocks:
+                try:
+                    b.check_inputs()
+                except Exception as err:
+                    print('--Error at t={:f} when checking inputs of block {:s}'.format(t, str(b)))
+                    print('  {}'.format(err))
+                    print('  inputs were: ', b.inputs)
+                    raise RuntimeError from None
+        for b, xd in self._derivviews:
+            if xd is None:
+                self.xd[..., b._xslice] = b.deriv()
+            else:
+                xd[...] = b.deriv()
+        DEBUG('deriv', self.xd)
+        return self.xd
 
-    def _propagate(self, b, t, depth=0):
+    def _propagate(self, blocks, t):
         """
-        Propagate values of a block to all connected inputs.
-        
-        :param b: Block with valid output
-        :type b: Block
+        Evaluate blocks and copy their outputs to the inputs they drive
+
+        :param blocks: blocks in topological order
+        :type blocks: list of Block
         :param t: current time
         :type t: float
 
-        When all inputs to a block are available, its output can be computed
-        using its `output` method (which may also be a function of time).
-        
-        This value is presented to each connected input port via its
-        `setinput` method.  That method returns True if the block now has
-        all its inputs defined, in which case we recurse.
+        If checks are enabled the inputs of each block are checked before it
+        is evaluated, and its outputs after, see ``_check``.
 
+        If the signal store is in use output values are copied into it, see
+        ``_layout``.
         """
-        
-        # check for a subsystem block here, recurse to evalute it
-        # execute the subsystem to obtain its outputs
+        checks = self._checks
+        store = self._store
+        debug = 'propagate' in debuglist
+        for b in blocks:
+            # get output of block at time t
+            try:
+                if checks:
+                    b.check_inputs()
+                out = b.output(t)
+            except Exception as err:
+                print('--Error at t={:f} when computing output of block {:s}'.format(t, str(b)))
+                print('  {}'.format(err))
+                print('  inputs were: ', b.inputs)
+                if b.nstates > 0:
+                    print('  state was: ', b._x)
+                raise RuntimeError from None
 
-        # get output of block at time t
-        try:
-            out = b.output(t)
-        except Exception as err:
-            print('--Error at t={:f} when computing output of block {:s}'.format(t, str(b)))
-            print('  {}'.format(err))
-            print('  inputs were: ', b.inputs)
-            if b.nstates > 0:
-                print('  state was: ', b.x)
-            raise RuntimeError from None
+            if debug:
+                DEBUG('propagate', 'evaluating: {:s} @ t={:.3f}: output = '.format(str(b),t) + str(out))
 
-            
-        DEBUG('propagate', '  '*depth, 'propagating: {:s} @ t={:.3f}: output = '.format(str(b),t) + str(out))
+            if checks:
+                self._check(b, out)
 
-        # check for validity
-        assert isinstance(out, list) and len(out) == b.nout, 'block output is wrong type/length'
-        # TODO check output validity once at the start
-        
-        # check it has no nan or inf values
-        if self.checkfinite and isinstance(out, (int, float, np.ndarray)) and not np.isfinite(out).any():
-            raise RuntimeError('block outputs nan')
-        
-        # propagate block outputs to all downstream connected blocks
-        for (port, outwires) in enumerate(b.outports): # every port
-            val = out[port]
-            for w in outwires:     # every wire
-                
-                DEBUG('propagate', '  '*depth, '[', port, '] = ', val, ' --> ', w.end.block.name, '[', w.end.port, ']')
-                
-                if w.send(val) and w.end.block.blockclass == 'function':
-                    self._propagate(w.end.block, t, depth+1)
+            if store is None:
+                for port, dest, inport in b._fanout:
+                    dest.inputs[inport] = out[port]
+            else:
+                # copy values into the store, array inputs are views of it
+                for port, k in b._scalarslots:
+                    store[k] = out[port]
+                for port, view in b._arrayslots:
+                    view[...] = out[port]
+                for port, dest, inport in b._objfanout:
+                    value = out[port]
+                    if type(value) is np.ndarray and value.base is store:
+                        value = value.copy()  # block passed on an input
+                    dest.inputs[inport] = value
+
+    def _check(self, b, out):
+        """
+        Check the output of a block
+
+        :param b: block that was evaluated
+        :type b: Block
+        :param out: output port values of the block
+        :type out: list
+        :raises RuntimeError: output is not valid
+
+        The output must be a list with a value for every port.  Once the wire
+        types have been recorded by ``compile`` a numeric value on a port must
+        have the recorded shape, any other value the recorded type, and if ``checkfinite`` is set a
+        numeric value must not contain inf or nan.
+        """
+        if not isinstance(out, list) or len(out) != b.nout:
+            raise RuntimeError('block {:s} output is wrong type/length'.format(str(b)))
+
+        for port, wires in enumerate(b.outports):
+            if len(wires) == 0 or wires[0].shape is None:
+                continue  # not recorded
+            w = wires[0]
+            value = out[port]
+            if w.dtype is None:
+                # not numeric, check the type
+                ok = isinstance(value, w.type)
+            elif b.batched:
+                # first dimension is the ensemble
+                ok = np.shape(value)[1:] == w.shape
+            else:
+                ok = np.shape(value) == w.shape
+            if not ok:
+                raise RuntimeError('block {:s} output {:d} is {:s} {:s}, expecting {:s} {:s}'.format(
+                    str(b), port, type(value).__name__, str(np.shape(value)), w.type.__name__, str(w.shape)))
+            if self.checkfinite and w.dtype is not None and w.dtype.kind in 'fc' \
+                    and not np.all(np.isfinite(value)):
+                raise RuntimeError('block {:s} output {:d} is not finite'.format(str(b), port))
+
+    def _record(self):
+        """
+        Record the type of the value on every wire
+
+        The type, dtype and shape of the value that each scheduled block
+        outputs is stored in every wire from that port, along with the value
+        itself.  The dtype is None if the value is not numeric.
+
+        The output ports of scheduled blocks with floating point or complex
+        values are listed, in schedule order, for ``_checkfinite``, along with
+        an input where the value can be read at run time.  The inputs of
+        blocks in a fused group are not updated by ``evaluate``, so the value
+        on a wire entering a group is read from the input of the fused block,
+        and a wire within a group is checked only if its port also drives a
+        block outside the group.
+        """
+        group = {m: g for g in self._fused for m in g.members}
+
+        def live(w):
+            # the block and input port that hold the value on wire w
+            g = group.get(w.end.block)
+            if g is None:
+                return w.end.block, w.end.port
+            elif group.get(w.start.block) is not g:
+                return g, g._inmap[w.end.block, w.end.port]
+            else:
+                return None
+
+        position = {}
+        for i, b in enumerate(self.schedule):
+            if b.type in ('algebraicloop', 'fusedlinear'):
+                for m in b.members:
+                    position[m] = i
+            else:
+                position[b] = i
+
+        numeric = []
+        for b in self.blocklist:
+            for wires in b.outports:
+                values = [w.end.block.inputs[w.end.port] for w in wires
+                            if w.end.block.inputs is not None]
+                values = [v for v in values if v is not None]
+                if len(values) == 0:
+                    continue  # block is not scheduled
+                value = values[0]
+                if isinstance(value, (numbers.Number, np.ndarray)):
+                    dtype = np.asarray(value).dtype
+                else:
+                    dtype = None
+                for w in wires:
+                    w.value = value
+                    w.type = type(value)
+                    w.dtype = dtype
+                    w.shape = np.shape(value)
+                if b in position and dtype is not None and dtype.kind in 'fc':
+                    # the value is read from an input that the port drives
+                    for w in wires:
+                        dest = live(w)
+                        if dest is not None and dest[0].inputs[dest[1]] is not None:
+                            numeric.append((position[b], w, dest))
+                            break
+
+        numeric.sort(key=lambda n: n[0])
+        self._scalarwires = [dest for i, w, dest in numeric if w.shape == ()]
+        self._arraywires = [dest for i, w, dest in numeric if w.shape != ()]
+        self._numericwires = [(w, dest) for i, w, dest in numeric]
+
+    def _layout(self):
+        """
+        Allocate the signal store
+
+        Every output port of a scheduled block whose value, when the diagram
+        was compiled, was a float64 scalar or array is given a slice of a
+        single float64 vector, the store.  ``_propagate`` copies each output
+        value into its slice, so the store always holds the values on those
+        wires and can be checked, copied or logged as one array.
+
+        Inputs of function and transfer blocks that are driven by an array
+        port are bound to a view of its slice by ``_bindstore``, so their
+        values no longer need to be sent to them.  Scalar values, values of
+        other types, and values sent to sinks, which may keep them, are sent
+        to the inputs as before.
+        """
+        size = 0
+        offset = {}
+        self._storeinputs = []
+        for b in self.schedule:
+            b._scalarslots = []
+            b._arrayslots = []
+            b._objfanout = []
+            for port, dest, inport in b._fanout:
+                w = dest.inports[inport]
+                if w.dtype != np.float64:
+                    b._objfanout.append((port, dest, inport))
+                    continue
+                if (b, port) not in offset:
+                    offset[b, port] = size
+                    if w.shape == ():
+                        b._scalarslots.append((port, size))
+                        size += 1
+                    else:
+                        b._arrayslots.append((port, w.shape))
+                        size += int(np.prod(w.shape))
+                if w.shape != () and dest.blockclass in ('function', 'transfer'):
+                    self._storeinputs.append((dest, inport, (b, port)))
+                else:
+                    b._objfanout.append((port, dest, inport))
+
+        self._store = np.zeros((size,))
+
+        def view(b, port, shape):
+            start = offset[b, port]
+            return self._store[start:start + int(np.prod(shape))].reshape(shape)
+
+        for b in self.schedule:
+            b._arrayslots = [(port, view(b, port, shape)) for port, shape in b._arrayslots]
+        self._storeinputs = [(dest, inport, view(b, port, dest.inports[inport].shape))
+                                for dest, inport, (b, port) in self._storeinputs]
+
+        # numeric wires that are not in the store, for _checkfinite
+        unstored = [(w, dest) for w, dest in self._numericwires if w.dtype != np.float64]
+        self._unstored = ([dest for w, dest in unstored if w.shape == ()],
+                          [dest for w, dest in unstored if w.shape != ()])
+
+    def _bindstore(self):
+        """
+        Bind block inputs to their views of the signal store
+
+        This is done when the store is allocated and at the start of every
+        run, since blocks may recreate their input lists when started.
+        """
+        for dest, inport, view in self._storeinputs:
+            dest.inputs[inport] = view
+
+    def _checkfinite(self, t):
+        """
+        Check that the values on all wires are finite
+
+        :param t: current time
+        :type t: float
+        :raises RuntimeError: a wire has an inf or nan value
+
+        The values of all floating point and complex wires, see ``_record``,
+        are gathered into arrays, or are already in the signal store, and are
+        checked at once.  This is cheap
+        enough to do at every accepted step.  If a value is not finite the
+        wires are searched in schedule order for the first one at fault.
+        """
+        if self._store is None:
+            scalarwires, arraywires = self._scalarwires, self._arraywires
+            stored = True
+        else:
+            # most values are in the store
+            scalarwires, arraywires = self._unstored
+            stored = np.isfinite(self._store).all()
+
+        if self.x.ndim > 1:
+            # in an ensemble some scalar wires have a value per simulation
+            arraywires = scalarwires + arraywires
+            scalarwires = []
+
+        scalars = [b.inputs[port] for b, port in scalarwires]
+        if len(arraywires) > 0:
+            arrays = np.concatenate([np.ravel(b.inputs[port]) for b, port in arraywires])
+        else:
+            arrays = []
+        if stored and np.isfinite(scalars).all() and np.isfinite(arrays).all():
+            return
+
+        for w, (b, port) in self._numericwires:
+            if not np.all(np.isfinite(b.inputs[port])):
+                raise RuntimeError('wire {:s} from block {:s} output {:d} is not finite at t={:f}'.format(
+                    w.fullname, str(w.start.block), w.start.port, t))
 
     def report(self):
         """
@@ -890,24 +2457,34 @@ class BlockDiagram:
             start = "{:d}[{:d}]".format(w.start.block.id, w.start.port)
             end = "{:d}[{:d}]".format(w.end.block.id, w.end.port)
             
-            value = w.end.block.inputs[w.end.port]
-            typ = type(value).__name__
-            if isinstance(value, np.ndarray):
-                typ += ' {:s}'.format(str(value.shape))
+            if w.type is None:
+                typ = ''  # not evaluated
+            else:
+                typ = w.type.__name__
+                if issubclass(w.type, np.ndarray):
+                    typ += ' {:s}'.format(str(w.shape))
             table.row( w.id, start, end, w.fullname, typ)
         table.print()
 
         print('\nState variables: {:d}'.format(self.nstates))
+
+        if len(self.pruned) > 0:
+            print('\nPruned blocks: {:d}'.format(len(self.pruned)))
+            print('  ' + ', '.join([str(b) for b in self.pruned]))
+
+        for g in self._fused:
+            print('\nFused linear block {:s}: {:d} inputs, {:d} outputs, {:d} states'.format(
+                    str(g), g.nin, g.nout, g.nstates))
+            print('  ' + ', '.join([str(b) for b in g.members]))
         
         if not self.compiled:
             print('** System has not been compiled, or had a compile time error')
             
     def getstate(self):
-        # get the state from each stateful block
-        x0 = np.array([])
-        for b in self.blocklist:
-            if b.blockclass == 'transfer':
-                x0 = np.r_[x0, b.getstate()]
+        # get the initial state from each stateful block
+        x0 = np.zeros((self.nstates,))
+        for b in self.transferblocks:
+            x0[b._xslice] = b.getstate()
         #print('x0', x0)
         return x0
                         
@@ -1016,6 +2593,24 @@ class BlockDiagram:
 
             file.write('}\n')
             
+    def dumpcode(self, file=None):
+        """
+        Display the generated code for the network.
+
+        :param file: Name of file to write to, defaults to None
+        :type file: str, optional
+
+        The code generated by ``compile(codegen=True)`` is printed, or written
+        to the specified file.
+        """
+        if self.code is None:
+            raise RuntimeError('no code has been generated, use compile(codegen=True)')
+        if file is None:
+            print(self.code)
+        else:
+            with open(file, 'w') as f:
+                f.write(self.code)
+
     def blockvalues(self):
         for b in self.blocklist:
             print('Block {:s}:'.format(b.name))
@@ -65,12 +65,15 @@ class Item(FunctionBlock):
 
         super().__init__(nin=1, nout=1, **kwargs)
         self.type = 'item'
+        self.pure = True
         self.item = item
     
-    def output(self, t=None):
-        # TODO, handle inputs that are vectors themselves
+    def check_inputs(self):
         assert isinstance(self.inputs[0], dict), 'Input signal must be a dict'
         assert self.item in self.inputs[0], 'Item is not in signal dict'
+
+    def output(self, t=None):
+        # TODO, handle inputs that are vectors themselves
         return [self.inputs[0][self.item]]
 
 # ------------------------------------------------------------------------ #
@@ -117,6 +120,7 @@ class Mux(FunctionBlock):
         """
         super().__init__(nin=nin, nout=1, inputs=inputs, **kwargs)
         self.type = 'mux'
+        self.pure = True
     
     def output(self, t=None):
         # TODO, handle inputs that are vectors themselves
@@ -161,10 +165,13 @@ class DeMux(FunctionBlock):
         """
         super().__init__(nin=1, nout=nout, inputs=inputs, **kwargs)
         self.type = 'demux'
+        self.pure = True
     
+    def check_inputs(self):
+        assert len(self.inputs[0]) == self.nout, 'Input width not equal to number of output ports'
+
     def output(self, t=None):
         # TODO, handle inputs that are vectors themselves
-        assert len(self.inputs[0]) == self.nout, 'Input width not equal to number of output ports'
         return list(self.inputs[0])
 
 # ------------------------------------------------------------------------ #
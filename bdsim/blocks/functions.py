@@ -66,6 +66,8 @@ class Sum(FunctionBlock):
         super().__init__(nin=len(signs), nout=1, inputs=inputs, **kwargs)
         assert isinstance(signs, str), 'first argument must be signs string'
         self.type = 'sum'
+        self.pure = True
+        self.batchable = True
         assert all([x in '+-' for x in signs]), 'invalid sign'
         self.signs = signs
         self.angles = angles
@@ -131,6 +133,8 @@ class Prod(FunctionBlock):
         super().__init__(nin=len(ops),nout=1, inputs=inputs, **kwargs)
         assert isinstance(ops, str), 'first argument must be signs string'
         self.type = 'prod'
+        self.pure = True
+        self.batchable = True
         assert all([x in '*/' for x in ops]), 'invalid op'
         self.ops = ops
         self.matrix = matrix
@@ -142,19 +146,21 @@ class Prod(FunctionBlock):
                     prod = input
                 else:
                     if self.matrix:
-                        prod = numpy.linalg.inv(input)
-                    prod = 1.0 / input
+                        prod = np.linalg.inv(input)
+                    else:
+                        prod = 1.0 / input
             else:
+                # not in-place, the first input may be broadcast against the others
                 if self.ops[i] == '*':
                     if self.matrix:
                         prod = prod @ input
                     else:
-                        prod *= input
+                        prod = prod * input
                 else:
                     if self.matrix:
-                        prod = prod @ numpy.linalg.inv(input)
+                        prod = prod @ np.linalg.inv(input)
                     else:
-                        prod /= input
+                        prod = prod / input
 
         return [prod]
 
@@ -200,16 +206,37 @@ class Gain(FunctionBlock):
         compute the appropriate product.  If both are numpy arrays then the
         matmult operator `@` is used and by default the input is postmultiplied
         by the gain, but this can be changed using the ``premul`` option.
+
+        In an ensemble simulation the leading axis of the input is the
+        simulation index.  A matrix gain, or an array of matrix gains, one per
+        simulation, multiplies each input vector, otherwise the gain is applied
+        elementwise.
         """
         super().__init__(nin=1, nout=1, inputs=inputs, **kwargs)
         self.gain  = gain
         self.type = 'gain'
+        self.pure = True
         self.premul = premul
+        self.batchable = True
         
     def output(self, t=None):
         input = self.inputs[0]
         
-        if isinstance(input, np.ndarray) and isinstance(self.gain, np.ndarray):
+        if self.batched and isinstance(self.gain, np.ndarray) and self.gain.ndim > 1:
+            # ensemble of input vectors, one per row
+            if self.gain.ndim == 2:
+                # same gain matrix for every simulation
+                if self.premul:
+                    return [input @ self.gain.T]
+                else:
+                    return [input @ self.gain]
+            else:
+                # a gain matrix per simulation
+                if self.premul:
+                    return [(self.gain @ input[..., np.newaxis])[..., 0]]
+                else:
+                    return [(input[..., np.newaxis, :] @ self.gain)[..., 0, :]]
+        elif isinstance(input, np.ndarray) and isinstance(self.gain, np.ndarray) and not self.batched:
             # array x array case
             if self.premul:
                 # premultiply by gain
@@ -219,6 +246,25 @@ class Gain(FunctionBlock):
                 return [input @ self.gain]
         else:
             return [self.inputs[0] * self.gain]
+
+    def jacobian(self):
+        input = self.inputs[0]
+        gain = np.asarray(self.gain, dtype=float)
+        if np.ndim(input) > 1 or gain.ndim > 2:
+            return None
+        if isinstance(input, np.ndarray) and isinstance(self.gain, np.ndarray):
+            # matrix product, or dot product of vectors
+            if gain.ndim == 1:
+                return [[gain.reshape((1, -1))]]
+            return [[gain if self.premul else gain.T]]
+        elif np.ndim(input) == 0:
+            # scalar input scales every element of the gain
+            return [[gain.reshape((-1, 1))]]
+        elif gain.ndim == 0 or gain.shape == np.shape(input):
+            # elementwise product
+            return [[np.diag(np.broadcast_to(gain, np.shape(input)).ravel())]]
+        else:
+            return None
         
 # ------------------------------------------------------------------------ #
 
@@ -269,6 +315,8 @@ class Clip(FunctionBlock):
         self.min = min
         self.max = max
         self.type = 'clip'
+        self.pure = True
+        self.batchable = True
         
     def output(self, t=None):
         input = self.inputs[0]
@@ -364,6 +412,7 @@ class Function(FunctionBlock):
         super().__init__(nin=nin, nout=nout, inputs=inputs, **kwargs_)
         self.nin = nin
         self.type = 'function'
+        self.pure = False  # the function may have side effects
 
         if isinstance(func, (list, tuple)):
             for f in func:
@@ -479,6 +528,7 @@ class Interpolate(FunctionBlock):
         else:
             nin = 1
         super().__init__(nin=nin, nout=1, inputs=inputs, **kwargs)
+        self.pure = True
             
         if xy is None:
             # process separate x and y vectors
@@ -76,6 +76,7 @@ class Bicycle(TransferBlock):
         self.vlim = vlim
         self.slim = slim
         self.type = 'bicycle'
+        self.batchable = True
 
         self.L = L
         if x0 is None:
@@ -89,9 +90,17 @@ class Bicycle(TransferBlock):
         self.state_names(('x', 'y', r'$\theta$'))
         
     def output(self, t):
-        return list(self._x)
+        # in an ensemble simulation the state has a row per simulation
+        return list(self._x.T)
     
     def deriv(self):
+        if self.batched:
+            theta = self._x[:, 2]
+            v = np.clip(self.inputs[0], -self.vlim, self.vlim)
+            gamma = np.clip(self.inputs[1], -self.slim, self.slim)
+            xd = (v * np.cos(theta), v * np.sin(theta), v * np.tan(gamma) / self.L)
+            return np.stack(np.broadcast_arrays(*xd), axis=-1)
+
         theta = self._x[2]
         
         # get inputs and clip them
@@ -152,6 +161,7 @@ class Unicycle(TransferBlock):
         super().__init__(nin=2, nout=3, inputs=inputs, **kwargs)
         self.nstates = 3
         self.type = 'unicycle'
+        self.batchable = True
         
         if x0 is None:
             self._x0 = np.zeros((slef.nstates,))
@@ -160,9 +170,15 @@ class Unicycle(TransferBlock):
             self._x0 = x0
         
     def output(self, t):
-        return list(self._x)
+        # in an ensemble simulation the state has a row per simulation
+        return list(self._x.T)
     
     def deriv(self):
+        if self.batched:
+            theta = self._x[:, 2]
+            xd = (self.inputs[0] * np.cos(theta), self.inputs[0] * np.sin(theta), self.inputs[1])
+            return np.stack(np.broadcast_arrays(*xd), axis=-1)
+
         theta = self._x[2]
         v = self.inputs[0]
         omega = self.inputs[1]
@@ -384,6 +400,7 @@ class MultiRotor(TransferBlock):
             
         self.a1s = np.zeros((self.nrotors,))
         self.b1s = np.zeros((self.nrotors,))
+        self._landed = False
     
     def output(self, t=None):
         
@@ -425,6 +442,10 @@ class MultiRotor(TransferBlock):
     
         return [out]
     
+    def check_inputs(self):
+        if len(self.inputs[0]) != self.nrotors:
+            raise RuntimeError('input vector wrong size')
+
     def deriv(self):
     
         model = self.model
@@ -435,8 +456,6 @@ class MultiRotor(TransferBlock):
         
         # process inputs
         w = self.inputs[0]
-        if len(w) != self.nrotors:
-            raise RuntimeError('input vector wrong size')
     
         if self.speedcheck and np.any(w == 0):
             # might need to fix this, preculudes aerobatics :(
@@ -524,15 +543,17 @@ class MultiRotor(TransferBlock):
             tau[:,i] = np.cross(T[:,i], self.D[:,i])    # Torque due to rotor thrust
     
         # RIGID BODY DYNAMIC MODEL
-        dz = v
+        dz = v.copy()
         dn = iW @ o
         
         dv = model['g'] * e3 + R @ np.sum(T, axis=1) / model['M']
         
-        # vehicle can't fall below ground, remember z is down
-        if self.groundcheck and z[2] > 0:
-            z[0] = 0
-            dz[0] = 0
+        # vehicle can't fall below ground, remember z is down.  It is held
+        # on the ground from the event at which it landed, so the derivative
+        # is smooth within a step
+        if self._landed:
+            dz[2] = min(dz[2], 0)
+            dv[2] = min(dv[2], 0)
     
         do = np.linalg.inv(model['J']) @ (np.cross(-o, model['J'] @ o) + np.sum(tau, axis=1) + np.sum(Q, axis=1)) # row sum of torques
     
@@ -542,6 +563,25 @@ class MultiRotor(TransferBlock):
         
         return np.r_[dz, dn, dv, do]  # This is the state derivative vector
 
+    def start(self, **kwargs):
+        self._landed = False
+
+    def step(self):
+        # the vehicle has taken off
+        if self._landed and self._x[2] < 0:
+            self._landed = False
+
+    def events(self):
+        # height below the ground, remember z is down
+        if self.groundcheck:
+            return [-1.0 if self._landed else self._x[2]]
+
+    def event(self, i, t):
+        # the vehicle has landed, it stops on the ground
+        self._x[2] = 0
+        self._x[8] = min(self._x[8], 0)
+        self._landed = True
+
 if __name__ == "__main__":
 
     import pathlib
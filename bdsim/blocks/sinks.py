@@ -19,7 +19,7 @@ from matplotlib.pyplot import Polygon
 
 import spatialmath.base as sm
 
-from bdsim.components import SinkBlock, block
+from bdsim.components import SinkBlock, Struct, block
 
 
 
@@ -120,6 +120,9 @@ class Stop(SinkBlock):
         :rtype: Stop instance
 
         Conditionally stop the simulation.
+
+        The condition is an event, so the simulation stops at the time it
+        becomes true rather than at the end of the integrator step.
         """
         super().__init__(nin=1, inputs=inputs, **kwargs)
         self.type = 'stop'
@@ -127,14 +130,187 @@ class Stop(SinkBlock):
         self.stop  = stop
 
     def step(self):
+        if self._condition():
+            self.bd.stop = self
+
+    def events(self):
+        return [1.0 if self._condition() else -1.0]
+
+    def event(self, i, t):
+        self.bd.stop = self
+
+    def _condition(self):
         if isinstance(self.stop, bool):
-            stop = self.inputs[0]
+            return self.inputs[0]
         elif callable(self.stop):
-            stop = self.stop(self.inputs[0])
+            return self.stop(self.inputs[0])
         else:
             raise RuntimeError('input to stop must be boolean or callable')
-        if stop:
-            self.bd.stop = self
+
+# ------------------------------------------------------------------------ #
+
+
+@block
+class Stats(SinkBlock):
+    """
+    :blockname:`STATS`
+    
+    .. table::
+       :align: left
+    
+       +--------+---------+---------+
+       | inputs | outputs |  states |
+       +--------+---------+---------+
+       | 1      | 0       | 0       |
+       +--------+---------+---------+
+       | float, |         |         | 
+       | A(N,)  |         |         |
+       +--------+---------+---------+
+    """
+
+    def __init__(self, *inputs, weighted=False, bins=None, range=None,
+                 percentiles=[], reservoir=1000, seed=0, **kwargs):
+        """
+        :param ``*inputs``: Optional incoming connections
+        :type ``*inputs``: Block or Plug
+        :param weighted: weight each value by the length of its step, defaults to False
+        :type weighted: bool, optional
+        :param bins: number of bins of a histogram, defaults to None
+        :type bins: int, optional
+        :param range: lower and upper limits of the histogram
+        :type range: array_like(2), optional
+        :param percentiles: percentiles to estimate, defaults to []
+        :type percentiles: array_like, optional
+        :param reservoir: number of values kept to estimate percentiles, defaults to 1000
+        :type reservoir: int, optional
+        :param seed: seed for the choice of values kept, defaults to 0
+        :type seed: int, optional
+        :param ``**kwargs``: common Block options
+        :return: A STATS block
+        :rtype: Stats instance
+
+        Accumulate statistics of a signal without recording it.
+
+        At every step of the simulation the value of the signal is used to
+        update its running minimum, maximum, mean, variance and RMS value,
+        elementwise if it is an array.  If ``weighted`` is True each value
+        is weighted by the time since the previous step, so the statistics
+        are averages over time rather than over the steps, which differ if
+        the step size varies.
+
+        If ``bins`` and ``range`` are given, a histogram with ``bins`` equal
+        bins between the limits is accumulated, values outside the limits
+        are not counted.  If ``percentiles`` are given, they are estimated
+        from a reservoir of values chosen uniformly at random from all the
+        steps, so the memory used does not depend on the number of steps.
+
+        The statistics are returned by ``stats``, and ``run`` returns those
+        of every STATS block in the ``stats`` attribute of its results,
+        keyed by block name.
+        """
+        super().__init__(nin=1, inputs=inputs, **kwargs)
+        self.type = 'stats'
+
+        if (bins is None) != (range is None):
+            raise ValueError('a histogram needs both bins and range')
+        self.weighted = weighted
+        self.bins = bins
+        self.range = range
+        self.percentiles = percentiles
+        self.reservoir = reservoir
+        self.seed = seed
+        self.start()
+
+    def start(self, **kwargs):
+        self._n = 0         # number of values
+        self._W = 0.0       # sum of the weights
+        self._mean = 0.0
+        self._S = 0.0       # weighted sum of squared deviations from the mean
+        self._min = None
+        self._max = None
+        self._hist = None
+        self._samples = None
+        self._rng = np.random.default_rng(self.seed)
+        self._t = 0.0       # time of the previous step
+
+    def step(self):
+        u = np.asarray(self.inputs[0], dtype=float)
+        if self.weighted:
+            w = self.bd.t - self._t
+            self._t = self.bd.t
+        else:
+            w = 1.0
+
+        if self._n == 0:
+            self._min = u.copy()
+            self._max = u.copy()
+        else:
+            np.minimum(self._min, u, out=self._min)
+            np.maximum(self._max, u, out=self._max)
+        self._n += 1
+
+        if w > 0:
+            # weighted form of Welford's algorithm
+            self._W += w
+            delta = u - self._mean
+            self._mean = self._mean + (w / self._W) * delta
+            self._S = self._S + w * delta * (u - self._mean)
+
+            if self.bins is not None:
+                if self._hist is None:
+                    self._hist = np.zeros(u.shape + (self.bins,))
+                lo, hi = self.range
+                k = np.floor((u - lo) / (hi - lo) * self.bins).astype(int)
+                # the last bin includes its upper limit
+                k = np.where(u == hi, self.bins - 1, k).ravel()
+                i = np.flatnonzero((k >= 0) & (k < self.bins))
+                np.add.at(self._hist.reshape((-1, self.bins)), (i, k[i]), w)
+
+        if len(self.percentiles) > 0:
+            # reservoir sampling, every value is kept with equal probability
+            if self._samples is None:
+                self._samples = np.empty((self.reservoir,) + u.shape)
+            if self._n <= self.reservoir:
+                self._samples[self._n - 1] = u
+            else:
+                j = self._rng.integers(self._n)
+                if j < self.reservoir:
+                    self._samples[j] = u
+
+    def stats(self):
+        """
+        Statistics of the signal
+
+        :return: statistics
+        :rtype: Struct
+
+        The attributes are ``n`` the number of values, ``min``, ``max``,
+        ``mean``, ``var``, ``std`` and ``rms``, and if requested ``hist`` and
+        ``edges`` the histogram and its bin edges, and ``percentiles`` the
+        estimated percentiles, the first axis of which is the percentile.
+        """
+        out = Struct('stats')
+        out.n = self._n
+        # a scalar signal has scalar statistics
+        out.min = None if self._min is None else self._min[()]
+        out.max = None if self._max is None else self._max[()]
+        if self._W > 0:
+            out.mean = self._mean
+            out.var = self._S / self._W
+            out.std = np.sqrt(out.var)
+            out.rms = np.sqrt(out.var + self._mean ** 2)
+        else:
+            out.mean = out.var = out.std = out.rms = None
+        if self.bins is not None:
+            out.hist = self._hist
+            out.edges = np.linspace(self.range[0], self.range[1], self.bins + 1)
+        if len(self.percentiles) > 0:
+            if self._samples is None:
+                out.percentiles = None
+            else:
+                n = min(self._n, self.reservoir)
+                out.percentiles = np.percentile(self._samples[:n], self.percentiles, axis=0)
+        return out
 
 if __name__ == "__main__":
 
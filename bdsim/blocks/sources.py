@@ -55,6 +55,7 @@ class Constant(SourceBlock):
             value = np.array(value)
         self.value = value
         self.type = 'constant'
+        self.pure = True
 
     def output(self, t=None):
         return [self.value]               
@@ -149,6 +150,7 @@ class WaveForm(SourceBlock):
         self.amplitude = amplitude
         self.offset = offset
         self.type = 'waveform'
+        self.pure = True
 
     def output(self, t=None):
         T = 1.0 / self.freq
@@ -177,6 +179,23 @@ class WaveForm(SourceBlock):
         #print('waveform = ', out)
         return [out]
 
+    def breakpoints(self, T):
+        # the square wave jumps, and the triangle wave changes slope, at
+        # these fractions of the cycle
+        if self.wave == 'square':
+            edges = [0, self.duty]
+        elif self.wave == 'triangle':
+            edges = [0.25, 0.75]
+        else:
+            return []
+        times = []
+        for n in range(math.floor(-self.phase) - 1, math.ceil(T * self.freq - self.phase) + 1):
+            for edge in edges:
+                t = (n + edge + self.phase) / self.freq
+                if 0 < t < T:
+                    times.append(t)
+        return sorted(times)
+
 # ------------------------------------------------------------------------ #
 
 @block
@@ -220,12 +239,16 @@ class Piecewise(SourceBlock):
         self.t = [ x[0] for x in seq]
         self.y = [ x[1] for x in seq]
         self.type = "piecewise"
+        self.pure = True
 
     def output(self, t):
         i = sum([ 1 if t >= _t else 0  for _t in self.t]) - 1
         out = self.y[i]
         #print(out)
         return [out]
+
+    def breakpoints(self, T):
+        return [t for t in self.t if 0 < t < T]
     
 # ------------------------------------------------------------------------ #
 
@@ -272,6 +295,7 @@ class Step(SourceBlock):
         self.off = off
         self.on = on
         self.type = "step"
+        self.pure = True
 
     def output(self, t=None):
         if t >= self.T:
@@ -282,6 +306,9 @@ class Step(SourceBlock):
         #print(out)
         return [out]
 
+    def breakpoints(self, T):
+        return [self.T] if 0 < self.T < T else []
+
 if __name__ == "__main__":
 
     import pathlib
@@ -40,9 +40,44 @@ import unittest
 import numpy.testing as nt
 
 from bdsim.blocks.displays import *
+from bdsim.blocks.sinks import Stats
 
 class SinkBlockTest(unittest.TestCase):
     
+    def test_stats(self):
+
+        x = np.array([1.0, -2, 3.5, 0, 4, -1, 2.5])
+        b = Stats(bins=3, range=(-3, 3), percentiles=[0, 50, 100])
+        b.start()
+        for xi in x:
+            b.setinputs(xi)
+            b.step()
+        s = b.stats()
+        self.assertEqual(s.n, len(x))
+        self.assertEqual(s.min, x.min())
+        self.assertEqual(s.max, x.max())
+        self.assertAlmostEqual(s.mean, x.mean())
+        self.assertAlmostEqual(s.var, x.var())
+        self.assertAlmostEqual(s.std, x.std())
+        self.assertAlmostEqual(s.rms, np.sqrt(np.mean(x ** 2)))
+        nt.assert_array_equal(s.hist, [1, 2, 2])
+        nt.assert_array_equal(s.edges, [-3, -1, 1, 3])
+        nt.assert_array_equal(s.percentiles, [-2, 1, 4])
+
+        # elementwise, percentiles from a sample of the values
+        x = np.random.default_rng(1).normal(size=(5000, 2)) * [1, 2]
+        b = Stats(percentiles=[50], reservoir=500)
+        b.start()
+        for xi in x:
+            b.setinputs(xi)
+            b.step()
+        s = b.stats()
+        nt.assert_allclose(s.mean, x.mean(axis=0))
+        nt.assert_allclose(s.var, x.var(axis=0))
+        nt.assert_array_equal(s.min, x.min(axis=0))
+        self.assertEqual(s.percentiles.shape, (1, 2))
+        nt.assert_allclose(s.percentiles[0], [0, 0], atol=0.3)
+
     
     def test_quadrotor(self):
         
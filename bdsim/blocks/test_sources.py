@@ -205,6 +205,17 @@ class SourceBlockTest(unittest.TestCase):
         self.assertEqual(block.output(2.1)[0], 0)
         self.assertEqual(block.output(9)[0], 0)
 
+    def test_breakpoints(self):
+
+        self.assertEqual(Constant(value=7).breakpoints(5), [])
+        self.assertEqual(WaveForm(wave='sine').breakpoints(5), [])
+        nt.assert_almost_equal(WaveForm(wave='square', freq=2).breakpoints(1.2), [0.25, 0.5, 0.75, 1])
+        nt.assert_almost_equal(WaveForm(wave='square', duty=0.25, phase=0.1).breakpoints(2), [0.1, 0.35, 1.1, 1.35])
+        nt.assert_almost_equal(WaveForm(wave='triangle').breakpoints(2), [0.25, 0.75, 1.25, 1.75])
+        self.assertEqual(Step(T=2).breakpoints(5), [2])
+        self.assertEqual(Step(T=2).breakpoints(1), [])
+        self.assertEqual(Piecewise( (0,0), (1,1), (2,1), (10,0)).breakpoints(5), [1, 2])
+
 # ---------------------------------------------------------------------------------------#
 if __name__ == '__main__':
 
@@ -78,8 +78,13 @@ class Integrator(TransferBlock):
               the state vector, or
             - a vector, of the same shape as ``x0`` that applies elementwise to
               the state.
+
+        The state is held at a bound while the input would drive it beyond.
+        Reaching a bound is an event, so the integrator step ends at that time.
         """
         super().__init__(nin=1, nout=1, inputs=inputs, **kwargs)
+        self.type = 'integrator'
+        self.batchable = True
 
         if isinstance(x0, np.ndarray):
             assert len(x0.shape) == 1, 'state must be a vector'
@@ -104,17 +109,69 @@ class Integrator(TransferBlock):
         self._x0 = np.r_[x0]
         self.min = np.r_[min]
         self.max = np.r_[max]
+        self.start()
+
+    def start(self, **kwargs):
+        # the elements of the state held at their minimum or maximum
+        self._minheld = np.zeros((self.nstates,), dtype=bool)
+        self._maxheld = np.zeros((self.nstates,), dtype=bool)
 
     def output(self, t=None):
-        return list(self._x)
+        # in an ensemble simulation the state has a row per simulation
+        if self.nstates == 1:
+            return list(self._x.T)
+        else:
+            return [self._x.copy()]
 
     def deriv(self):
-        xd = np.array(self.inputs)
-        for i in range(0, self.nstates):
-            if self._x[i] < self.min[i] or self._x[i] > self.max[i]:
-                xd[i] = 0
+        u = np.asarray(self.inputs[0], dtype=float)
+        if self.nstates == 1:
+            u = u[..., np.newaxis]
+        xd = np.broadcast_to(u, self._x.shape).copy()
+        if self.batched:
+            # an ensemble has no events, hold the state once it is at a bound
+            xd[((self._x <= self.min) & (xd < 0)) | ((self._x >= self.max) & (xd > 0))] = 0
+        else:
+            # the state is held from the event at which it reached the bound,
+            # so the derivative is smooth within a step
+            xd[self._minheld | self._maxheld] = 0
         return xd
 
+    def events(self):
+        # for each finite bound, the distance beyond it, or if the state is
+        # held there, the input driving it away
+        upper = np.isfinite(self.max)
+        lower = np.isfinite(self.min)
+        if not np.any(upper) and not np.any(lower):
+            return None
+        u = np.broadcast_to(self.inputs[0], self._x.shape)
+        return np.r_[np.where(self._maxheld, -u, self._x - self.max)[upper],
+                     np.where(self._minheld, u, self.min - self._x)[lower]]
+
+    def event(self, i, t):
+        upper = np.flatnonzero(np.isfinite(self.max))
+        lower = np.flatnonzero(np.isfinite(self.min))
+        u = np.broadcast_to(self.inputs[0], self._x.shape)
+        if i < len(upper):
+            k = upper[i]
+            held, bound, beyond = self._maxheld, self.max, u[k] > 0
+        else:
+            k = lower[i - len(upper)]
+            held, bound, beyond = self._minheld, self.min, u[k] < 0
+        if held[k]:
+            # the input has reversed
+            held[k] = False
+        else:
+            # the state has reached the bound
+            self._x[k] = bound[k] if len(bound) > 1 else bound[0]
+            held[k] = beyond
+
+    def jacobian(self):
+        # while the state is held at a bound its derivative is zero, but the
+        # Jacobian is constant so this is ignored
+        n = self.nstates
+        return np.zeros((n, n)), [np.eye(n)], [np.eye(n)]
+
 # ------------------------------------------------------------------------ #
 
 
@@ -196,6 +253,7 @@ class LTI_SS(TransferBlock):
         self.A = A
         self.B = B
         self.C = C
+        self.batchable = True
 
         self.nstates = A.shape[0]
 
@@ -205,10 +263,19 @@ class LTI_SS(TransferBlock):
             self._x0 = x0
 
     def output(self, t=None):
-        return list(self.C @ self._x)
+        # in an ensemble simulation the state has a row per simulation
+        return list(self.C @ self._x.T)
 
     def deriv(self):
-        return self.A @ self._x + self.B @ np.array(self.inputs)
+        if self.batched:
+            u = np.array(np.broadcast_arrays(*self.inputs), dtype=float)
+            return self._x @ self.A.T + (self.B @ u).T
+        else:
+            return self.A @ self._x + self.B @ np.array(self.inputs)
+
+    def jacobian(self):
+        return self.A, [self.B[:, i:i + 1] for i in range(self.nin)], \
+            [self.C[p:p + 1, :] for p in range(self.nout)]
 # ------------------------------------------------------------------------ #
 
 
@@ -0,0 +1,294 @@
+"""
+Generate Python code that evaluates a compiled block diagram.
+
+The derivative schedule of a compiled ``BlockDiagram``, the blocks needed
+to compute the state derivative, is converted to straight-line Python
+source code.  Every output port becomes a local
+variable, every block becomes a call to its ``output`` or ``deriv`` method,
+and simple blocks (``GAIN``, ``SUM``, ``PROD``, ``MUX`` and ``DEMUX``) are
+replaced by inline arithmetic.  Algebraic loops are evaluated
+by calling their ``AlgebraicLoop`` solver block, and groups of linear blocks by
+calling their ``FusedLinear`` block.  Constant blocks, and blocks that depend
+only on time, are left to the block diagram.
+
+The source defines a function ``make(bd, blocks)`` which returns a closure
+``evaluate(x, t)`` that has the same behaviour as
+``BlockDiagram.evaluate(x, t, outputs=False)`` but none of its overhead.
+"""
+
+import hashlib
+import importlib.util
+import linecache
+from pathlib import Path
+
+import numpy as np
+
+
+def generate(bd):
+    """
+    Generate Python source code for a compiled block diagram
+
+    :param bd: compiled block diagram
+    :type bd: BlockDiagram
+    :return: source code and the list of blocks it refers to
+    :rtype: str, list of Block
+
+    The blocks are referred to by their index in the returned list, which
+    must be passed to ``make`` in the generated code.
+
+    Inline arithmetic is generated according to the types of the values seen
+    on the wires when the diagram was compiled.
+
+    Constant blocks, and blocks that depend only on time, are evaluated by
+    the block diagram, and the blocks they drive read those values from
+    their inputs.
+    """
+    schedule = bd._untimed[0]
+    scheduled = set(schedule)
+    cached = set(bd._folded) | set(bd._timed[0])
+
+    # blocks within algebraic loops are evaluated by the loop solver, their
+    # outputs are outputs of the solver
+    solver = {}
+    source = {}
+    for b in schedule:
+        if b.type == 'algebraicloop':
+            port = 0
+            for m in b.members:
+                solver[m] = b
+                for p in range(m.nout):
+                    source[m, p] = (b, port)
+                    port += 1
+
+    # blocks within fused linear blocks are evaluated by the fused block, the
+    # outputs that leave the group are outputs of the fused block
+    fused = {}
+    for b in schedule:
+        if b.type == 'fusedlinear':
+            for m in b.members:
+                fused[m] = b
+            for (m, p), port in b._outmap.items():
+                source[m, p] = (b, port)
+
+    # all scheduled blocks, followed by loop members whose inputs we need
+    # to set
+    blocks = list(schedule) + list(solver)
+    index = {b: i for i, b in enumerate(blocks)}
+
+    def var(b, port):
+        b, port = source.get((b, port), (b, port))
+        if b.outports[port]:
+            return 'w{:d}_{:d}'.format(index[b], port)
+        else:
+            return '_'  # unconnected port
+
+    def driven(b, w):
+        # input is driven by a scheduled block, not from within the same loop
+        start = w.start.block
+        if start in solver:
+            return solver[start] is not solver.get(b)
+        return fused.get(start, start) in scheduled
+
+    def inputs(b):
+        # the expression for each input port, or None
+        ins = []
+        for port, w in enumerate(b.inports):
+            if w is not None and w.start.block in cached:
+                ins.append('b{:d}_in[{:d}]'.format(index[b], port))
+            elif w is not None and driven(b, w):
+                ins.append(var(w.start.block, w.start.port))
+            else:
+                ins.append(None)
+        return ins
+
+    def setinputs(b):
+        i = index[b]
+        return ['b{:d}_in[{:d}] = {:s}'.format(i, port, v)
+                    for port, (w, v) in enumerate(zip(b.inports, inputs(b)))
+                        if v is not None and w.start.block not in cached]
+
+    head = []
+    body = []
+    tail = []
+    if len(bd._timed[0]) > 0:
+        head.append('_tlast = bd._tlast')
+        head.append('_propagate = bd._propagate')
+        head.append('_timed = bd._timed[0]')
+        body.append('')
+        body.append('# blocks that depend only on time')
+        body.append('if t != _tlast[0]:')
+        body.append('    _tlast[0] = t')
+        body.append('    _propagate(_timed, t)')
+    for b in blocks:
+        i = index[b]
+        head.append('b{:d} = blocks[{:d}]  # {:s}'.format(i, i, str(b)))
+        if b.nin > 0:
+            head.append('b{:d}_in = b{:d}.inputs'.format(i, i))
+
+        if b in solver:
+            # inputs are set before the loop is solved
+            continue
+
+        body.append('')
+        body.append('# {:s} ({:s})'.format(str(b), b.type))
+        outs = [var(b, port) for port in range(b.nout)]
+
+        if b.blockclass == 'transfer':
+            # input values are not known yet, set them before calling deriv
+            head.append('b{:d}_output = b{:d}.output'.format(i, i))
+            head.append('b{:d}_deriv = b{:d}.deriv'.format(i, i))
+            body.append(_call(i, outs))
+            tail.append('')
+            tail.append('# ' + str(b))
+            tail.extend(setinputs(b))
+            if isinstance(b._xslice, slice):
+                tail.append('_xd[{:d}:{:d}] = b{:d}_deriv()'.format(b._xslice.start, b._xslice.stop, i))
+            else:
+                # states of a fused block that are not contiguous
+                head.append('s{:d} = b{:d}._xslice'.format(i, i))
+                tail.append('_xd[s{:d}] = b{:d}_deriv()'.format(i, i))
+            continue
+
+        if b.type == 'algebraicloop':
+            for m in b.members:
+                body.extend(setinputs(m))
+        else:
+            body.extend(setinputs(b))
+        inline = _inliners.get(b.type)
+        code = None
+        if inline is not None:
+            code = inline(b, i, inputs(b), outs, head)
+        if code is None:
+            head.append('b{:d}_output = b{:d}.output'.format(i, i))
+            code = [_call(i, outs)]
+        body.extend(code)
+
+    lines = [
+        '# Generated by bdsim from block diagram: {:s}'.format(bd.name),
+        '#',
+        '# blocks: {:d}, wires: {:d}, states: {:d}'.format(len(bd.blocklist), len(bd.wirelist), bd.nstates),
+        '',
+        'import numpy as np',
+        'from math import pi',
+        '',
+        '',
+        'def make(bd, blocks):',
+        '    _x = bd.x',
+        '    _xd = bd.xd',
+    ]
+    lines.extend(['    ' + line for line in head])
+    lines.append('')
+    lines.append('    def evaluate(x, t):')
+    lines.append('        bd.t = t')
+    lines.append('        _x[...] = x')
+    lines.extend(['        ' + line if line else '' for line in body + tail])
+    lines.append('')
+    lines.append('        return _xd')
+    lines.append('')
+    lines.append('    return evaluate')
+    lines.append('')
+
+    return '\n'.join(lines), blocks
+
+
+def load(source, cachedir=None):
+    """
+    Load generated source code
+
+    :param source: source code created by ``generate``
+    :type source: str
+    :param cachedir: directory to cache the code in, defaults to None
+    :type cachedir: str, optional
+    :return: the ``make`` function defined by the source code
+    :rtype: callable
+
+    If ``cachedir`` is given the source is written to a file in that directory
+    whose name is a hash of the source.  If that file already exists it is
+    imported, and Python's own bytecode cache in ``__pycache__`` avoids
+    recompiling the source.
+    """
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    modname = 'bdsim_' + key
+
+    if cachedir is None:
+        # keep a copy of the source for tracebacks
+        filename = '<{:s}>'.format(modname)
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        namespace = {}
+        exec(compile(source, filename, 'exec'), namespace)
+        return namespace['make']
+
+    path = Path(cachedir) / (modname + '.py')
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source, encoding='utf-8')
+
+    spec = importlib.util.spec_from_file_location(modname, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.make
+
+# ------------------------------------------------------------------------- #
+
+def _targets(outs):
+    # assignment targets that unpack a list of port values
+    if len(outs) == 1:
+        return outs[0] + ','
+    else:
+        return ', '.join(outs)
+
+def _call(i, outs):
+    # call the block's output method and unpack the result
+    if len(outs) == 0:
+        return 'b{:d}_output(t)'.format(i)
+    else:
+        return '{:s} = b{:d}_output(t)'.format(_targets(outs), i)
+
+def _gain(b, i, ins, outs, head):
+    head.append('k{:d} = b{:d}.gain'.format(i, i))
+    if isinstance(b.gain, np.ndarray) and isinstance(b.inputs[0], np.ndarray):
+        if b.premul:
+            return ['{:s} = k{:d} @ {:s}'.format(outs[0], i, ins[0])]
+        else:
+            return ['{:s} = {:s} @ k{:d}'.format(outs[0], ins[0], i)]
+    else:
+        return ['{:s} = {:s} * k{:d}'.format(outs[0], ins[0], i)]
+
+def _sum(b, i, ins, outs, head):
+    expr = ''
+    for sign, v in zip(b.signs, ins):
+        if expr == '':
+            expr = v if sign == '+' else '-' + v
+        else:
+            expr += ' {:s} {:s}'.format(sign, v)
+    if b.angles:
+        expr = 'np.mod({:s} + pi, 2 * pi) - pi'.format(expr)
+    return ['{:s} = {:s}'.format(outs[0], expr)]
+
+def _prod(b, i, ins, outs, head):
+    expr = ''
+    for op, v in zip(b.ops, ins):
+        if b.matrix:
+            if op == '/':
+                v = 'np.linalg.inv({:s})'.format(v)
+            expr = v if expr == '' else expr + ' @ ' + v
+        else:
+            if expr == '':
+                expr = v if op == '*' else '1.0 / ' + v
+            else:
+                expr += ' {:s} {:s}'.format(op, v)
+    return ['{:s} = {:s}'.format(outs[0], expr)]
+
+def _mux(b, i, ins, outs, head):
+    return ['{:s} = np.r_[[{:s}]]'.format(outs[0], ', '.join(ins))]
+
+def _demux(b, i, ins, outs, head):
+    return ['{:s} = {:s}'.format(_targets(outs), ins[0])]
+
+_inliners = {
+    'gain': _gain,
+    'sum': _sum,
+    'prod': _prod,
+    'mux': _mux,
+    'demux': _demux,
+}
@@ -6,6 +6,7 @@ Components of the simulation system, namely blocks, wires and plugs.
 
 import math
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 from matplotlib import animation
 from collections import UserDict
@@ -42,7 +43,12 @@ class Struct(UserDict):
             self.data[name] = value
         
     def __getattr__(self, name):
-        return self.data[name]
+        # AttributeError allows pickle and copy to probe for special methods
+        # before data exists
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name) from None
         
     def __str__(self):
         return self.name + ' ' + str({k:v for k, v in self.data.items() if not k.startswith('_')})
@@ -72,7 +78,10 @@ class Wire:
     start and end ports.
 
     A wire records all the connections defined by the user.  At compile time
-    wires are used to build inter-block references.
+    wires are used to build inter-block references, and the value on the
+    wire when the diagram is first evaluated is recorded in ``value``, along
+    with its ``type``, ``dtype`` and ``shape``.  ``dtype`` is None if the value
+    is not numeric.
     
     Between two blocks, a wire can connect one or more ports, ie. it can connect
     a set of output ports on one block to a same sized set of input ports on 
@@ -87,6 +96,8 @@ class Wire:
         self.end = end
         self.value = None
         self.type = None
+        self.dtype = None
+        self.shape = None
         self.name = None
 
     @property
@@ -449,6 +460,14 @@ class Block:
 
     _latex_remove = str.maketrans({'$':'', '\\':'', '{':'', '}':'', '^':'', '_':''})
 
+    # block can evaluate an ensemble of signal values, see BlockDiagram.run_ensemble
+    batchable = False
+    batched = False
+
+    # outputs depend only on inputs, parameters and time, so may be folded or
+    # cached, a block must declare this
+    pure = False
+
     def __init__(self, name=None, inames=None, onames=None, snames=None, pos=None, nin=None, nout=None, inputs=None, bd=None, **kwargs):
 
         # print('Block constructor, bd = ', bd)
@@ -798,6 +817,15 @@ class Block:
         assert self.nin > 0 or self.nout > 0, 'no inputs or outputs specified'
         assert hasattr(self, 'initd') and self.initd, 'Block superclass not initalized. was super().__init__ called?'
 
+    def check_inputs(self):  # check validity of input values
+        pass
+
+    def events(self):  # values of event functions, an event when one becomes non-negative
+        return None
+
+    def event(self, i, t):  # event function i became non-negative at time t
+        pass
+
     def done(self, **kwargs):  # end of simulation
         pass
 
@@ -829,6 +857,7 @@ class SourceBlock(Block):
     but no inputs.  Its output is a function of parameters and time.
     """
     blockclass = 'source'
+    batchable = True
 
     def __init__(self, **kwargs):
         # print('Source constructor')
@@ -836,6 +865,22 @@ class SourceBlock(Block):
         self.nin = 0
         self.nstates = 0
 
+    def breakpoints(self, T):
+        """
+        Times at which the output is discontinuous
+
+        :param T: simulation time
+        :type T: float
+        :return: times in the interval (0, T)
+        :rtype: list of float
+
+        The integrator is restarted at these times rather than having to
+        discover the discontinuity by rejecting steps.  A discontinuity in the
+        slope of the output is also worth reporting.  The default is no
+        breakpoints.
+        """
+        return []
+
 
 class TransferBlock(Block):
     """
@@ -865,6 +910,9 @@ class TransferBlock(Block):
         assert len(self._x0) == self.nstates, 'incorrect length for initial state'
         assert self.nin > 0 or self.nout > 0, 'no inputs or outputs specified'
 
+    def jacobian(self):  # constant A, [B per input port], [C per output port], or None
+        return None
+
 
 class FunctionBlock(Block):
     """
@@ -879,6 +927,461 @@ class FunctionBlock(Block):
         super().__init__(**kwargs)
         self.nstates = 0
 
+    def jacobian(self):  # constant D[output port][input port], or None
+        return None
+
+
+class AlgebraicLoop(FunctionBlock):
+    """
+    An AlgebraicLoop is a FunctionBlock that evaluates a group of function
+    blocks that form one or more algebraic loops.  It is created by
+    ``BlockDiagram.compile`` and takes the place of the group in the execution
+    schedule.
+
+    The loops are broken by tearing, guessing the output values of some of
+    the blocks, the torn blocks, so the rest can be evaluated in order.  The
+    torn blocks are then evaluated and the difference between their outputs
+    and the guesses is driven to zero using Broyden's method.  The Jacobian
+    is initially estimated by finite differences, and the solution and
+    Jacobian are kept to start the next solve.
+
+    The output ports of the block are the output ports of all the blocks in
+    the group, in order.
+    """
+
+    def __init__(self, members, tol=1e-10, maxiter=50, **kwargs):
+        """
+        :param members: blocks that form the loops
+        :type members: list of Block
+        :param tol: convergence tolerance on the residual, defaults to 1e-10
+        :type tol: float, optional
+        :param maxiter: maximum number of iterations, defaults to 50
+        :type maxiter: int, optional
+        :param ``**kwargs``: common Block options
+        :return: an algebraic loop solver
+        :rtype: AlgebraicLoop instance
+        """
+        super().__init__(nin=0, nout=sum([b.nout for b in members]), **kwargs)
+        self.type = 'algebraicloop'
+        self.pure = False
+        self.members = members
+        self.tol = tol
+        self.maxiter = maxiter
+        self.inputs = []
+
+        group = set(members)
+        offset = {}
+        port = 0
+        for b in members:
+            offset[b] = port
+            port += b.nout
+
+        # wires within the group, and wires leaving it
+        self._internal = {b: [(p, dest, inport) for p, dest, inport in b._fanout if dest in group]
+                            for b in members}
+        self._fanout = [(offset[b] + p, dest, inport) for b in members
+                            for p, dest, inport in b._fanout if dest not in group]
+        self.outports = [wires for b in members for wires in b.outports]
+        self.nexternal = len([w for b in members for w in b.inports if w.start.block not in group])
+
+        # choose blocks to tear, so that the others can be evaluated in order
+        drivers = {b: {w.start.block for w in b.inports if w.start.block in group} for b in members}
+        known = set()
+        self._order = []
+        self._torn = []
+        remaining = list(members)
+        while remaining:
+            for b in remaining:
+                if drivers[b] <= known:
+                    self._order.append(b)
+                    break
+            else:
+                b = remaining[0]
+                self._torn.append(b)
+            known.add(b)
+            remaining.remove(b)
+
+        self._z = None  # solution at the last evaluation
+        self._J = None  # Jacobian at the last evaluation
+
+    def output(self, t=None):
+        if self._z is None:
+            self._start(t)
+
+        z = self._z
+        r = self._residual(z, t)
+        J = self._J
+        for i in range(self.maxiter):
+            if np.linalg.norm(r) <= self.tol * (1 + np.linalg.norm(z)):
+                break
+            if J is None:
+                J = self._jacobian(z, r, t)
+            dz = np.linalg.solve(J, -r)
+            z = z + dz
+            r_new = self._residual(z, t)
+
+            if np.linalg.norm(r_new) > np.linalg.norm(r):
+                # the Jacobian is a poor estimate, start afresh
+                J = None
+            else:
+                # Broyden's rank one update of the Jacobian
+                J = J + np.outer(r_new - r - J @ dz, dz) / (dz @ dz)
+            r = r_new
+        else:
+            if np.linalg.norm(r) > self.tol * (1 + np.linalg.norm(z)):
+                raise RuntimeError('algebraic loop did not converge, residual {:g}'.format(np.linalg.norm(r)))
+
+        self._z = z
+        self._J = J
+        return [value for b in self.members for value in self._outputs[b]]
+
+    def _start(self, t):
+        # guess zero for the torn outputs, and take the outputs computed
+        # from that guess as the initial solution, this also determines the
+        # shape of the values on the torn wires
+        for b in self._torn:
+            for port in range(b.nout):
+                self._send(b, port, 0.0)
+        self._evaluate(t)
+
+        self._layout = []
+        offset = 0
+        for b in self._torn:
+            for port, value in enumerate(self._outputs[b]):
+                shape = np.shape(value)
+                n = int(np.prod(shape))
+                self._layout.append((b, port, slice(offset, offset + n), shape))
+                offset += n
+        self._z = np.concatenate([np.ravel(self._outputs[b][port])
+                                    for b, port, sl, shape in self._layout]).astype(float)
+
+    def _send(self, b, port, value):
+        # copy a value to the inputs within the group that are driven by this
+        # output port
+        for p, dest, inport in self._internal[b]:
+            if p == port:
+                dest.inputs[inport] = value
+
+    def _evaluate(self, t):
+        # evaluate the group given the torn outputs
+        self._outputs = {}
+        for b in self._order:
+            out = b.output(t)
+            self._outputs[b] = out
+            for p, dest, inport in self._internal[b]:
+                dest.inputs[inport] = out[p]
+        for b in self._torn:
+            self._outputs[b] = b.output(t)
+
+    def _residual(self, z, t):
+        # difference between torn block outputs and the guessed values z
+        for b, port, sl, shape in self._layout:
+            if shape == ():
+                self._send(b, port, z[sl.start])
+            else:
+                self._send(b, port, z[sl].reshape(shape))
+        self._evaluate(t)
+
+        r = np.empty(z.shape)
+        for b, port, sl, shape in self._layout:
+            r[sl] = np.ravel(self._outputs[b][port])
+        return r - z
+
+    def _jacobian(self, z, r, t):
+        # forward difference estimate of the Jacobian of the residual
+        J = np.empty((len(z), len(z)))
+        for j in range(len(z)):
+            h = 1e-7 * max(1.0, abs(z[j]))
+            zh = z.copy()
+            zh[j] += h
+            J[:, j] = (self._residual(zh, t) - r) / h
+        return J
+
+
+class FusedLinear(FunctionBlock):
+    r"""
+    A FusedLinear is a block that evaluates a group of linear blocks, such as
+    ``GAIN``, ``SUM``, ``MUX``, ``DEMUX``, ``LTI_SS`` and ``LTI_SISO``, as a
+    single state-space system
+
+    .. math::
+
+        \dot{x} = A x + B u, \quad y = C x + D u
+
+    It is created by ``BlockDiagram.compile`` and takes the place of the group
+    in the execution schedule.  ``x`` holds the states of the transfer blocks
+    in the group, ``u`` the values on the wires entering the group and ``y``
+    the values on the wires leaving it, flattened into vectors.
+
+    If the group contains transfer blocks its outputs depend only on its
+    state, D is zero, and it is scheduled like a transfer block.  Otherwise
+    A, B and C are empty.  Large sparse matrices are kept in compressed sparse
+    row format.
+
+    The input ports of the block are the wires entering the group, and its
+    output ports are the output ports of the blocks in the group that drive
+    blocks outside it, in order.
+    """
+
+    def __init__(self, members, **kwargs):
+        """
+        :param members: linear blocks, transfer blocks then function blocks in
+            topological order
+        :type members: list of Block
+        :param ``**kwargs``: common Block options
+        :return: a fused linear block
+        :rtype: FusedLinear instance
+
+        The shapes of the values on the wires are taken from the inputs of the
+        blocks, so the diagram must have been evaluated.
+        """
+        super().__init__(**kwargs)
+        self.type = 'fusedlinear'
+        self.pure = False
+        self.members = members
+        self.batchable = all([b.batchable for b in members])
+
+        group = set(members)
+
+        # wires entering the group, and output ports driving blocks outside it
+        self.inports = [w for b in members for w in b.inports if w.start.block not in group]
+        self._inmap = {(w.end.block, w.end.port): port for port, w in enumerate(self.inports)}
+        self.outports = []
+        self._outmap = {}
+        for b in members:
+            for p, wires in enumerate(b.outports):
+                wires = [w for w in wires if w.end.block not in group]
+                if len(wires) > 0:
+                    self._outmap[b, p] = len(self.outports)
+                    self.outports.append(wires)
+        self.nin = len(self.inports)
+        self.nout = len(self.outports)
+        self.inputs = [None] * self.nin
+
+        # wires within the group
+        self._internal = {b: [(w.start.port, w.end.block, w.end.port)
+                                for wires in b.outports for w in wires if w.end.block in group]
+                            for b in members}
+        self._shapes = {(b, p): np.shape(b.inputs[p]) for b in members for p in range(b.nin)}
+
+        self._transfers = [b for b in members if b.blockclass == 'transfer']
+        self.nstates = sum([b.nstates for b in self._transfers])
+        if self.nstates > 0:
+            self.blockclass = 'transfer'
+
+        self.build()
+
+    def build(self):
+        """
+        Compute the state-space matrices of the group
+
+        :raises RuntimeError: a block in the group is not linear
+
+        The matrices are found from the matrices of the transfer blocks and by
+        evaluating each function block with unit inputs.  This is done when
+        the diagram is compiled and at the start of every run, since block
+        parameters may have been changed.
+        """
+        # the states of the group within the state vector of the diagram
+        columns = [np.arange(b._xslice.start, b._xslice.stop) for b in self._transfers]
+        columns = np.concatenate(columns) if len(columns) > 0 else np.zeros((0,), dtype=int)
+        if len(columns) > 0 and np.all(np.diff(columns) == 1):
+            self._xslice = slice(int(columns[0]), int(columns[-1]) + 1)
+        else:
+            self._xslice = columns
+
+        nx = self.nstates
+        sizes = [int(np.prod(self._shapes[w.end.block, w.end.port])) for w in self.inports]
+        offset = nx + np.cumsum([0] + sizes)
+        n = offset[-1]
+
+        # the value on every output port in the group, as a matrix that maps
+        # [x; u] to the flattened value
+        value = {}
+        shape = {}
+
+        def inputs(b):
+            # matrix that maps [x; u] to the flattened inputs of block b
+            rows = []
+            for p, w in enumerate(b.inports):
+                if (b, p) in self._inmap:
+                    port = self._inmap[b, p]
+                    M = np.zeros((sizes[port], n))
+                    M[:, offset[port]:offset[port + 1]] = np.eye(sizes[port])
+                else:
+                    M = value[w.start.block, w.start.port]
+                rows.append(M)
+            return np.vstack(rows)
+
+        k = 0
+        for b in self._transfers:
+            for p in range(b.nout):
+                value[b, p] = np.zeros((1, n))
+                value[b, p][0, k:k + b.nstates] = b.C[p]
+                shape[b, p] = ()
+            k += b.nstates
+
+        for b in self.members:
+            if b.blockclass == 'function':
+                linear = self._linearmap(b, [self._shapes[b, p] for p in range(b.nin)])
+                if linear is None:
+                    raise RuntimeError('block {:s} is not linear, it cannot be fused'.format(str(b)))
+                L, outshapes = linear
+                M = L @ inputs(b)
+                row = 0
+                for p, s in enumerate(outshapes):
+                    m = int(np.prod(s))
+                    value[b, p] = M[row:row + m, :]
+                    shape[b, p] = s
+                    row += m
+
+        AB = np.zeros((nx, n))
+        k = 0
+        for b in self._transfers:
+            U = inputs(b)
+            if U.shape[0] != b.B.shape[1]:
+                raise RuntimeError('block {:s} has non-scalar inputs, it cannot be fused'.format(str(b)))
+            AB[k:k + b.nstates, k:k + b.nstates] = b.A
+            AB[k:k + b.nstates, :] += b.B @ U
+            k += b.nstates
+
+        Y = np.vstack([value[port] for port in self._outmap] + [np.zeros((0, n))])
+        self._A = self._sparse(AB[:, :nx])
+        self._B = self._sparse(AB[:, nx:])
+        self._C = self._sparse(Y[:, :nx])
+        self._D = self._sparse(Y[:, nx:])
+        self._feedthrough = np.any(Y[:, nx:] != 0)
+        self._ny = Y.shape[0]
+
+        # where each output port is found in y, an index for a scalar and a
+        # slice for a vector
+        self._index = []
+        row = 0
+        for port in self._outmap:
+            if shape[port] == ():
+                self._index.append(row)
+                row += 1
+            else:
+                self._index.append(slice(row, row + shape[port][0]))
+                row += shape[port][0]
+
+    def output(self, t=None):
+        if self.batched:
+            # ensemble of values, a row per simulation
+            y = np.zeros((self.bd.x.shape[0], self._ny))
+            if self.nstates > 0:
+                y += (self._C @ self.bd.x[:, self._xslice].T).T
+            if self._feedthrough:
+                y += (self._D @ self._gather().T).T
+            return [y[:, i] for i in self._index]
+
+        if self.nstates > 0:
+            y = self._C @ self.bd.x[self._xslice]
+            if self._feedthrough:
+                y = y + self._D @ np.hstack(self.inputs)
+        else:
+            y = self._D @ np.hstack(self.inputs)
+        return [y[i] for i in self._index]
+
+    def deriv(self):
+        if self.batched:
+            xd = (self._A @ self.bd.x[:, self._xslice].T).T
+            if self.nin > 0:
+                xd = xd + (self._B @ self._gather().T).T
+            return xd
+
+        xd = self._A @ self.bd.x[self._xslice]
+        if self.nin > 0:
+            xd = xd + self._B @ np.hstack(self.inputs)
+        return xd
+
+    def publish(self, t=None):
+        """
+        Evaluate the blocks in the group
+
+        :param t: current time
+        :type t: float
+
+        ``output`` computes only the values on the wires leaving the group.
+        This evaluates the blocks in the group one by one so that the values
+        on all their input ports are known, for example to be watched.
+        """
+        for (b, p), port in self._inmap.items():
+            b.inputs[p] = self.inputs[port]
+        for b in self.members:
+            out = b.output(t)
+            for p, dest, inport in self._internal[b]:
+                dest.inputs[inport] = out[p]
+
+    def _gather(self):
+        # input values of an ensemble, a row per simulation, signals that are
+        # the same for every simulation are repeated
+        N = self.bd.x.shape[0]
+        u = []
+        for value, w in zip(self.inputs, self.inports):
+            n = int(np.prod(self._shapes[w.end.block, w.end.port]))
+            u.append(np.broadcast_to(np.reshape(value, (-1, n)), (N, n)))
+        return np.hstack(u)
+
+    @staticmethod
+    def _linearmap(b, shapes):
+        """
+        Find the linear map computed by a function block
+
+        :param b: function block
+        :type b: Block
+        :param shapes: shapes of the values on its input ports
+        :type shapes: list of tuple
+        :return: matrix and shapes of the values on its output ports, or None
+        :rtype: ndarray(m,n), list of tuple
+
+        The block is evaluated with zero input, and with each element of its
+        flattened input set to one in turn, giving the columns of the matrix.
+        The block is linear if the output for zero input is zero, and the
+        matrix gives the output for an arbitrary input.  Only real scalars
+        and vectors are considered.
+        """
+        if any([len(s) > 1 for s in shapes]):
+            return None
+        sizes = [int(np.prod(s)) for s in shapes]
+
+        def evaluate(z):
+            # the outputs of b for the flattened inputs z
+            inputs = []
+            k = 0
+            for s, m in zip(shapes, sizes):
+                inputs.append(z[k] if s == () else z[k:k + m].copy())
+                k += m
+            b.inputs = inputs
+            out = b.output(0.0)
+            return out, np.concatenate([np.ravel(v) for v in out])
+
+        saved = b.inputs
+        n = sum(sizes)
+        try:
+            out, y0 = evaluate(np.zeros((n,)))
+            if y0.dtype.kind not in 'biuf' or any([np.ndim(v) > 1 for v in out]) \
+                    or np.any(y0 != 0):
+                return None
+            L = np.zeros((len(y0), n))
+            for j, e in enumerate(np.eye(n)):
+                L[:, j] = evaluate(e)[1]
+            z = np.linspace(-1.3, 2.9, n)
+            if not np.allclose(evaluate(z)[1], L @ z):
+                return None
+        except Exception:
+            return None
+        finally:
+            b.inputs = saved
+        return L, [np.shape(v) for v in out]
+
+    @staticmethod
+    def _sparse(M):
+        # keep large, mostly zero, matrices in sparse form
+        if M.size >= 1024 and np.count_nonzero(M) <= 0.1 * M.size:
+            return scipy.sparse.csr_matrix(M)
+        return M
+
 
 class SubsystemBlock(Block):
     """
@@ -0,0 +1,122 @@
+"""
+Run parameter sweeps of a block diagram across a pool of processes.
+
+A ``BlockDiagram`` cannot be sent to another process, it holds bound factory
+methods, and blocks may hold lambdas and references to global state.  Instead
+each worker process calls a user supplied function to build its own copy of
+the diagram, once, and then runs any number of parameter points with it.  Only
+the parameter values and the simulation results cross process boundaries.
+"""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+_worker = None  # (diagram, parameter keys, run options) of this worker process
+
+
+def sweep(build, grid, workers=None, T=10.0, dt=0.1, solver='RK45', watch=[], **kwargs):
+    """
+    Run a block diagram over a grid of parameter values in parallel
+
+    :param build: function that returns a block diagram
+    :type build: callable
+    :param grid: parameter values to simulate
+    :type grid: dict
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :type workers: int, optional
+    :param T: maximum integration time, defaults to 10.0
+    :type T: float, optional
+    :param dt: maximum time step, defaults to 0.1
+    :type dt: float, optional
+    :param solver: integration method, defaults to ``RK45``
+    :type solver: str, optional
+    :param watch: list of input ports to log, given by name
+    :type watch: list of str
+    :param ``**kwargs``: passed to ``BlockDiagram.run``
+    :return: simulation results for every point of the grid
+    :rtype: dict
+
+    ``grid`` is a dictionary that maps a block parameter, a string of the
+    form "block.attribute", to a list of values.  Every combination of values
+    is simulated, and the results are returned in a dictionary keyed by the
+    tuple of parameter values, in the same order as the keys of ``grid``.
+    Values that cannot be keys, such as arrays, are replaced by their index
+    in their list, as are the values of a list that holds equal values.  The
+    parameter values of a point are also held in the ``params`` attribute of
+    its results, a dictionary keyed like ``grid``.  For example::
+
+        def build():
+            bd = bdsim.BlockDiagram(sysargs=False)
+            ...
+            return bd
+
+        results = bdsim.sweep(build, {'K.gain': [1, 2, 5], 'plant.A': [A1, A2]})
+        out = results[5, 0]  # K.gain = 5 and plant.A = A1
+        out.params['plant.A']  # A1
+
+    ``build`` is called once in every worker process.  It must be picklable,
+    ie. defined at module level, and must construct the diagram without
+    reference to the command line, using ``sysargs=False``.  The diagram is
+    compiled if ``build`` did not do so.  Graphics, animation and the
+    progress bar are disabled in the workers.
+
+    Parameters are set on the blocks before each run, so only parameters
+    that are read during simulation can be swept.  The value of a point is
+    None if its simulation failed, the error is printed by the worker.
+    """
+    keys = list(grid.keys())
+    values = [list(v) for v in grid.values()]
+    points = list(itertools.product(*values))
+    labels = [v if _haskeys(v) else range(len(v)) for v in values]
+    labels = list(itertools.product(*labels))
+    options = dict(T=T, dt=dt, solver=solver, watch=watch, **kwargs)
+
+    if workers is None:
+        workers = os.cpu_count()
+    chunksize = max(1, len(points) // (4 * workers))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initworker,
+                             initargs=(build, keys, options)) as executor:
+        results = list(executor.map(_runpoint, points, chunksize=chunksize))
+
+    for point, out in zip(points, results):
+        if out is not None:
+            out.params = dict(zip(keys, point))
+    return dict(zip(labels, results))
+
+
+def _haskeys(values):
+    # the values can be the keys of a dictionary, and are all different
+    try:
+        return len(set(values)) == len(values)
+    except TypeError:
+        return False
+
+
+def _initworker(build, keys, options):
+    # build the diagram for this worker process
+    global _worker
+
+    bd = build()
+    bd.options = bd.options._replace(graphics=False, animation=False, progress=False)
+    if not bd.compiled:
+        bd.compile()
+    keys = [bd._parameter(key) for key in keys]
+    _worker = (bd, keys, options)
+
+
+def _runpoint(point):
+    # simulate one point of the grid in a worker process
+    bd, keys, options = _worker
+
+    for (block, attr), value in zip(keys, point):
+        setattr(block, attr, value)
+    try:
+        return bd.run(**options)
+    except Exception as err:
+        # the other points are still simulated
+        print('simulation failed at {:s}: {}'.format(
+            ', '.join(['{:s}.{:s}={}'.format(block.name, attr, value)
+                        for (block, attr), value in zip(keys, point)]), err))
+        return None
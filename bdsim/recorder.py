@@ -0,0 +1,416 @@
+"""
+Recording of simulation results.
+
+A simulation records the time, the state and the watched signals at every
+step, or at every sample time.  Appending these to Python lists and
+converting them to arrays at the end boxes every scalar, and the lists and
+the arrays both exist at the end of the run.  A ``Recorder`` instead writes
+each value into a preallocated numpy array, which grows geometrically when
+the number of samples is not known in advance, and the arrays are trimmed
+in place and returned as the results.
+
+For a simulation whose results do not fit in memory, ``writer`` returns a
+recorder that writes the values to disk in chunks, to an HDF5 file or to a
+directory of ``.npy`` files, and ``load`` reads them back lazily.
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+from bdsim.components import Struct
+
+
+class Recorder:
+    """
+    Record values into preallocated arrays
+
+    :param n: number of samples, if known, defaults to None
+    :type n: int, optional
+    :param chunk: initial number of samples if ``n`` is not known, defaults to 1024
+    :type chunk: int, optional
+
+    Each channel is declared by ``add``, and ``append`` then records a
+    sample of every channel.  A channel is stored in an array with a row
+    per sample.  When the arrays are full their length is doubled, so the
+    cost of growing is spread over the samples.
+
+    Integer and boolean values are recorded as float in case later values
+    are not integers, and values that are not numeric are recorded in an
+    array of objects.
+    """
+
+    def __init__(self, n=None, chunk=1024):
+        self.names = []
+        self.n = 0  # number of samples recorded
+        self._capacity = n if n is not None else chunk
+        self._initial = self._capacity
+        self._arrays = []
+        self._specs = []
+
+    def add(self, name, shape=None, dtype=None):
+        """
+        Add a channel
+
+        :param name: name of the channel
+        :type name: str
+        :param shape: shape of each value, defaults to None
+        :type shape: tuple, optional
+        :param dtype: type of each value, defaults to float
+        :type dtype: numpy.dtype, optional
+
+        If ``shape`` is None, the shape and type are those of the first
+        value.  Channels must be added before the first sample is appended.
+        """
+        if self.n > 0:
+            raise RuntimeError('cannot add a channel after recording has started')
+        self.names.append(name)
+        self._specs.append((shape, dtype))
+        self._arrays.append(None)
+
+    def append(self, *values):
+        """
+        Record a sample of every channel
+
+        :param ``*values``: a value for each channel, in the order they were added
+        """
+        k = self.n
+        if k == self._capacity:
+            self._grow()
+        arrays = self._arrays
+        for i, value in enumerate(values):
+            a = arrays[i]
+            if a is None:
+                a = arrays[i] = self._allocate(i, value)
+            a[k] = value
+        self.n = k + 1
+
+    def arrays(self):
+        """
+        The recorded values
+
+        :return: an array for each channel, with a row per sample
+        :rtype: dict
+
+        The unused rows of the arrays are dropped in place, and the recorder
+        is then empty.
+        """
+        out = {}
+        for i, name in enumerate(self.names):
+            a = self._arrays[i]
+            self._arrays[i] = None
+            if a is None:
+                # there are no samples
+                a = self._allocate(i, None)
+            elif a.shape[0] != self.n:
+                try:
+                    # in place, unless there are other references to it
+                    a.resize((self.n,) + a.shape[1:])
+                except ValueError:
+                    a = a[:self.n].copy()
+            out[name] = a
+        self._arrays = [None] * len(self.names)
+        self._capacity = self._initial
+        self.n = 0
+        return out
+
+    def _allocate(self, i, value):
+        # an array for the samples of channel i, allocated when its first
+        # value is known
+        shape, dtype = self._specs[i]
+        if shape is None:
+            value = np.asarray(value if value is not None else np.nan)
+            shape, dtype = value.shape, value.dtype
+        dtype = np.dtype(dtype)
+        if dtype.kind in 'biu':
+            dtype = np.dtype(np.float64)
+        elif dtype.kind not in 'fc':
+            dtype = np.dtype(object)
+        return np.empty((self._capacity,) + tuple(shape), dtype=dtype)
+
+    def _grow(self):
+        # double the length of the arrays
+        n = self._capacity
+        self._capacity = max(2 * n, 1)
+        for i in range(len(self._arrays)):
+            a = self._arrays[i]
+            if a is not None:
+                # in place, unless there are other references to it, such as
+                # views, whose memory would be freed
+                self._arrays[i] = None
+                try:
+                    a.resize((self._capacity,) + a.shape[1:])
+                except ValueError:
+                    b = np.empty((self._capacity,) + a.shape[1:], dtype=a.dtype)
+                    b[:n] = a
+                    a = b
+                self._arrays[i] = a
+
+
+class LogPolicy:
+    """
+    Choose the samples of a signal to record
+
+    :param every: record every k'th sample, defaults to None
+    :type every: int, optional
+    :param period: record at most once per interval of simulation time,
+                   defaults to None
+    :type period: float, optional
+    :param change: record only when the value changes, defaults to False
+    :type change: bool, optional
+
+    The object is called with the time and value of each sample, and
+    returns True if it should be recorded.  The first sample is always
+    recorded.  With ``period`` a sample is recorded at the first step at
+    or after each multiple of the period.  With ``change`` a sample is
+    recorded when its value differs from the last recorded value, which
+    suits piecewise constant signals such as the outputs of ``STEP`` or
+    ``PIECEWISE``.  If several options are given, a sample is recorded if
+    it satisfies them all.
+    """
+
+    def __init__(self, every=None, period=None, change=False):
+        if every is not None and (int(every) != every or every < 1):
+            raise ValueError('every must be a positive integer')
+        if period is not None and period <= 0:
+            raise ValueError('period must be positive')
+        self.every = every
+        self.period = period
+        self.change = change
+        self._count = 0     # number of samples offered
+        self._next = None   # time of the next sample for a period
+        self._last = None   # last value recorded
+
+    def __call__(self, t, value):
+        k = self._count
+        self._count += 1
+        if self.every is not None and k % self.every != 0:
+            return False
+        if self.period is not None and self._next is not None \
+                and t < self._next - 1e-9 * self.period:
+            return False
+        if self.change and self._last is not None and np.array_equal(value, self._last):
+            return False
+
+        if self.period is not None:
+            # the next multiple of the period, allowing for rounding of the
+            # times of the samples
+            self._next = (np.floor(t / self.period + 1e-9) + 1) * self.period
+        if self.change:
+            # the value may be a view that will be overwritten
+            self._last = np.array(value)
+        return True
+
+
+class FileRecorder(Recorder):
+    """
+    Record values to a file
+
+    :param path: name of the file or directory
+    :type path: str
+    :param chunk: number of samples written at a time, defaults to 4096
+    :type chunk: int, optional
+    :param attrs: other results, saved with the values, defaults to {}
+    :type attrs: dict, optional
+
+    The values are buffered in arrays of ``chunk`` samples, which are
+    written when they are full, so the memory used does not depend on the
+    number of samples.  ``arrays`` writes the remaining samples and returns
+    arrays that are read from the file on demand.  Values that are not
+    numeric cannot be recorded.  ``close`` finishes the file without
+    returning the arrays, for example if the simulation failed.
+
+    Subclasses write the samples with ``_write`` and finish the file with
+    ``_close``.
+    """
+
+    def __init__(self, path, chunk=4096, attrs={}):
+        super().__init__(n=chunk)
+        self.path = str(path)
+        self.attrs = dict(attrs)
+        self.written = 0  # number of samples written
+        self.closed = False
+
+    def append(self, *values):
+        if self.n == self._capacity:
+            self._flush()
+        super().append(*values)
+
+    def arrays(self):
+        self.close()
+        out = load(self.path)
+        return {name: out[name] for name in self.names}
+
+    def close(self):
+        """
+        Write the remaining samples and finish the file
+
+        The file can then be read by ``load``.  Closing a recorder that is
+        already closed has no effect.
+        """
+        if self.closed:
+            return
+        self._flush()
+        for i in range(len(self.names)):
+            if self._arrays[i] is None:
+                # there are no samples
+                self._arrays[i] = self._allocate(i, None)[:0]
+        self._close()
+        self.closed = True
+
+    def _allocate(self, i, value):
+        a = super()._allocate(i, value)
+        if a.dtype.kind == 'O':
+            raise ValueError('cannot record values of {:s} to a file, they are not numeric'.format(self.names[i]))
+        return a
+
+    def _flush(self):
+        # write the buffered samples
+        if self.n > 0:
+            self._write(self.n)
+            self.written += self.n
+            self.n = 0
+
+
+class NpyRecorder(FileRecorder):
+    """
+    Record values to a directory of ``.npy`` files
+
+    Each channel is written to a file ``name.npy`` that ``numpy.load`` can
+    map into memory.  The file ``index.json`` lists the channels and holds
+    the other results.
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        os.makedirs(self.path, exist_ok=True)
+        self._files = {}
+
+    def _write(self, n):
+        for name, a in zip(self.names, self._arrays):
+            f = self._files.get(name)
+            if f is None:
+                # the header is written when the number of samples is known
+                f = self._files[name] = open(os.path.join(self.path, name + '.npy'), 'wb')
+                f.write(_npyheader(a.dtype, a.shape[1:], None))
+            f.write(np.ascontiguousarray(a[:n]).data)
+
+    def _close(self):
+        for name, a in zip(self.names, self._arrays):
+            f = self._files.pop(name, None)
+            if f is None:
+                np.save(os.path.join(self.path, name + '.npy'), a)
+            else:
+                f.seek(0)
+                f.write(_npyheader(a.dtype, a.shape[1:], self.written))
+                f.close()
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump({'channels': self.names, 'n': self.written, 'attrs': self.attrs}, f)
+
+
+class HDF5Recorder(FileRecorder):
+    """
+    Record values to an HDF5 file
+
+    Each channel is a dataset in the file, that grows by a chunk at a time,
+    and the other results are attributes of the file.  Requires ``h5py``.
+    """
+
+    def __init__(self, path, chunk=4096, **kwargs):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('h5py is required to record to an HDF5 file') from None
+        super().__init__(path, chunk=chunk, **kwargs)
+        self._file = h5py.File(self.path, 'w')
+        for key, value in self.attrs.items():
+            self._file.attrs[key] = json.dumps(value)
+
+    def _write(self, n):
+        for name, a in zip(self.names, self._arrays):
+            if name not in self._file:
+                self._file.create_dataset(name, shape=(0,) + a.shape[1:], dtype=a.dtype,
+                    maxshape=(None,) + a.shape[1:], chunks=(self._capacity,) + a.shape[1:])
+            dataset = self._file[name]
+            dataset.resize(self.written + n, axis=0)
+            dataset[self.written:] = a[:n]
+
+    def _close(self):
+        for name, a in zip(self.names, self._arrays):
+            if name not in self._file:
+                self._file.create_dataset(name, data=a)
+        self._file.attrs['channels'] = json.dumps(self.names)
+        self._file.close()
+
+
+def writer(path, **kwargs):
+    """
+    Create a recorder that writes to disk
+
+    :param path: name of an HDF5 file, or of a directory
+    :type path: str
+    :param ``**kwargs``: options for ``FileRecorder``
+    :return: recorder
+    :rtype: FileRecorder
+
+    A ``path`` ending in ``.h5`` or ``.hdf5`` is an HDF5 file if ``h5py`` is
+    installed, anything else is a directory of ``.npy`` files.  Without
+    ``h5py`` the directory has the name of the HDF5 file, ``load`` reads
+    either.
+    """
+    if str(path).endswith(('.h5', '.hdf5')):
+        try:
+            import h5py
+        except ImportError:
+            pass
+        else:
+            return HDF5Recorder(path, **kwargs)
+    return NpyRecorder(path, **kwargs)
+
+
+def load(path):
+    """
+    Load results that were recorded to disk
+
+    :param path: name of an HDF5 file, or of a directory
+    :type path: str
+    :return: recorded values and other results
+    :rtype: Struct
+
+    The values are not read into memory.  They are memory mapped arrays for
+    a directory of ``.npy`` files, or ``h5py`` datasets for an HDF5 file, which
+    stays open for reading, and are read when they are indexed.
+    """
+    out = Struct('results')
+    path = str(path)
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        for name in index['channels']:
+            filename = os.path.join(path, name + '.npy')
+            # an empty array cannot be mapped
+            out[name] = np.load(filename, mmap_mode='r' if index['n'] > 0 else None)
+        out.update(index['attrs'])
+    else:
+        import h5py
+        f = h5py.File(path, 'r')
+        for name in json.loads(f.attrs['channels']):
+            out[name] = f[name]
+        for key, value in f.attrs.items():
+            if key != 'channels':
+                out[key] = json.loads(value)
+    return out
+
+
+def _npyheader(dtype, shape, n):
+    # the header of a .npy file of n samples, padded to the length of the
+    # header for any number of samples so that it can be written before the
+    # number is known, and then overwritten
+    def header(n):
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), (n,) + tuple(shape))
+    # magic string, version 1.0, header length, header and newline, aligned to 64 bytes
+    size = -(-(10 + len(header(10 ** 19)) + 1) // 64) * 64
+    text = header(0 if n is None else n).ljust(size - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', size - 10) + text.encode('latin1')
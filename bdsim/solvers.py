@@ -0,0 +1,271 @@
+"""
+Fixed-step integrators for simulating block diagrams.
+
+The ``scipy.integrate`` solvers choose their step size adaptively, and for
+small systems their per-step overhead is much greater than the cost of
+evaluating the diagram.  The explicit Runge-Kutta methods here take steps of
+a fixed size, keep their stages in preallocated arrays, and call the
+derivative function of the diagram directly.
+
+The integrators have the parts of the ``scipy.integrate.OdeSolver``
+interface that ``BlockDiagram.run`` uses: the attributes ``t``, ``t_old``,
+``y`` and ``status``, and the methods ``step`` and ``dense_output``.
+"""
+
+import numpy as np
+import scipy.integrate
+
+
+class RungeKutta:
+    """
+    Explicit Runge-Kutta integrator with a fixed step size
+
+    :param fun: derivative function ``fun(y, t)``
+    :type fun: callable
+    :param t0: initial time
+    :type t0: float
+    :param y0: initial state
+    :type y0: array_like(n)
+    :param t_bound: final time
+    :type t_bound: float
+    :param h: step size
+    :type h: float
+
+    The array returned by ``fun`` is copied, so it can be overwritten by the
+    next call.  The final step is shortened to end at ``t_bound``.
+
+    Subclasses define the Butcher tableau of the method: the rows ``A`` of
+    the Runge-Kutta matrix, the weights ``B`` and the nodes ``C``.  If
+    ``FSAL`` is True the last stage is evaluated at the end of the step,
+    and is the first stage of the next step.
+
+    ``P`` holds the coefficients of the interpolant within a step, the weight
+    of stage i at the fraction s of the step is the polynomial
+    ``P[i,0] s + P[i,1] s**2 + ...``.
+    """
+
+    A = None
+    B = None
+    C = None
+    P = None
+    FSAL = False
+
+    def __init__(self, fun, t0, y0, t_bound, h):
+        if h <= 0:
+            raise ValueError('step size must be positive')
+        self.fun = fun
+        self.t = t0
+        self.t_old = None
+        self.y = np.array(y0, dtype=float)
+        self.y_old = None
+        self.t_bound = t_bound
+        self.h = h
+        self.status = 'running' if t0 < t_bound else 'finished'
+        self.nfev = 0
+
+        self._t0 = t0
+        self._nsteps = 0
+        self._K = np.zeros((len(self.C),) + self.y.shape)  # stage derivatives
+        self._ystage = np.zeros(self.y.shape)              # state at a stage
+        self._fsal = False  # the first stage is the last stage of the previous step
+
+    def step(self):
+        """
+        Take one step
+
+        ``t`` and ``y`` are updated.  ``y`` is a new array, so previous values
+        can be kept.
+        """
+        if self.status != 'running':
+            raise RuntimeError('attempt to step an integrator that is not running')
+
+        # compute the time from the step count so that error does not accumulate
+        t = self.t
+        tnew = self._t0 + (self._nsteps + 1) * self.h
+        if tnew > self.t_bound - 1e-9 * self.h:
+            tnew = self.t_bound
+        h = tnew - t
+
+        fun = self.fun
+        K = self._K
+        y = self.y
+        ystage = self._ystage
+        nstages = len(self.C)
+        if self._fsal:
+            K[0] = K[-1]
+        else:
+            K[0] = fun(y, t)
+            self.nfev += 1
+        for i in range(1, nstages - 1 if self.FSAL else nstages):
+            np.dot(self.A[i], K[:i], out=ystage)
+            ystage *= h
+            ystage += y
+            K[i] = fun(ystage, t + self.C[i] * h)
+            self.nfev += 1
+
+        # the new state, the weight of the last stage of an FSAL method is zero
+        ynew = np.dot(self.B, K)
+        ynew *= h
+        ynew += y
+
+        if self.FSAL:
+            K[-1] = fun(ynew, tnew)
+            self.nfev += 1
+            self._fsal = True
+
+        self.t_old = t
+        self.t = tnew
+        self.y_old = y
+        self.y = ynew
+        self._nsteps += 1
+        if tnew >= self.t_bound:
+            self.status = 'finished'
+
+
+    def dense_output(self):
+        """
+        Interpolant for the last step
+
+        :return: interpolant
+        :rtype: RungeKuttaDenseOutput
+        """
+        if self.t_old is None:
+            raise RuntimeError('dense output is not available before the first step')
+        return RungeKuttaDenseOutput(self.t_old, self.t, self.y_old, self._K.T @ self.P)
+
+
+class RungeKuttaDenseOutput:
+    """
+    Interpolant for a step of a Runge-Kutta method
+
+    :param t_old: time at the start of the step
+    :type t_old: float
+    :param t: time at the end of the step
+    :type t: float
+    :param y_old: state at the start of the step
+    :type y_old: ndarray(n)
+    :param Q: coefficients of the polynomial in the step fraction
+    :type Q: ndarray(n,m)
+
+    Calling the object with a time in the step returns the state at that
+    time.
+    """
+
+    def __init__(self, t_old, t, y_old, Q):
+        self.t_old = t_old
+        self.t = t
+        self.h = t - t_old
+        self.y_old = y_old
+        self.Q = Q
+        self._powers = np.arange(1, Q.shape[1] + 1)
+
+    def __call__(self, t):
+        s = (t - self.t_old) / self.h
+        return self.y_old + self.h * (self.Q @ s ** self._powers)
+
+
+class Euler(RungeKutta):
+    """
+    Forward Euler method, first order
+    """
+    A = [np.zeros((0,))]
+    B = np.r_[1.0]
+    C = np.r_[0.0]
+    P = np.array([[1.0]])
+
+
+class Heun(RungeKutta):
+    """
+    Heun's method, second order
+    """
+    A = [np.zeros((0,)), np.r_[1.0]]
+    B = np.r_[1/2, 1/2]
+    C = np.r_[0.0, 1.0]
+    P = np.array([[1, -1/2],
+                  [0, 1/2]])
+
+
+class RK4(RungeKutta):
+    """
+    Classic fourth order Runge-Kutta method
+    """
+    A = [np.zeros((0,)), np.r_[1/2], np.r_[0, 1/2], np.r_[0, 0, 1.0]]
+    B = np.r_[1/6, 1/3, 1/3, 1/6]
+    C = np.r_[0.0, 1/2, 1/2, 1.0]
+    P = np.array([[1, -3/2, 2/3],
+                  [0, 1, -2/3],
+                  [0, 1, -2/3],
+                  [0, -1/2, 2/3]])
+
+
+class DormandPrince(RungeKutta):
+    """
+    Dormand-Prince method, fifth order
+
+    This is the method of ``scipy.integrate.RK45``, and its interpolant,
+    without the error estimate.  It has six derivative evaluations per
+    step.
+    """
+    A = [np.zeros((0,)),
+         np.r_[1/5],
+         np.r_[3/40, 9/40],
+         np.r_[44/45, -56/15, 32/9],
+         np.r_[19372/6561, -25360/2187, 64448/6561, -212/729],
+         np.r_[9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+         np.r_[35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+    B = np.r_[35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0]
+    C = np.r_[0, 1/5, 3/10, 4/5, 8/9, 1, 1]
+    P = np.array([
+        [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+        [0, 0, 0, 0],
+        [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+        [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+        [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+        [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+        [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+    FSAL = True
+
+
+#: fixed-step integrators by name
+fixedstep = {
+    'euler': Euler,
+    'heun': Heun,
+    'rk4': RK4,
+    'dopri5': DormandPrince,
+}
+
+
+def integrator(solver, fun, t0, y0, t_bound, dt, **kwargs):
+    """
+    Create an integrator
+
+    :param solver: integration method
+    :type solver: str
+    :param fun: derivative function ``fun(y, t)``
+    :type fun: callable
+    :param t0: initial time
+    :type t0: float
+    :param y0: initial state
+    :type y0: array_like(n)
+    :param t_bound: final time
+    :type t_bound: float
+    :param dt: step size of a fixed-step method, else the maximum step size
+    :type dt: float
+    :param ``**kwargs``: passed to the ``scipy.integrate`` solver
+    :return: integrator
+    :rtype: RungeKutta or scipy.integrate.OdeSolver
+
+    ``solver`` is the name of a fixed-step method in ``fixedstep``, or of a
+    ``scipy.integrate`` solver such as ``RK45``.  The array returned by
+    ``fun`` may be overwritten by its next call.
+    """
+    if solver in fixedstep:
+        if len(kwargs) > 0:
+            raise ValueError('unknown options for fixed-step solver: ' + ', '.join(kwargs.keys()))
+        return fixedstep[solver](fun, t0, y0, t_bound, dt)
+
+    scipy_integrator = scipy.integrate.__dict__[solver]  # get user specified integrator
+
+    # the integrator keeps references to derivatives, so copy it
+    return scipy_integrator(lambda t, y: fun(y, t).copy(),
+                            t0=t0, y0=y0, t_bound=t_bound, max_step=dt, **kwargs)
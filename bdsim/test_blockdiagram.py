@@ -3,17 +3,1125 @@
 import numpy as np
 import scipy.interpolate
 import math
+import itertools
+import os
+import sys
+import tempfile
+import tracemalloc
 
 import bdsim
+from bdsim.components import FunctionBlock, TransferBlock, SinkBlock
 import unittest
+import unittest.mock
 import numpy.testing as nt
 
 
+def _sweep_diagram():
+    # built in the worker processes of a sweep
+    bd = bdsim.BlockDiagram(sysargs=False)
+    gain = bd.GAIN(1, name='K')
+    int1 = bd.INTEGRATOR(x0=0, name='int')
+    bd.connect(bd.CONSTANT(1, name='c'), gain)
+    bd.connect(gain, int1)
+    bd.connect(int1, bd.OUTPORT(1))
+    return bd
+
+def _sweep_vector_diagram():
+    # the gain of a sweep is a matrix
+    bd = bdsim.BlockDiagram(sysargs=False)
+    gain = bd.GAIN(np.eye(2), name='K')
+    int1 = bd.INTEGRATOR(x0=np.r_[0.0, 0.0])
+    bd.connect(bd.CONSTANT(np.r_[1.0, 1.0]), gain)
+    bd.connect(gain, int1)
+    bd.connect(int1, bd.OUTPORT(1))
+    return bd
+
+class _Scale(FunctionBlock):
+    # gain block that does not allocate
+    def __init__(self, k, **kwargs):
+        super().__init__(nin=1, nout=1, **kwargs)
+        self.type = 'scale'
+        self.k = k
+        self._out = [0.0]
+
+    def output(self, t=None):
+        self._out[0] = self.k * self.inputs[0]
+        return self._out
+
+class _Integrate(TransferBlock):
+    # integrator block that does not allocate
+    def __init__(self, **kwargs):
+        super().__init__(nin=1, nout=1, **kwargs)
+        self.type = 'integrate'
+        self.nstates = 1
+        self._x0 = np.r_[1.0]
+        self._out = [0.0]
+        self._xd = np.zeros((1,))
+
+    def output(self, t=None):
+        self._out[0] = self._x[0]
+        return self._out
+
+    def deriv(self):
+        self._xd[0] = self.inputs[0]
+        return self._xd
+
+class _Clock(FunctionBlock):
+    # the time, a source like INTERPOLATE(time=True)
+    blockclass = 'source'
+
+    def __init__(self, **kwargs):
+        super().__init__(nin=0, nout=1, **kwargs)
+        self.type = 'clock'
+
+    def output(self, t=None):
+        return [t]
+
+class _Fail(SinkBlock):
+    # a sink that raises an error that is not a RuntimeError after a time
+    def __init__(self, after=1, **kwargs):
+        super().__init__(nin=1, **kwargs)
+        self.type = 'fail'
+        self.after = after
+
+    def step(self):
+        if self.bd.t > self.after:
+            raise ValueError('failed')
+
+def _sweep_fail_diagram():
+    # some points of a sweep fail
+    bd = bdsim.BlockDiagram(sysargs=False)
+    int1 = bd.INTEGRATOR(x0=0)
+    fail = _Fail(name='fail')
+    bd.add_block(fail)
+    bd.connect(bd.CONSTANT(1), int1)
+    bd.connect(int1, fail)
+    return bd
+
 class BlockTest(unittest.TestCase):
     pass
 
 class BlockDiagramTest(unittest.TestCase):
-    pass
+
+    def test_schedule(self):
+
+        bd = bdsim.BlockDiagram()
+
+        # create blocks in reverse order of data flow
+        dst = bd.OUTPORT(1)
+        g2 = bd.GAIN(4)
+        g1 = bd.GAIN(3)
+        src = bd.CONSTANT(2)
+
+        bd.connect(src, g1)
+        bd.connect(g1, g2)
+        bd.connect(g2, dst)
+        bd.compile()
+
+        self.assertEqual(bd.schedule, [src, g1, g2])
+        self.assertEqual(dst.inputs, [24])
+
+        bd.evaluate(x=[], t=0)
+        self.assertEqual(dst.inputs, [24])
+
+    def test_state(self):
+
+        bd = bdsim.BlockDiagram()
+
+        src = bd.CONSTANT(2)
+        int1 = bd.INTEGRATOR(x0=1)
+        lti = bd.LTI_SS(A=np.array([[1, 2], [3, 4]]), B=np.array([5, 6]), C=np.array([7, 8]), x0=[30, 40])
+        bd.connect(src, int1)
+        bd.connect(int1, lti)
+        bd.connect(lti, bd.OUTPORT(1))
+        bd.compile()
+
+        self.assertEqual(bd.nstates, 3)
+        nt.assert_equal(bd.getstate(), np.r_[1, 30, 40])
+
+        # stateful blocks see their slice of the state vector
+        xd = bd.evaluate(np.r_[10, 11, 12], t=0)
+        self.assertTrue(np.shares_memory(int1._x, bd.x))
+        self.assertTrue(np.shares_memory(lti._x, bd.x))
+        nt.assert_equal(int1._x, np.r_[10])
+        nt.assert_equal(lti._x, np.r_[11, 12])
+        nt.assert_equal(xd, np.r_[2, 1 * 11 + 2 * 12 + 5 * 10, 3 * 11 + 4 * 12 + 6 * 10])
+
+    def _codegen_diagram(self):
+        bd = bdsim.BlockDiagram()
+
+        demand = bd.STEP(T=1)
+        sum = bd.SUM('+-')
+        gain = bd.GAIN(10)
+        plant = bd.LTI_SISO(0.5, [2, 1])
+        bd.connect(demand, sum[0])
+        bd.connect(plant, sum[1])
+        bd.connect(sum, gain)
+        bd.connect(gain, plant)
+
+        const = bd.CONSTANT([2, 4])
+        demux = bd.DEMUX(2)
+        prod = bd.PROD('*/')
+        mux = bd.MUX(2)
+        dst = bd.OUTPORT(1)
+        bd.connect(const, demux)
+        bd.connect(demux[0], prod[0])
+        bd.connect(demux[1], prod[1])
+        bd.connect(prod, mux[0])
+        bd.connect(sum, mux[1])
+        bd.connect(mux, dst)
+        return bd, dst
+
+    def test_loops(self):
+
+        bd = bdsim.BlockDiagram()
+
+        sum = bd.SUM('+-')
+        gain1 = bd.GAIN(2)
+        gain2 = bd.GAIN(3)
+        bd.connect(bd.CONSTANT(1), sum[0])
+        bd.connect(sum, gain1)
+        bd.connect(gain1, gain2, bd.OUTPORT(1))
+        bd.connect(gain2, sum[1])
+
+        # a second loop, a block wired to itself
+        prod = bd.PROD('**')
+        bd.connect(bd.CONSTANT(1), prod[0])
+        bd.connect(prod, prod[1])
+
+        self.assertFalse(bd.compile())
+        self.assertEqual(len(bd.algebraic_loops), 2)
+        self.assertIn([sum, gain1, gain2, sum], bd.algebraic_loops)
+        self.assertIn([prod, prod], bd.algebraic_loops)
+
+    def test_algebraic(self):
+
+        bd = bdsim.BlockDiagram()
+
+        # y = 3 - 2 y
+        sum = bd.SUM('+-')
+        gain = bd.GAIN(2)
+        dst = bd.OUTPORT(1)
+        bd.connect(bd.CONSTANT(3), sum[0])
+        bd.connect(sum, gain, dst)
+        bd.connect(gain, sum[1])
+
+        # y = cos(y) + x, where x is the integral of y
+        func = bd.FUNCTION(lambda u, x: np.cos(u) + x, nin=2)
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(func, func[0], int1)
+        bd.connect(int1, func[1])
+
+        self.assertFalse(bd.compile())
+        self.assertTrue(bd.compile(algebraic=True))
+        self.assertEqual(len(bd.algebraic_loops), 2)
+        self.assertEqual(dst.inputs, [1])
+        self.assertAlmostEqual(func.inputs[0], 0.7390851332)
+
+        xd = bd.evaluate(np.r_[0.5], 0)
+        self.assertAlmostEqual(xd[0], np.cos(xd[0]) + 0.5)
+
+        # warm start reuses the previous solution
+        loop = [b for b in bd.schedule if b.type == 'algebraicloop' and func in b.members][0]
+        self.assertAlmostEqual(loop._z[0], xd[0])
+
+        bd.compile(algebraic=True, codegen=True)
+        evaluate = bd._codemaker(bd, bd._codeblocks)
+        nt.assert_almost_equal(evaluate(np.r_[1.0], 0), bd.evaluate(np.r_[1.0], 0))
+        nt.assert_almost_equal(dst.inputs, [1])
+
+    def test_loops_feedforward(self):
+
+        # every block feeds the next two, 2**40 paths through the diagram
+        bd = bdsim.BlockDiagram()
+        blocks = [bd.CONSTANT(1)] + [bd.SUM('++') for i in range(40)]
+        bd.connect(blocks[0], blocks[1][0], blocks[1][1], blocks[2][0])
+        for i in range(1, 39):
+            bd.connect(blocks[i], blocks[i + 1][1], blocks[i + 2][0])
+        bd.connect(blocks[39], blocks[40][1])
+        bd.connect(blocks[40], bd.OUTPORT(1))
+
+        self.assertTrue(bd.compile())
+        self.assertEqual(bd.algebraic_loops, [])
+
+    def test_derivschedule(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+
+        int1 = bd.INTEGRATOR(x0=0)
+        gain1 = bd.GAIN(2)
+        gain2 = bd.GAIN(3)
+        bd.connect(bd.CONSTANT(1), int1)
+        bd.connect(int1, gain1)
+        bd.connect(gain1, gain2)
+        bd.connect(gain2, bd.OUTPORT(1))
+        bd.compile()
+
+        self.assertEqual(bd.schedule[-2:], [gain1, gain2])
+        self.assertNotIn(gain1, bd._derivschedule)
+
+        bd.evaluate(np.r_[1.0], 0, outputs=False)
+        self.assertEqual(gain2.inputs[0], 0)
+        bd.evaluate(np.r_[1.0], 0)
+        self.assertEqual(gain2.inputs[0], 2)
+
+        # watched values correspond to the accepted steps
+        out = bd.run(T=1, watch=[gain2])
+        nt.assert_almost_equal(out.u0, 2 * out.x[:, 0])
+
+    def test_fold(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+
+        const = bd.CONSTANT(2)
+        gain1 = bd.GAIN(3)
+        step = bd.STEP(T=1)
+        gain2 = bd.GAIN(4)
+        sum = bd.SUM('++')
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(const, gain1)
+        bd.connect(step, gain2)
+        bd.connect(gain1, sum[0])
+        bd.connect(gain2, sum[1])
+        bd.connect(sum, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+
+        # constant subgraphs are folded, time dependent blocks are cached
+        self.assertEqual(bd._folded, [const, gain1])
+        self.assertEqual(bd._timed[0], [step, gain2, sum])
+        self.assertEqual(bd._untimed[0], [int1])
+
+        nt.assert_equal(bd.evaluate(np.r_[0.0], 0, outputs=False), np.r_[6])
+        nt.assert_equal(bd.evaluate(np.r_[0.0], 2, outputs=False), np.r_[10])
+
+        # cached values are recomputed when the time changes
+        gain2.inputs[0] = None
+        nt.assert_equal(bd.evaluate(np.r_[1.0], 2, outputs=False), np.r_[10])
+        self.assertIsNone(gain2.inputs[0])
+        nt.assert_equal(bd.evaluate(np.r_[1.0], 0, outputs=False), np.r_[6])
+        self.assertEqual(gain2.inputs[0], 0)
+
+        # changed parameters are folded again at the start of a run
+        gain1.gain = 5
+        out = bd.run(T=2)
+        nt.assert_allclose(out.x[-1], [2 * 10 + 4], rtol=1e-3)
+
+        bd.compile(codegen=True)
+        evaluate = bd._codemaker(bd, bd._codeblocks)
+        for t in [0, 2]:
+            nt.assert_equal(evaluate(np.r_[0.0], t), bd.evaluate(np.r_[0.0], t).copy())
+
+        # user defined blocks are not folded or cached unless declared pure
+        bd = bdsim.BlockDiagram(progress=False)
+        scale = _Scale(2)
+        clock = _Clock()
+        bd.add_block(scale)
+        bd.add_block(clock)
+        sum = bd.SUM('++')
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), scale)
+        bd.connect(scale, sum[0])
+        bd.connect(clock, sum[1])
+        bd.connect(sum, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        self.assertNotIn(scale, bd._folded)
+        self.assertNotIn(clock, bd._timed[0])
+        self.assertEqual(set(bd._untimed[0]), {scale, clock, sum, int1})
+
+        scale.pure = clock.pure = True
+        bd.compile()
+        self.assertIn(scale, bd._folded)
+        self.assertEqual(bd._timed[0], [clock, sum])
+
+    def test_checks(self):
+
+        def diagram(debug):
+            bd = bdsim.BlockDiagram(progress=False, debug=debug)
+            ramp = bd.INTEGRATOR(x0=0)
+            # output changes shape after t=1
+            func = bd.FUNCTION(lambda u: np.r_[u, u] if u < 1 else np.r_[u, u, u])
+            demux = bd.DEMUX(2)
+            int1 = bd.INTEGRATOR(x0=0)
+            bd.connect(bd.CONSTANT(1), ramp)
+            bd.connect(ramp, func)
+            bd.connect(func, demux)
+            bd.connect(demux[0], int1)
+            bd.compile()
+            return bd, func
+
+        # wire types are recorded at compile time
+        bd, func = diagram('')
+        w = func.outports[0][0]
+        self.assertIs(w.type, np.ndarray)
+        self.assertEqual(w.dtype, np.float64)
+        self.assertEqual(w.shape, (2,))
+        w = bd.blocknames['demux.0'].outports[0][0]
+        self.assertEqual(w.shape, ())
+
+        # release mode does not check block inputs or outputs
+        out = bd.run(T=2)
+        self.assertIsNotNone(out)
+        nt.assert_allclose(out.x[-1], [2.0, 2.0], rtol=1e-3)
+
+        # debug mode finds the change of shape
+        bd, func = diagram('c')
+        self.assertIsNone(bd.run(T=2))
+
+        # inputs are always checked at compile time
+        bd = bdsim.BlockDiagram(progress=False)
+        demux = bd.DEMUX(3)
+        bd.connect(bd.CONSTANT(np.r_[1, 2]), demux)
+        bd.connect(demux[0], bd.INTEGRATOR(x0=0))
+        self.assertFalse(bd.compile())
+
+    def test_checkfinite(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+        ramp = bd.INTEGRATOR(x0=0)
+        func = bd.FUNCTION(lambda u: np.nan if u > 1 else u, name='func')
+        gain = bd.GAIN(np.r_[1, 2])
+        bd.connect(bd.CONSTANT(1), ramp)
+        bd.connect(ramp, func)
+        bd.connect(func, gain)
+        bd.connect(gain, bd.OUTPORT(1))
+        bd.compile()
+
+        self.assertEqual([(b, p) for b, p in bd._scalarwires], [(func, 0), (gain, 0)])
+        self.assertEqual(len(bd._arraywires), 1)
+
+        self.assertIsNone(bd.run(T=2))
+        out = bd.run(T=2, checkfinite=False)
+        self.assertIsNotNone(out)
+
+        # the first wire in schedule order is reported
+        bd.evaluate(np.r_[2.0], 2)
+        with self.assertRaisesRegex(RuntimeError, 'from block func output 0'):
+            bd._checkfinite(2)
+
+        # the inputs of fused blocks are not updated, values on wires
+        # entering the group are read from the fused block
+        for store in (False, True):
+            bd = bdsim.BlockDiagram(progress=False)
+            ramp = bd.INTEGRATOR(x0=0)
+            func = bd.FUNCTION(lambda u: np.nan if u > 1 else u, name='func')
+            sum = bd.SUM('++')
+            bd.connect(bd.CONSTANT(1), ramp)
+            bd.connect(ramp, func)
+            bd.connect(func, sum[0])
+            bd.connect(bd.CONSTANT(1), sum[1])
+            gain = bd.GAIN(2)
+            bd.connect(sum, gain)
+            bd.connect(gain, bd.OUTPORT(1))
+            bd.compile(fuse=True, store=store)
+            self.assertEqual(len(bd._fused), 1)
+
+            self.assertIsNone(bd.run(T=2))
+            bd.evaluate(np.r_[2.0], 2)
+            with self.assertRaisesRegex(RuntimeError, r'wire func\[0\] --> sum.0\[0\]'):
+                bd._checkfinite(2)
+
+    def test_store(self):
+
+        def diagram(store):
+            bd = bdsim.BlockDiagram(progress=False)
+            step = bd.STEP(T=1, off=0.0, on=1.0)
+            gain = bd.GAIN(np.r_[1.0, 2.0])
+            int1 = bd.INTEGRATOR(x0=np.r_[0.0, 0.0])
+            gain2 = bd.GAIN(-1)
+            sum = bd.SUM('++')
+            int2 = bd.INTEGRATOR(x0=0)
+            bd.connect(step, gain)
+            bd.connect(gain, int1)
+            bd.connect(int1, bd.OUTPORT(1))
+            bd.connect(int2, gain2)
+            bd.connect(gain2, sum[0])
+            bd.connect(step, sum[1])
+            bd.connect(sum, int2)
+            bd.compile(store=store)
+            return bd, gain, int1
+
+        bd0, gain, int1 = diagram(False)
+        self.assertIsNone(bd0._store)
+        out0 = bd0.run(T=3, watch=[int1])
+
+        bd, gain, int1 = diagram(True)
+        self.assertEqual(bd._store.shape, (8,))
+
+        # vector inputs are views of the store, scalars are sent to inputs
+        self.assertTrue(np.shares_memory(int1.inputs[0], bd._store))
+        self.assertEqual(len(gain._objfanout), 0)
+        self.assertEqual([p for p, k in bd.blocknames['step.0']._scalarslots], [0])
+
+        out = bd.run(T=3, watch=[int1])
+        nt.assert_equal(out.x, out0.x)
+        nt.assert_equal(out.u0, out0.u0)
+        nt.assert_equal(out.u0[-1], [1, 2])
+
+        # the store holds the values on all the wires
+        self.assertTrue(np.all(bd._store != 0))
+        bd.evaluate(np.full((3,), np.nan), 3)
+        self.assertFalse(np.all(np.isfinite(bd._store)))
+        with self.assertRaises(RuntimeError):
+            bd._checkfinite(3)
+
+        # an ensemble does not use the store, which is restored after
+        out = bd.run_ensemble(params={'gain.1.gain': [-1, -2]}, T=3)
+        nt.assert_allclose(out.x[-1, :, :2], [[2, 4], [2, 4]], rtol=1e-3)
+        nt.assert_allclose(out.x[-1, 0, 2], out0.x[-1, 2], rtol=1e-3)
+        self.assertTrue(np.shares_memory(int1.inputs[0], bd._store))
+        out = bd.run(T=3)
+        nt.assert_equal(out.x, out0.x)
+
+    def test_fixedstep(self):
+
+        # x'' = -x, x(0) = 1, has the solution x = cos(t)
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0)
+        int2 = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1)
+        bd.connect(int1, int2)
+        bd.connect(int2, gain, bd.OUTPORT(1))
+        bd.connect(gain, int1)
+        bd.compile()
+
+        def error(solver, dt):
+            out = bd.run(T=2, dt=dt, solver=solver)
+            self.assertAlmostEqual(out.t[-1], 2)
+            nt.assert_allclose(np.diff(out.t), dt)
+            return np.max(np.abs(out.x[:, 1] - np.cos(out.t)))
+
+        # halving the step reduces the error according to the order
+        for solver, order in [('euler', 1), ('heun', 2), ('rk4', 4), ('dopri5', 5)]:
+            ratio = error(solver, 0.1) / error(solver, 0.05)
+            self.assertGreater(ratio, 2 ** order * 0.8, solver)
+
+        # the last step is shortened to end at T
+        out = bd.run(T=1.05, dt=0.1, solver='rk4')
+        nt.assert_allclose(out.t[-2:], [1.0, 1.05])
+
+        out = bd.run_ensemble(x0=[[0, 1], [0, 2]], T=2, dt=0.1, solver='rk4')
+        nt.assert_allclose(out.x[-1, :, 1], [np.cos(2), 2 * np.cos(2)], rtol=1e-4)
+
+        with self.assertRaises(ValueError):
+            bd.run_ensemble(x0=[[0, 1]], T=2, solver='rk4', rtol=1e-3)
+
+    def test_t_eval(self):
+
+        # x'' = -x, x(0) = 1, has the solution x = cos(t)
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0)
+        int2 = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1)
+        bd.connect(int1, int2)
+        bd.connect(int2, gain, bd.OUTPORT(1))
+        bd.connect(gain, int1)
+        bd.compile()
+
+        # the solver takes large steps, the results are interpolated
+        for solver in ('RK45', 'rk4', 'dopri5'):
+            out = bd.run(T=5, dt=0.5, solver=solver, sample_dt=0.01, watch=[gain])
+            nt.assert_allclose(out.t, np.linspace(0, 5, 501))
+            self.assertEqual(out.x.shape, (501, 2))
+            nt.assert_allclose(out.x[:, 1], np.cos(out.t), atol=1e-2)
+            nt.assert_allclose(out.u0, out.x[:, 1])
+
+        t = [0.25, 0.5, 2]
+        out = bd.run(T=3, t_eval=t, watch=[gain])
+        nt.assert_equal(out.t, t)
+        nt.assert_allclose(out.x[:, 1], np.cos(t), rtol=1e-3)
+        nt.assert_allclose(out.u0, np.cos(t), rtol=1e-3)
+
+        with self.assertRaises(ValueError):
+            bd.run(T=3, t_eval=[1, 4])
+        with self.assertRaises(ValueError):
+            bd.run(T=3, t_eval=[1, 0.5])
+
+    def test_breakpoints(self):
+
+        # the integral of a step at t=1 and of a pulse from 2 to 2.5
+        bd = bdsim.BlockDiagram(progress=False)
+        step = bd.STEP(T=1, off=0.0, on=1.0)
+        pulse = bd.PIECEWISE((0, 0), (2, 1), (2.5, 0))
+        sum = bd.SUM('++')
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(step, sum[0])
+        bd.connect(pulse, sum[1])
+        bd.connect(sum, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        self.assertEqual(bd._breakpoints(3), [1, 2, 2.5])
+        self.assertEqual(bd._breakpoints(2), [1])
+
+        # no step straddles a breakpoint, and the result is exact
+        out = bd.run(T=3, dt=10)
+        for t in (1, 2, 2.5):
+            self.assertIn(np.nextafter(t, 0), out.t)
+        nt.assert_allclose(out.x[:, 0], np.maximum(out.t - 1, 0) + np.clip(out.t - 2, 0, 0.5), atol=1e-12)
+
+        out = bd.run_ensemble(x0=[[0], [1]], T=3, dt=10)
+        nt.assert_allclose(out.x[-1, :, 0], [2.5, 3.5], atol=1e-12)
+
+        # a function of time that is a source but has no breakpoints
+        bd = bdsim.BlockDiagram(progress=False)
+        clock = _Clock()
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.add_block(clock)
+        bd.connect(clock, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        self.assertEqual(bd._breakpoints(3), [])
+        out = bd.run(T=2)
+        self.assertAlmostEqual(out.x[-1, 0], 2, places=2)
+
+    def test_events(self):
+
+        # stop when a ramp reaches 1.234
+        bd = bdsim.BlockDiagram(progress=False)
+        ramp = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), ramp)
+        bd.connect(ramp, bd.STOP(lambda x: x >= 1.234))
+        bd.compile()
+        out = bd.run(T=5, dt=10)
+        self.assertAlmostEqual(out.t[-1], 1.234, places=9)
+        self.assertAlmostEqual(out.x[-1, 0], 1.234, places=9)
+
+        # a step is evaluated once, for its event functions and its results
+        times = []
+        evaluate = bd.evaluate
+        def counted(x, t, outputs=True):
+            if outputs:
+                times.append(t)
+            return evaluate(x, t, outputs)
+        bd.evaluate = counted
+        bd.run(T=5, dt=0.5, solver='rk4')
+        self.assertEqual(times.count(0.5), 1)
+
+        # an integrator that saturates at 1 until its input reverses
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0, max=1)
+        bd.connect(bd.PIECEWISE((0, 1), (2, -1)), int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        for solver in ('RK45', 'rk4'):
+            out = bd.run(T=3, dt=10, solver=solver, t_eval=[0.5, 1.5, 2.5, 3])
+            nt.assert_allclose(out.x[:, 0], [0.5, 1, 0.5, 0], atol=1e-9)
+
+    def test_jacobian(self):
+
+        # a chain of feedback loops around LTI blocks
+        bd = bdsim.BlockDiagram(progress=False)
+        prev = bd.STEP(T=0.5)
+        for i in range(5):
+            sum = bd.SUM('+-')
+            lti = bd.LTI_SISO(1, [1, 3, 2])
+            bd.connect(prev, sum[0])
+            bd.connect(lti, sum[1])
+            bd.connect(sum, bd.GAIN(2), lti)
+            prev = lti
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(prev, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+
+        # each LTI block is driven by the one before
+        J, sparsity = bd._jacobian()
+        pattern = np.kron(np.eye(5) + np.eye(5, k=-1), np.ones((2, 2)))
+        pattern = np.pad(pattern, (0, 1))
+        pattern[-1, -3:] = 1
+        nt.assert_array_equal(sparsity.toarray(), pattern)
+
+        # compare with finite differences
+        x = np.linspace(-1, 1, bd.nstates)
+        f = lambda x: bd.evaluate(x, 1.0, outputs=False).copy()
+        Jfd = np.column_stack([(f(x + 1e-6 * e) - f(x)) / 1e-6 for e in np.eye(bd.nstates)])
+        nt.assert_allclose(J.toarray(), Jfd, atol=1e-5)
+        self.assertTrue(np.all(J.toarray()[pattern == 0] == 0))
+
+        ref = bd.run(T=5, t_eval=[1, 3, 5])
+        for solver in ('BDF', 'Radau', 'LSODA'):
+            out = bd.run(T=5, solver=solver, t_eval=[1, 3, 5])
+            nt.assert_allclose(out.x, ref.x, atol=1e-3)
+
+        # a nonlinear block has no Jacobian, but the sparsity is known
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=1)
+        int2 = bd.INTEGRATOR(x0=0)
+        func = bd.FUNCTION(lambda x: -x ** 3)
+        bd.connect(func, int1)
+        bd.connect(int1, func, int2)
+        bd.compile()
+        J, sparsity = bd._jacobian()
+        self.assertIsNone(J)
+        nt.assert_array_equal(sparsity.toarray(), [[1, 0], [1, 1]])
+        ref = bd.run(T=2, t_eval=[2])
+        out = bd.run(T=2, solver='BDF', t_eval=[2])
+        nt.assert_allclose(out.x, ref.x, atol=1e-3)
+
+    def test_recorder(self):
+
+        from bdsim.recorder import Recorder
+
+        rec = Recorder(chunk=2)
+        rec.add('t', ())
+        rec.add('x', (2,))
+        rec.add('u')
+        for k in range(5):
+            rec.append(k / 10, np.r_[k, -k], k)
+        out = rec.arrays()
+        nt.assert_array_equal(out['t'], np.arange(5) / 10)
+        nt.assert_array_equal(out['x'], np.c_[np.arange(5), -np.arange(5)])
+        self.assertEqual(out['u'].dtype, np.float64)
+        self.assertEqual(out['u'].shape, (5,))
+        self.assertEqual(rec.n, 0)
+
+        # the arrays are not views of the larger arrays they were recorded in
+        for a in out.values():
+            self.assertTrue(a.flags.owndata)
+
+        # the arrays are trimmed in place, unless there is a view of them
+        rec = Recorder(chunk=8)
+        rec.add('t', ())
+        rec.add('x', (2,))
+        for k in range(5):
+            rec.append(k, np.r_[k, -k])
+        address = rec._arrays[0].ctypes.data
+        view = rec._arrays[1][:2]
+        out = rec.arrays()
+        self.assertEqual(out['t'].ctypes.data, address)
+        self.assertEqual(out['x'].shape, (5, 2))
+        self.assertFalse(np.shares_memory(out['x'], view))
+        nt.assert_array_equal(view, [[0, 0], [1, -1]])
+
+        # more steps than the initial size of the arrays
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(2), int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        out = bd.run(T=3, dt=1e-3, solver='euler', watch=[int1])
+        self.assertEqual(out.t.shape, (3000,))
+        self.assertEqual(out.x.shape, (3000, 1))
+        nt.assert_allclose(out.x[:, 0], 2 * out.t)
+        self.assertEqual(out.u0.dtype, np.float64)
+        nt.assert_array_equal(out.u0, np.full((3000,), 2.0))
+
+    def test_record_to(self):
+
+        from bdsim.recorder import NpyRecorder, load
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # written in several chunks
+            rec = NpyRecorder(os.path.join(tmp, 'rec'), chunk=7, attrs={'a': [1, 2]})
+            rec.add('t', ())
+            rec.add('x', (2,))
+            rec.add('u')
+            for k in range(30):
+                rec.append(k / 10, np.r_[k, -k], k)
+            out = rec.arrays()
+            self.assertIsInstance(out['x'], np.memmap)
+            nt.assert_array_equal(out['t'], np.arange(30) / 10)
+            nt.assert_array_equal(out['x'], np.c_[np.arange(30), -np.arange(30)])
+            nt.assert_array_equal(out['u'], np.arange(30))
+            self.assertEqual(load(os.path.join(tmp, 'rec')).a, [1, 2])
+
+            bd = bdsim.BlockDiagram(progress=False)
+            int1 = bd.INTEGRATOR(x0=np.r_[1.0, 2.0])
+            gain = bd.GAIN(-1)
+            bd.connect(int1, gain)
+            bd.connect(gain, int1)
+            bd.compile()
+            ref = bd.run(T=2, watch=[gain])
+
+            formats = ['run']
+            try:
+                import h5py
+                formats.append('run.h5')
+            except ImportError:
+                pass
+            for name in formats:
+                path = os.path.join(tmp, name)
+                out = bd.run(T=2, watch=[gain], record_to=path)
+                for out in (out, load(path)):
+                    nt.assert_array_equal(out.t[:], ref.t)
+                    nt.assert_array_equal(out.x[:], ref.x)
+                    nt.assert_array_equal(out.u0[:], ref.u0)
+                    self.assertEqual(out.xnames, ref.xnames)
+                    self.assertEqual(out.unames, ref.unames)
+                del out
+
+            # without h5py an HDF5 file is recorded as a directory
+            with unittest.mock.patch.dict(sys.modules, {'h5py': None}):
+                path = os.path.join(tmp, 'nohdf5.h5')
+                out = bd.run(T=2, watch=[gain], record_to=path)
+                self.assertTrue(os.path.isdir(path))
+                nt.assert_array_equal(load(path).x, ref.x)
+            del out
+
+            # the file is completed if the simulation raises an error
+            fail = _Fail()
+            bd.add_block(fail)
+            bd.connect(int1, fail)
+            bd.compile()
+            path = os.path.join(tmp, 'fail')
+            with self.assertRaises(ValueError):
+                bd.run(T=2, record_to=path)
+            out = load(path)
+            self.assertGreater(len(out.t), 0)
+            self.assertTrue(np.all(out.t[:] <= 1.1))
+            self.assertEqual(out.x.shape, (len(out.t), 2))
+            del out
+
+    def test_watch_policy(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.STEP(T=1), int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+        out = bd.run(T=3, dt=0.01, solver='rk4',
+            watch=[int1, (int1, {'change': True}), (int1, {'every': 50}), (int1, {'period': 0.5})])
+        self.assertEqual(len(out.u0), 300)
+        nt.assert_allclose(out.t_u1, [0.01, 1.01])
+        nt.assert_array_equal(out.u1, [0, 1])
+        nt.assert_allclose(out.t_u2, out.t[::50])
+        nt.assert_allclose(out.t_u3, [0.01, 0.5, 1, 1.5, 2, 2.5, 3])
+        self.assertEqual(out.unames, [str(int1[0])] * 4)
+
+        with self.assertRaises(ValueError):
+            bd.run(T=3, watch=[(int1, {'sometimes': True})])
+        with self.assertRaises(ValueError):
+            bd.iterrun(T=3, watch=[(int1, {'every': 2})])
+
+    def test_stats(self):
+
+        # statistics of a ramp over time, with steps of varying size
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), int1)
+        bd.connect(int1, bd.STATS(weighted=True, name='ramp'))
+        bd.compile()
+        out = bd.run(T=2, dt=10)
+        s = out.stats['ramp']
+        self.assertEqual(s.n, len(out.t))
+        self.assertAlmostEqual(s.max, 2)
+        # the mean of a sample held back over each step
+        ref = np.sum(out.x[:, 0] * np.diff(np.r_[0, out.t])) / 2
+        self.assertAlmostEqual(s.mean, ref)
+
+    def test_iterrun(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(-1)
+        bd.connect(int1, gain)
+        bd.connect(gain, int1)
+        bd.compile()
+        ref = bd.run(T=2, watch=[gain])
+
+        # the same steps as run, and can be resumed after a pause
+        steps = bd.iterrun(T=2, watch=[gain])
+        first = list(itertools.islice(steps, 3))
+        rest = list(steps)
+        t = np.array([t for t, x, u in first + rest])
+        x = np.array([x for t, x, u in first + rest])
+        u = np.array([u[0] for t, x, u in first + rest])
+        nt.assert_array_equal(t, ref.t)
+        nt.assert_array_equal(x, ref.x)
+        nt.assert_array_equal(u, ref.u0)
+
+        # sample times
+        for t, x, u in bd.iterrun(T=2, sample_dt=0.5):
+            self.assertAlmostEqual(x[0], np.exp(-t), places=3)
+        self.assertEqual(t, 2)
+
+        # no states
+        bd = bdsim.BlockDiagram(progress=False)
+        gain = bd.GAIN(2)
+        bd.connect(bd.WAVEFORM('sine'), gain)
+        bd.connect(gain, bd.OUTPORT(1))
+        bd.compile()
+        steps = list(bd.iterrun(T=1, dt=0.25, watch=[gain]))
+        self.assertEqual([t for t, x, u in steps], [0, 0.25, 0.5, 0.75])
+        self.assertTrue(all([x is None for t, x, u in steps]))
+
+    def test_allocation(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+        blocks = [_Scale(-1.0, bd=bd), _Integrate(bd=bd), _Scale(2.0, bd=bd)]
+        for b in blocks:
+            bd.add_block(b)
+        bd.connect(blocks[1], blocks[0], blocks[2])
+        bd.connect(blocks[0], blocks[1])
+        bd.connect(blocks[2], bd.OUTPORT(1))
+
+        def nothing(x, t, outputs):
+            pass
+
+        def measure(evaluate, outputs):
+            # memory allocated and not freed, and peak allocation, while
+            # evaluating the diagram many times after a warm-up
+            x = np.r_[0.5]
+            times = [0.1 * i for i in range(1000)]
+            for t in times[:10]:
+                evaluate(x, t, outputs)
+            tracemalloc.start()
+            try:
+                for t in times[:10]:
+                    evaluate(x, t, outputs)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                for t in times:
+                    evaluate(x, t, outputs)
+                after, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            return after - before, peak - before
+
+        baseline = measure(nothing, True)[1]
+        for store in (False, True):
+            bd.compile(store=store)
+            for outputs in (False, True):
+                leaked, peak = measure(bd.evaluate, outputs)
+                self.assertEqual(leaked, 0)
+                # only the iterators of the loops over the schedule and fanout
+                self.assertLessEqual(peak - baseline, 2 * 64)
+
+    def test_fuse(self):
+
+        def diagram():
+            bd = bdsim.BlockDiagram(progress=False)
+            sum = bd.SUM('+-', name='sum')
+            gain = bd.GAIN(10, name='K')
+            plant = bd.LTI_SISO(0.5, [2, 1], name='plant')
+            g2 = bd.GAIN(np.r_[1.0, 2.0], name='g2')
+            demux = bd.DEMUX(2, name='demux')
+            lti = bd.LTI_SS(A=-np.eye(2), B=np.eye(2), C=np.eye(2), name='lti')
+            mux = bd.MUX(2, name='mux')
+            bd.connect(bd.STEP(T=1), sum[0])
+            bd.connect(plant, sum[1])
+            bd.connect(sum, gain)
+            clip = bd.CLIP(min=-5, max=5, name='clip')
+            bd.connect(gain, clip)
+            bd.connect(clip, plant)
+            bd.connect(plant, g2)
+            bd.connect(g2, demux)
+            bd.connect(demux[0], lti[0])
+            bd.connect(demux[1], lti[1])
+            bd.connect(lti[0], mux[0])
+            bd.connect(lti[1], mux[1])
+            bd.connect(mux, bd.OUTPORT(1))
+            return bd
+
+        bd = diagram()
+        bd.compile()
+        ref = bd.run(T=3, watch=['K', 'demux'])
+
+        bd = diagram()
+        bd.compile(fuse=True)
+        names = [[str(b) for b in g.members] for g in bd._fused]
+        self.assertEqual(len(names), 2)
+        self.assertCountEqual(names[0], ['plant', 'lti', 'g2', 'demux', 'mux'])
+        self.assertEqual(names[1], ['sum', 'K'])
+        self.assertEqual(bd._fused[0].blockclass, 'transfer')
+        self.assertNotIn(bd.blocknames['K'], bd.schedule)
+
+        # the blocks within the fused blocks can be watched
+        out = bd.run(T=3, watch=['K', 'demux'])
+        nt.assert_almost_equal(out.x, ref.x)
+        nt.assert_almost_equal(out.u0, ref.u0)
+        nt.assert_almost_equal(out.u1, ref.u1)
+
+        # changed parameters are used by the next run
+        bd.blocknames['K'].gain = 2
+        out = bd.run(T=3, watch=['clip'])
+        nt.assert_almost_equal(out.u0[-1], 2 * (1 - out.x[-1, 0] * 0.25))
+
+        bd.compile(fuse=True, codegen=True)
+        evaluate = bd._codemaker(bd, bd._codeblocks)
+        x = np.r_[0.1, 0.2, 0.3]
+        nt.assert_equal(evaluate(x, 2), bd.evaluate(x, 2).copy())
+
+        # a group is not fused if that would close a loop through another block
+        bd = bdsim.BlockDiagram(progress=False)
+        int1 = bd.INTEGRATOR(x0=1)
+        gain = bd.GAIN(2)
+        sum = bd.SUM('++')
+        bd.connect(int1, gain)
+        bd.connect(gain, sum[0])
+        clip = bd.CLIP(min=-1, max=1)
+        bd.connect(gain, clip)
+        bd.connect(clip, sum[1])
+        bd.connect(sum, int1)
+        self.assertTrue(bd.compile(fuse=True))
+        self.assertEqual(bd._fused, [])
+
+    def test_prune(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), int1)
+        bd.connect(int1, bd.OUTPORT(1))
+
+        # diagnostic branch whose output goes nowhere
+        gain1 = bd.GAIN(2)
+        gain2 = bd.GAIN(3)
+        bd.connect(int1, gain1)
+        bd.connect(gain1, gain2)
+        
+        bd.compile()
+        self.assertEqual(bd.pruned, [gain1, gain2])
+        self.assertNotIn(gain1, bd.schedule)
+        self.assertIsNone(gain2.inputs[0])
+
+        # watching the branch puts it back in the schedule
+        out = bd.run(T=1, watch=[gain2])
+        self.assertIn(gain1, bd.schedule)
+        self.assertNotIn(gain2, bd.schedule)
+        nt.assert_almost_equal(out.u0, 2 * out.x[:, 0])
+
+        bd.compile(prune=False)
+        self.assertEqual(bd.pruned, [])
+        self.assertIn(gain2, bd.schedule)
+
+    def test_codegen(self):
+
+        bd, dst = self._codegen_diagram()
+        bd.compile(codegen=True)
+        self.assertIn('def make(bd, blocks):', bd.code)
+
+        evaluate = bd._codemaker(bd, bd._codeblocks)
+        for t in [0, 2]:
+            x = np.r_[0.7]
+            xd = bd.evaluate(x, t).copy()
+            nt.assert_equal(evaluate(x, t), xd)
+
+        # the code only evaluates blocks needed for the derivative
+        dst.inputs[0] = None
+        evaluate(x, 2)
+        self.assertIsNone(dst.inputs[0])
+        bd.evaluate(x, 2)
+        nt.assert_equal(dst.inputs[0], np.r_[0.5, 1 - 0.7 * 0.25])
+
+    def test_codegen_cache(self):
+        import tempfile
+        import os
+
+        with tempfile.TemporaryDirectory() as cachedir:
+            bd, dst = self._codegen_diagram()
+            bd.compile(codegen=True, codecache=cachedir)
+            files = os.listdir(cachedir)
+            self.assertEqual(len([f for f in files if f.endswith('.py')]), 1)
+
+            # compiling the same diagram again reuses the cached code
+            bd, dst = self._codegen_diagram()
+            bd.compile(codegen=True, codecache=cachedir)
+            self.assertEqual(os.listdir(cachedir), files)
+
+            evaluate = bd._codemaker(bd, bd._codeblocks)
+            nt.assert_equal(evaluate(np.r_[0.7], 2), bd.evaluate(np.r_[0.7], 2))
+
+    def test_ensemble(self):
+
+        bd = bdsim.BlockDiagram(progress=False)
+
+        gain = bd.GAIN(1)
+        int1 = bd.INTEGRATOR(x0=0)
+        bd.connect(bd.CONSTANT(1), gain)
+        bd.connect(gain, int1)
+        bd.connect(int1, bd.OUTPORT(1))
+        bd.compile()
+
+        out = bd.run_ensemble(x0=[[0], [1], [2]], params={'gain.0.gain': [1, 2, 3]}, T=2, watch=[int1])
+        self.assertEqual(out.x.shape, (len(out.t), 3, 1))
+        nt.assert_almost_equal(out.x[-1, :, 0], np.r_[2, 5, 8])
+        self.assertEqual(out.u0.shape, (len(out.t), 3))
+        nt.assert_equal(out.u0[-1], np.r_[1, 2, 3])
+
+        # the diagram is restored after the run
+        self.assertEqual(gain.gain, 1)
+        self.assertFalse(gain.batched)
+        nt.assert_equal(bd.evaluate(np.r_[5], 0), np.r_[1])
+        self.assertTrue(np.shares_memory(int1._x, bd.x))
+
+        with self.assertRaises(ValueError):
+            bd.run_ensemble(x0=[[0], [1]], params={'gain.0.gain': [1, 2, 3]})
+        with self.assertRaises(ValueError):
+            bd.run_ensemble(params={'gain.0.nosuchparam': [1, 2, 3]})
+        with self.assertRaisesRegex(ValueError, 'source'):
+            bd.run_ensemble(params={'constant.0.value': [1, 2, 3]})
+
+        # a pruned block that does not support ensembles, restored to the
+        # schedule because its output is watched
+        func = bd.FUNCTION(np.sum)
+        gain2 = bd.GAIN(2)
+        bd.connect(int1, func)
+        bd.connect(func, gain2)
+        bd.compile()
+        self.assertIn(func, bd.pruned)
+        with self.assertRaises(ValueError):
+            bd.run_ensemble(x0=[[0], [1], [2]], T=2, watch=[gain2])
+        self.assertIn(func, bd.schedule)
+
+    def test_ensemble_feedback(self):
+
+        def diagram():
+            bd = bdsim.BlockDiagram(progress=False)
+            sum = bd.SUM('+-')
+            gain = bd.GAIN(1, name='K')
+            plant = bd.LTI_SISO(0.5, [2, 1])
+            vehicle = bd.UNICYCLE(x0=[0, 0, 0])
+            bd.connect(bd.STEP(T=1), sum[0])
+            bd.connect(plant, sum[1])
+            bd.connect(sum, gain)
+            bd.connect(gain, plant)
+            bd.connect(bd.CONSTANT(1), vehicle[0])
+            bd.connect(plant, vehicle[1])
+            bd.connect(vehicle[0], bd.OUTPORT(1))
+            bd.connect(vehicle[1], bd.OUTPORT(1))
+            bd.connect(vehicle[2], bd.OUTPORT(1))
+            bd.compile()
+            return bd
+
+        gains = [0.5, 2, 10]
+        bd = diagram()
+        out = bd.run_ensemble(params={'K.gain': gains}, T=5)
+
+        for i, k in enumerate(gains):
+            bd = diagram()
+            bd.blocknames['K'].gain = k
+            ref = bd.run(T=5)
+            nt.assert_allclose(out.x[-1, i, :], ref.x[-1, :], rtol=1e-2, atol=1e-3)
+
+    def test_sweep(self):
+
+        results = bdsim.sweep(_sweep_diagram, {'K.gain': [1, 2, 3], 'c.value': [1, 10]},
+                              workers=2, T=2, watch=['int'])
+        self.assertEqual(len(results), 6)
+        for (k, c), out in results.items():
+            self.assertEqual(out.params, {'K.gain': k, 'c.value': c})
+            nt.assert_almost_equal(out.x[-1], [2 * k * c])
+            nt.assert_equal(out.u0[-1], k * c)
+
+        # values that cannot be keys
+        values = [np.diag([1.0, 2.0]), np.diag([3.0, 4.0])]
+        results = bdsim.sweep(_sweep_vector_diagram, {'K.gain': values}, workers=2, T=2)
+        self.assertEqual(list(results.keys()), [(0,), (1,)])
+        for (j,), out in results.items():
+            nt.assert_equal(out.params['K.gain'], values[j])
+            nt.assert_almost_equal(out.x[-1], 2 * np.diag(values[j]))
+
+        # indices are used only for the values that cannot be keys
+        results = bdsim.sweep(_sweep_vector_diagram, {'K.gain': values, 'K.premul': [False, True]},
+                              workers=2, T=2)
+        self.assertEqual(sorted(results.keys()), [(0, False), (0, True), (1, False), (1, True)])
+
+        # a point that fails does not stop the sweep
+        results = bdsim.sweep(_sweep_fail_diagram, {'fail.after': [1, 10]}, workers=2, T=2)
+        self.assertIsNone(results[1,])
+        nt.assert_almost_equal(results[10,].x[-1], [2])
 
 class WiringTest(unittest.TestCase):
 